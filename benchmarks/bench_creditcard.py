@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Benchmarks the per-card cost of validating credit card numbers.
+
+Generates random card numbers of the well known types (about one in ten of
+them valid) and times verify_credit_card() in a loop against the bulk
+verify_credit_cards().
+
+Usage:
+    python benchmarks/bench_creditcard.py [cards] [repeat]
+
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure()
+
+from skipjack.creditcard import verify_credit_card, verify_credit_cards
+
+
+PREFIXES = ('4', '51', '55', '2221', '677189', '30', '36', '38', '34', '37',
+            '3528', '6011', '65', '62', '6759')
+
+
+def card_numbers(cards):
+    random.seed(0)
+    return [prefix + ''.join([random.choice('0123456789')
+                              for i in xrange(16 - len(prefix))])
+            for prefix in [random.choice(PREFIXES) for i in xrange(cards)]]
+
+
+def per_card(func, numbers, repeat):
+    """Best of `repeat` runs, in microseconds per card."""
+    timer = timeit.Timer(lambda: func(numbers))
+    return min(timer.repeat(repeat=repeat, number=1)) / len(numbers) * 1e6
+
+
+def main():
+    cards = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    numbers = card_numbers(cards)
+    print 'cards: %d, best of %d' % (cards, repeat)
+    print 'verify_credit_card (loop):  %6.2f us/card' % per_card(
+        lambda numbers: [verify_credit_card(number) for number in numbers],
+        numbers, repeat)
+    print 'verify_credit_cards (bulk): %6.2f us/card' % per_card(
+        lambda numbers: list(verify_credit_cards(numbers)), numbers, repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Benchmarks the per-row cost of parsing Skipjack responses.
+
+Builds synthetic Transaction Status and Customized Report responses of the
+requested size and times skipjack.parsers against them, without contacting
+Skipjack.
+
+Usage:
+    python benchmarks/bench_parsers.py [rows] [repeat]
+
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=['skipjack'],
+    )
+
+from skipjack.parsers import parse_status, parse_report
+
+
+STATUS_HEADER = '"000111222333","%d","","","","","","",""\r\n'
+STATUS_ROW = '"000111222333","150.00","12","Status message","12345",' \
+             '"10/19/11 13:02:03","%012d","123456","1042"\r\n'
+
+REPORT_HEADER = 'TransactionDate,TransactionStatus,TransactionFileName,' \
+                'OrderNumber,ApprovalCode,Amount,OriginalAmount<br>\r\n'
+REPORT_ROW = '10/19/2011 1:02:03 PM,Settled,%012d,12345,123456,' \
+             '$150.00,$150.00<br>\r\n'
+
+
+def status_response(rows):
+    return STATUS_HEADER % rows + ''.join(STATUS_ROW % i
+                                          for i in xrange(rows))
+
+
+def report_response(rows):
+    return '<html><body><!-- Begin Data -->' + REPORT_HEADER + \
+           ''.join(REPORT_ROW % i for i in xrange(rows)) + \
+           '<!-- End Data --></body></html>'
+
+
+def per_row(func, response, rows, repeat):
+    """Best of `repeat` runs, in microseconds per row."""
+    timer = timeit.Timer(lambda: func(response))
+    return min(timer.repeat(repeat=repeat, number=1)) / rows * 1e6
+
+
+def touch(history):
+    """Access the lazily converted values too, as a real caller would."""
+    for status in history:
+        status.date, status.amount, status.message_detail
+    return history
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    status = status_response(rows)
+    report = report_response(rows)
+    print 'rows: %d, best of %d' % (rows, repeat)
+    print 'status/history (parse only):   %6.2f us/row' % per_row(
+        parse_status, status, rows, repeat)
+    print 'status/history (all values):   %6.2f us/row' % per_row(
+        lambda response: touch(parse_status(response)), status, rows, repeat)
+    print 'customized report:             %6.2f us/row' % per_row(
+        parse_report, report, rows, repeat)
+    print 'customized report (columnar):  %6.2f us/row' % per_row(
+        lambda response: parse_report(response, columnar=True), report,
+        rows, repeat)
+
+
+if __name__ == '__main__':
+    main()
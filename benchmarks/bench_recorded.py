@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Benchmarks the parsers and concurrent status requests against traffic
+recorded from Skipjack with SKIPJACK_RECORD_FILE (see skipjack.recording),
+without contacting Skipjack.
+
+Times each endpoint's parser against its recorded responses, then replays
+the recorded status requests `workers` at a time with their recorded
+latencies, as the sync command makes them.
+
+Usage:
+    python benchmarks/bench_recorded.py recording.jsonl [workers] [repeat]
+
+"""
+import os
+import sys
+import time
+import timeit
+import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+if not settings.configured:
+    settings.configure(
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3',
+                               'NAME': ':memory:'}},
+        INSTALLED_APPS=['skipjack'],
+        SKIPJACK_DEBUG=True,
+    )
+
+from skipjack.parsers import parse_authorize, parse_status, \
+                             parse_change_status, parse_close_batch, \
+                             parse_report
+from skipjack.recording import load, install_replay, uninstall_replay
+from skipjack.utils import get_transaction_status
+from skipjack.workers import imap_unordered
+
+
+PARSERS = {
+    'authorize': parse_authorize,
+    'status': parse_status,
+    'change_status': parse_change_status,
+    'close_batch': parse_close_batch,
+    'report': parse_report,
+}
+
+
+def per_response(func, responses, repeat):
+    """Best of `repeat` runs, in microseconds per response."""
+    timer = timeit.Timer(lambda: [func(response) for response in responses])
+    return min(timer.repeat(repeat=repeat, number=1)) / len(responses) * 1e6
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit(__doc__)
+    path = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    repeat = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    records = load(path)
+    print 'records: %d, best of %d' % (len(records), repeat)
+    for endpoint, parser in sorted(PARSERS.items()):
+        responses = [record['response'] for record in records
+                     if record['endpoint'] == endpoint]
+        if responses:
+            print '%-14s %5d responses %10.2f us/response' % (
+                endpoint + ':', len(responses),
+                per_response(parser, responses, repeat))
+    orders = [dict(urlparse.parse_qsl(record['request'])).get('szOrderNumber')
+              for record in records if record['endpoint'] == 'status']
+    if not orders:
+        return
+    install_replay(path)
+    try:
+        started = time.time()
+        for order, status, error in imap_unordered(get_transaction_status,
+                                                   orders, workers):
+            pass
+        elapsed = time.time() - started
+    finally:
+        uninstall_replay()
+    print 'status replay: %d requests, %d workers, %.1f requests/second' % (
+        len(orders), workers, len(orders) / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,7 @@ setup(name='django-skipjack',
       author_email='richard@richardbolt.com',
       url='http://github.com/richardbolt/django-skipjack/tree/master',
       packages=['skipjack'],
+      package_data={'skipjack': ['data/*.csv']},
       keywords=['django', 'Skipjack', 'payment'],
       classifiers=[
           'Development Status :: 3 - Alpha',
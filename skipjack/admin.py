@@ -1,16 +1,69 @@
 """Admin definitions for the Skipjack usage in Django's admin site."""
+import datetime
+
 from django.conf import settings
+from django.conf.urls.defaults import patterns, url
 from django.contrib import admin
 from django.contrib.admin import helpers
 from django.contrib.admin.util import get_deleted_objects
 from django.contrib import messages
 from django.core.exceptions import PermissionDenied
 from django.db import router
+from django.http import HttpResponse
 from django.template.response import TemplateResponse
 from django.utils.encoding import force_unicode
 from django.utils.translation import ugettext_lazy as _
 
-from skipjack.models import Transaction, TransactionError
+from skipjack.counts import CountingQuerySet
+from skipjack.export import export_csv
+from skipjack.models import Transaction, TransactionError, \
+                            QueuedStatusChange, DailyRollup, \
+                            ArchivedTransaction, \
+                            CURRENT_STATUS_CHOICES, RETURN_CODE_CHOICES
+
+# Days shown on the dashboard by default.
+DASHBOARD_DAYS = 30
+
+
+def summarize_rollups(rollups):
+    """
+    Total up DailyRollups for the dashboard, returning a tuple of:
+    
+    1. A list of dicts of the totals for each day, most recent first, with
+       the counts by current status in the order of CURRENT_STATUS_CHOICES.
+    2. A dict of the same totals for all the days.
+    3. A list of (return code, description, count, amount) tuples.
+    
+    """
+    statuses = [code for code, label in CURRENT_STATUS_CHOICES]
+    def empty(day=None):
+        return {'day': day, 'count': 0, 'amount': 0, 'approved_count': 0,
+                'approved_amount': 0,
+                'statuses': dict((status, 0) for status in statuses)}
+    days = {}
+    overall = empty()
+    return_codes = {}
+    for rollup in rollups:
+        if rollup.day not in days:
+            days[rollup.day] = empty(rollup.day)
+        for totals in (days[rollup.day], overall):
+            totals['count'] += rollup.count
+            totals['amount'] += rollup.amount
+            if rollup.approved == '1':
+                totals['approved_count'] += rollup.count
+                totals['approved_amount'] += rollup.amount
+            totals['statuses'][rollup.current_status] += rollup.count
+        count, amount = return_codes.get(rollup.return_code, (0, 0))
+        return_codes[rollup.return_code] = (count + rollup.count,
+                                            amount + rollup.amount)
+    for totals in days.values() + [overall]:
+        totals['statuses'] = [totals['statuses'][status]
+                              for status in statuses]
+    descriptions = dict(RETURN_CODE_CHOICES)
+    return ([days[day] for day in sorted(days, reverse=True)], overall,
+            [(code, descriptions.get(code, ''), count, amount)
+             for code, (count, amount) in sorted(return_codes.items(),
+                                                 reverse=True)])
 
 """
 #--------------------------------------------
@@ -38,9 +91,9 @@ class IsApprovedListFilter(SimpleListFilter):
 class TransactionAdmin(admin.ModelAdmin):
     """Admin model for the Transaction model."""
     actions = ['delete_transactions', 'refund_transactions',
-               'settle_transactions', 'update_transactions']
+               'settle_transactions', 'update_transactions', 'export_as_csv']
     search_fields = ('transaction_id', 'amount', 'order_number', 'auth_code',
-                     'auth_response_code')
+                     'auth_response_code', 'batch_number')
     date_hierarchy = 'creation_date'
     list_display = ('transaction_id',
                     'order_number',
@@ -54,8 +107,8 @@ class TransactionAdmin(admin.ModelAdmin):
                     'mod_date',
                     'is_live',
                     'return_code')
-    list_filter = ('is_live', 'approved', 'creation_date', 'current_status',
-                   'pending_status')
+    list_filter = ('is_live', 'merchant', 'approved', 'creation_date',
+                   'current_status', 'pending_status')
     readonly_fields = ('transaction_id',
                        'auth_code', 
                        'amount', 
@@ -70,16 +123,18 @@ class TransactionAdmin(admin.ModelAdmin):
                        'return_code',
                        'cavv_response',
                        'is_live',
+                       'merchant',
                        'creation_date',
                        'mod_date',
                        'status_text',
                        'status_date',
+                       'batch_number',
                        'current_status',
                        'pending_status')
     fieldsets = (
         (None, {
             'fields': (('transaction_id', 'return_code', 'is_live'),
-                       'creation_date', 'amount')
+                       'merchant', 'creation_date', 'amount')
         }),
         (_('Authorization'), {
             'classes': ('collapse', 'collapse-closed', 'wide',),
@@ -98,7 +153,8 @@ class TransactionAdmin(admin.ModelAdmin):
         (_('Status'), {
             'classes': ('collapse', 'collapse-closed', 'wide',),
             'fields' : (('status_text', 'status_date'),
-                        ('current_status', 'pending_status'))
+                        ('current_status', 'pending_status'),
+                        'batch_number')
         }),
     )
     
@@ -112,6 +168,80 @@ class TransactionAdmin(admin.ModelAdmin):
     is_approved.short_description = u'Approved?' 
     is_approved.boolean = True
     
+    def queryset(self, request):
+        """
+        Counts and date hierarchy dates may be cached or estimated, see
+        settings.SKIPJACK_ADMIN_COUNTS.
+        
+        """
+        queryset = super(TransactionAdmin, self).queryset(request)
+        return queryset._clone(klass=CountingQuerySet)
+    
+    def get_urls(self):
+        """Add the dashboard view."""
+        opts = self.model._meta
+        urls = patterns('',
+            url(r'^dashboard/$',
+                self.admin_site.admin_view(self.dashboard_view),
+                name='%s_%s_dashboard' % (opts.app_label,
+                                          opts.object_name.lower())),
+        )
+        return urls + super(TransactionAdmin, self).get_urls()
+    
+    def dashboard_view(self, request):
+        """
+        Show the daily totals of transactions by status, approval and
+        return code.
+        
+        Reads only the DailyRollups (see settings.SKIPJACK_ROLLUPS), so it
+        takes the same time however many transactions there are. Takes
+        `days` (default 30) and `is_live` (0 or 1) GET parameters.
+        
+        """
+        opts = self.model._meta
+        app_label = opts.app_label
+        
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        
+        try:
+            days = max(1, int(request.GET.get('days', DASHBOARD_DAYS)))
+        except ValueError:
+            days = DASHBOARD_DAYS
+        since = datetime.date.today() - datetime.timedelta(days=days - 1)
+        rollups = DailyRollup.objects.filter(day__gte=since)
+        is_live = request.GET.get('is_live')
+        if is_live in ('0', '1'):
+            rollups = rollups.filter(is_live=is_live == '1')
+        daily, overall, return_codes = summarize_rollups(rollups)
+        
+        context = {
+            "title": _("Transactions dashboard"),
+            "days": days,
+            "is_live": is_live,
+            "daily": daily,
+            "overall": overall,
+            "return_codes": return_codes,
+            "statuses": [label for code, label in CURRENT_STATUS_CHOICES],
+            "opts": opts,
+            "app_label": app_label,
+        }
+        
+        if "grappelli" in settings.INSTALLED_APPS:
+            template_list = [
+                "admin/%s/%s/dashboard.grp.html" % (
+                                    app_label, opts.object_name.lower()),
+                "admin/%s/dashboard.grp.html" % app_label,
+                "admin/dashboard.grp.html"]
+        else:
+            template_list = [
+                "admin/%s/%s/dashboard.html" % (
+                                    app_label, opts.object_name.lower()),
+                "admin/%s/dashboard.html" % app_label,
+                "admin/dashboard.html"]
+        return TemplateResponse(request, template_list, context,
+                                current_app=self.admin_site.name)
+    
     def get_actions(self, request):
         """Don't use the generic delete_selected action."""
         actions = super(TransactionAdmin, self).get_actions(request)
@@ -152,8 +282,8 @@ class TransactionAdmin(admin.ModelAdmin):
             for obj in queryset:
                 obj_display = force_unicode(obj)
                 self.log_deletion(request, obj, obj_display)
-                # NB: obj.delete() calls obj.delete_transaction()
-                # which deletes the Transaction from Skipjack if possible.
+                # NB: obj.delete() queues the Transaction to be deleted from
+                # Skipjack (if possible) by the process_skipjack_queue command.
                 try:
                     obj.delete()
                     rows_updated += 1
@@ -331,5 +461,74 @@ class TransactionAdmin(admin.ModelAdmin):
                 message_bit = "%s transactions were" % rows_updated
             messages.success(request, "%s successfully updated." % message_bit)
     update_transactions.short_description = "Update status of selected transactions"
+    
+    def export_as_csv(self, request, queryset):
+        """
+        Download the selected transactions as CSV.
+        
+        The response is streamed a chunk of rows at a time, so select all to
+        export every transaction matching the current filters, however
+        many there are. (Middleware that reads the whole response, such as
+        GZipMiddleware, will undo that.)
+        
+        """
+        response = HttpResponse(export_csv(queryset), mimetype='text/csv')
+        response['Content-Disposition'] = \
+                                    'attachment; filename=transactions.csv'
+        return response
+    export_as_csv.short_description = "Export selected transactions as CSV"
 
 admin.site.register(Transaction, TransactionAdmin)
+
+
+class ArchivedTransactionAdmin(TransactionAdmin):
+    """
+    Read only admin model for the ArchivedTransaction model, otherwise
+    displayed the same as a Transaction.
+    
+    """
+    actions = ['export_as_csv']
+    fieldsets = TransactionAdmin.fieldsets + (
+        (_('Archive'), {
+            'fields' : ('archived_date',)
+        }),
+    )
+    
+    def queryset(self, request):
+        return admin.ModelAdmin.queryset(self, request)
+    
+    def get_urls(self):
+        return admin.ModelAdmin.get_urls(self)
+    
+    def get_readonly_fields(self, request, obj=None):
+        return [field.name for field in self.model._meta.fields]
+    
+    def has_add_permission(self, request):
+        return False
+    
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+admin.site.register(ArchivedTransaction, ArchivedTransactionAdmin)
+
+
+class QueuedStatusChangeAdmin(admin.ModelAdmin):
+    """Admin model for the QueuedStatusChange model."""
+    search_fields = ('transaction_id', 'order_number')
+    list_display = ('transaction_id',
+                    'order_number',
+                    'desired_status',
+                    'amount',
+                    'state',
+                    'attempts',
+                    'next_attempt',
+                    'status',
+                    'message',
+                    'creation_date')
+    list_filter = ('state', 'desired_status')
+    readonly_fields = ('key', 'payment', 'transaction_id', 'order_number',
+                       'auth_code', 'is_approved', 'desired_status', 'amount',
+                       'force_settlement', 'attempts', 'status', 'message',
+                       'creation_date', 'mod_date')
+
+admin.site.register(QueuedStatusChange, QueuedStatusChangeAdmin)
@@ -0,0 +1,132 @@
+"""
+Archiving of Transactions in a final state: settled, credited, archived,
+deleted or denied, with nothing pending. These are never checked with
+Skipjack again, so they're moved to the ArchivedTransaction table to keep
+the Transaction table, which checkout inserts into and the sync command and
+admin scan, small. See the archive_skipjack_transactions management command.
+
+Optional settings:
+    SKIPJACK_ARCHIVE_AFTER - days after creation that a Transaction in a
+        final state is archived (default 90).
+
+"""
+import datetime
+from itertools import chain
+
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from skipjack import counts
+from skipjack.models import Transaction, ArchivedTransaction, \
+                            QueuedStatusChange, SETTLED, CREDITED, \
+                            ARCHIVED, DELETED, DENIED
+
+
+DEFAULT_ARCHIVE_AFTER = 90
+DEFAULT_BATCH_SIZE = 500
+
+FINAL_STATUSES = (SETTLED, CREDITED, ARCHIVED, DELETED, DENIED)
+
+
+def archive_cutoff(days=None):
+    """Transactions created before this are old enough to archive."""
+    if days is None:
+        days = getattr(settings, 'SKIPJACK_ARCHIVE_AFTER',
+                       DEFAULT_ARCHIVE_AFTER)
+    return datetime.datetime.now() - datetime.timedelta(days=days)
+
+
+def archivable(days=None, cutoff=None):
+    """The Transactions to archive: final, and older than `days` days."""
+    return Transaction.objects.filter(current_status__in=FINAL_STATUSES,
+                                      pending_status=0,
+                                      creation_date__lt=cutoff or
+                                                        archive_cutoff(days))
+
+
+def archive_batch(first_pk, last_pk, cutoff):
+    """
+    Moves the archivable Transactions with pks from first_pk to last_pk
+    created before cutoff to the archive in one database transaction, with
+    an INSERT ... SELECT and a DELETE, returning the number moved. Any that
+    are no longer in a final state (e.g. have since been refunded) are left
+    alone.
+
+    The rows are selected by pk range rather than binding every pk, which
+    would run into the database's limit on parameters (999 on SQLite).
+
+    They're deleted without the delete signals, so nothing is queued to be
+    deleted from Skipjack and the DailyRollups still count them.
+
+    """
+    using = router.db_for_write(Transaction)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    opts = Transaction._meta
+    columns = ', '.join([qn(field.column) for field in opts.local_fields])
+    where = '%s BETWEEN %%s AND %%s AND %s < %%s AND %s IN (%s) ' \
+            'AND %s = 0' % (
+                qn(opts.pk.column),
+                qn(opts.get_field('creation_date').column),
+                qn(opts.get_field('current_status').column),
+                ', '.join([str(status) for status in FINAL_STATUSES]),
+                qn(opts.get_field('pending_status').column))
+    params = [first_pk, last_pk, cutoff]
+    # Nothing refers to an ArchivedTransaction.
+    QueuedStatusChange.objects.using(using).filter(
+            payment__in=archivable(cutoff=cutoff).filter(
+                pk__gte=first_pk, pk__lte=last_pk).values('pk')
+            ).update(payment=None)
+    cursor = connection.cursor()
+    cursor.execute('INSERT INTO %s (%s, %s) SELECT %s, %%s FROM %s '
+                   'WHERE %s' % (qn(ArchivedTransaction._meta.db_table),
+                                 columns, qn('archived_date'), columns,
+                                 qn(opts.db_table), where),
+                   [datetime.datetime.now()] + params)
+    cursor.execute('DELETE FROM %s WHERE %s' % (qn(opts.db_table), where),
+                   params)
+    # Raw SQL doesn't mark the transaction as needing a commit.
+    transaction.set_dirty(using=using)
+    return cursor.rowcount
+archive_batch = transaction.commit_on_success(archive_batch)
+
+
+def archive(days=None, batch_size=DEFAULT_BATCH_SIZE, limit=None):
+    """
+    Archives the archivable() Transactions `batch_size` at a time (each
+    batch in its own database transaction), up to `limit` of them.
+    Returns the number archived.
+
+    """
+    cutoff = archive_cutoff(days)
+    queryset = archivable(cutoff=cutoff).order_by('pk').values_list(
+                                                            'pk', flat=True)
+    archived = 0
+    last_pk = None
+    while limit is None or archived < limit:
+        size = batch_size
+        if limit is not None:
+            size = min(size, limit - archived)
+        if last_pk is not None:
+            batch = queryset.filter(pk__gt=last_pk)
+        else:
+            batch = queryset
+        pks = list(batch[:size])
+        if not pks:
+            break
+        last_pk = pks[-1]
+        archived += archive_batch(pks[0], last_pk, cutoff)
+    if archived:
+        counts.invalidate()
+    return archived
+
+
+def history(**filters):
+    """
+    Returns a list of the Transactions and ArchivedTransactions matching the
+    filters (e.g. order_number='12345'), most recent first.
+
+    """
+    return sorted(chain(Transaction.objects.filter(**filters),
+                        ArchivedTransaction.objects.filter(**filters)),
+                  key=lambda payment: payment.creation_date, reverse=True)
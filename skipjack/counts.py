@@ -0,0 +1,146 @@
+"""
+Cheap counts for the Transaction admin changelist.
+
+On a large table the changelist's COUNT(*) queries and the date hierarchy's
+date queries take most of the time the page takes. CountingQuerySet caches
+their results for a short while, and optionally estimates the count of the
+whole table from the database's statistics instead of counting it.
+
+Optional settings:
+    SKIPJACK_ADMIN_COUNTS - 'exact' (the default) counts as usual, 'cached'
+        caches counts and date hierarchy dates, and 'estimated' also
+        estimates the unfiltered count, on PostgreSQL and MySQL.
+    SKIPJACK_ADMIN_COUNT_TIMEOUT - seconds to cache them for (default 60).
+    SKIPJACK_ADMIN_COUNT_CACHE - the name of the cache (in CACHES) to use
+        (default 'default').
+
+The cached values are also discarded whenever a Transaction is created or
+deleted, so new Transactions show up straight away.
+
+"""
+from hashlib import md5
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+
+
+DEFAULT_TIMEOUT = 60
+
+GENERATION_KEY = 'skipjack-admin-counts:generation'
+
+# 30 days, the longest timeout memcached takes as a duration. (None would be
+# the cache's default timeout, 300 seconds.)
+GENERATION_TIMEOUT = 30 * 24 * 60 * 60
+
+
+def mode():
+    """The configured SKIPJACK_ADMIN_COUNTS."""
+    return getattr(settings, 'SKIPJACK_ADMIN_COUNTS', 'exact')
+
+
+def get_cache():
+    from django.core.cache import get_cache
+    return get_cache(getattr(settings, 'SKIPJACK_ADMIN_COUNT_CACHE',
+                             'default'))
+
+
+def generation(cache):
+    """
+    The current generation of the cached values. A new one starts from the
+    time, so that if the generation is evicted or expires it can't go back
+    to one whose values are still cached.
+
+    """
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        start = int(time.time())
+        cache.add(GENERATION_KEY, start, GENERATION_TIMEOUT)
+        value = cache.get(GENERATION_KEY) or start
+    return value
+
+
+def invalidate():
+    """Discards the cached counts and dates (if they're in use)."""
+    if mode() == 'exact':
+        return
+    cache = get_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # Not set yet, so nothing is cached.
+        pass
+
+
+def estimated_count(model, using):
+    """
+    Returns the database's estimate of the number of rows in the model's
+    table, or None if the database doesn't keep one.
+
+    """
+    connection = connections[using]
+    engine = connection.settings_dict['ENGINE']
+    cursor = connection.cursor()
+    if 'postgresql' in engine:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                       [model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[0] > 0:
+            return int(row[0])
+    elif 'mysql' in engine:
+        cursor.execute('SHOW TABLE STATUS LIKE %s', [model._meta.db_table])
+        row = cursor.fetchone()
+        if row and row[4]:
+            return int(row[4])
+    return None
+
+
+class CountingQuerySet(QuerySet):
+    """
+    A QuerySet whose count() and dates() results are cached, as configured
+    by SKIPJACK_ADMIN_COUNTS.
+
+    """
+    def cache_key(self, kind, *args):
+        """A key for the query's results, or None if it can't have any."""
+        try:
+            sql, params = self.query.get_compiler(self.db).as_sql()
+        except EmptyResultSet:
+            return None
+        key = md5(repr((sql, params, args))).hexdigest()
+        return 'skipjack-admin-counts:%s:%s:%s' % (
+                                    kind, generation(self.cache), key)
+
+    @property
+    def cache(self):
+        return get_cache()
+
+    def cached(self, kind, args, func):
+        key = self.cache_key(kind, *args)
+        if key is None:
+            return func()
+        value = self.cache.get(key)
+        if value is None:
+            value = func()
+            self.cache.set(key, value, getattr(
+                settings, 'SKIPJACK_ADMIN_COUNT_TIMEOUT', DEFAULT_TIMEOUT))
+        return value
+
+    def count(self):
+        counts = mode()
+        if counts == 'exact' or self._result_cache is not None:
+            return super(CountingQuerySet, self).count()
+        if counts == 'estimated' and not self.query.where and \
+                                    not self.query.extra:
+            estimate = estimated_count(self.model, self.db)
+            if estimate is not None:
+                return estimate
+        return self.cached('count', (), super(CountingQuerySet, self).count)
+
+    def dates(self, field_name, kind, order='ASC'):
+        if mode() == 'exact':
+            return super(CountingQuerySet, self).dates(field_name, kind, order)
+        return self.cached('dates', (field_name, kind, order), lambda: list(
+            super(CountingQuerySet, self).dates(field_name, kind, order)))
@@ -1,29 +1,191 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-""" Credit card helpers - provides validation for credit cards."""
+"""
+Credit card helpers - provides validation for credit cards.
+
+Card types are looked up by the leading digits of the number in a table of
+issuer identification number (IIN) ranges, read from a CSV file (see
+skipjack/data/iin_ranges.csv for the format) the first time it's needed.
+
+Optional settings:
+    SKIPJACK_IIN_RANGES - the path of the IIN range file to use instead of
+        the one included, e.g. to add card types without a new release.
+
+"""
 # from http://github.com/johnboxall/django-paypal
+from bisect import bisect_right
+import csv
+import os
 import re
-from string import digits
+from string import digits, maketrans
 
 # Adapted from:
 # http://www.djangosnippets.org/snippets/764/
 # http://www.satchmoproject.com/
 # http://tinyurl.com/shoppify-credit-cards
 
-# Well known card regular expressions.
+# Well known card regular expressions. No longer used to find the card type,
+# which comes from the IIN ranges.
 CARDS = {
-    'Visa': re.compile(r"^4\d{12}(\d{3})?$"),
-    'Mastercard': re.compile(r"(5[1-5]\d{4}|677189)\d{10}$"),
-    'Dinersclub': re.compile(r"^3(0[0-5]|[68]\d)\d{11}"),
+    'Visa': re.compile(r"^4\d{12}(?:\d{3})?$"),
+    'Mastercard': re.compile(r"(?:5[1-5]\d{4}|677189)\d{10}$"),
+    'Dinersclub': re.compile(r"^3(?:0[0-5]|[68]\d)\d{11}"),
     'Amex': re.compile("^3[47]\d{13}$"),
-    'Discover': re.compile("^(6011|65\d{2})\d{12}$"),
+    'Discover': re.compile("^(?:6011|65\d{2})\d{12}$"),
 }
 
+DEFAULT_IIN_RANGES = os.path.join(os.path.dirname(__file__), 'data',
+                                  'iin_ranges.csv')
+
+# Card number prefixes are compared this many digits long.
+IIN_DIGITS = 8
+
 # Well known test numbers
 TEST_NUMBERS = ('378282246310005', '371449635398431', '378734493671000',
                 '30569309025904', '38520000023237', '6011111111111117',
                 '6011000990139424', '555555555554444', '5105105105105100',
                 '4111111111111111', '4012888888881881', '4222222222222')
+TEST_NUMBER_SET = frozenset(TEST_NUMBERS)
+
+# Reasons verify_credit_cards() gives for a number being invalid.
+NOT_A_NUMBER = 'not a number'
+TEST_NUMBER = 'test number'
+FAILED_MOD10 = 'failed mod10'
+UNKNOWN_TYPE = 'unknown type'
+
+# Every byte that isn't a digit, to strip them with str.translate().
+NON_DIGITS = ''.join([chr(i) for i in range(256) if chr(i) not in digits])
+IDENTITY = maketrans('', '')
+NON_DIGITS_RE = re.compile('[^0-9]')
+
+# The value a digit adds to the mod10 sum, as is and when doubled.
+DIGIT_VALUES = dict((c, int(c)) for c in digits)
+DOUBLED_VALUES = dict((c, sum(divmod(2 * int(c), 10))) for c in digits)
+
+
+def only_digits(number):
+    """The number with anything but the digits 0-9 removed."""
+    if isinstance(number, str):
+        return number.translate(IDENTITY, NON_DIGITS)
+    return NON_DIGITS_RE.sub('', number)
+
+
+def is_mod10(number):
+    """Returns True if the string of digits is valid according to mod10."""
+    # Every second digit from the right is doubled.
+    total = sum(map(DIGIT_VALUES.__getitem__, number[-1::-2])) + \
+            sum(map(DOUBLED_VALUES.__getitem__, number[-2::-2]))
+    return total % 10 == 0
+
+
+def parse_lengths(text):
+    """The set of lengths in e.g. '13 16 19' or '16-19'."""
+    lengths = set()
+    for part in text.split():
+        first, _, last = part.partition('-')
+        lengths.update(range(int(first), int(last or first) + 1))
+    return frozenset(lengths)
+
+
+class IINTable(object):
+    """
+    A sorted table of IIN ranges, searched by bisection, so finding a card
+    number's type takes O(log n) time however many ranges there are.
+    
+    ranges is a list of (first prefix, last prefix, card type, lengths)
+    tuples. Where they overlap, the narrowest range applies.
+    
+    """
+    def __init__(self, ranges):
+        bounds = []
+        for first, last, card, lengths in ranges:
+            low = int(first.ljust(IIN_DIGITS, '0'))
+            high = int(last.ljust(IIN_DIGITS, '9'))
+            bounds.append((low, high, card, lengths))
+        # Split the ranges into consecutive, non-overlapping segments, each
+        # of which belongs to the narrowest range covering it.
+        points = sorted(set([low for low, high, card, lengths in bounds] +
+                            [high + 1 for low, high, card, lengths in bounds]))
+        self.lows = []
+        self.highs = []
+        self.cards = []
+        self.lengths = []
+        previous = None
+        for start, end in zip(points, points[1:]):
+            covering = [bound for bound in bounds
+                        if bound[0] <= start and end - 1 <= bound[1]]
+            if not covering:
+                previous = None
+                continue
+            narrowest = min(covering, key=lambda bound: bound[1] - bound[0])
+            if narrowest is previous:
+                self.highs[-1] = '%0*d' % (IIN_DIGITS, end - 1)
+                continue
+            self.lows.append('%0*d' % (IIN_DIGITS, start))
+            self.highs.append('%0*d' % (IIN_DIGITS, end - 1))
+            self.cards.append(narrowest[2])
+            self.lengths.append(narrowest[3])
+            previous = narrowest
+    
+    def __len__(self):
+        return len(self.lows)
+    
+    @classmethod
+    def load(cls, path):
+        """Read the table from a CSV file of IIN ranges."""
+        ranges = []
+        data = open(path, 'rb')
+        try:
+            for row in csv.reader(data):
+                if not row or row[0].startswith('#'):
+                    continue
+                first, last, card, lengths = [value.strip() for value in row]
+                ranges.append((first, last, card, parse_lengths(lengths)))
+        finally:
+            data.close()
+        return cls(ranges)
+    
+    def lookup(self, number):
+        """
+        The card type of a string of digits, or None if it isn't in any
+        range, or isn't a valid length for its range.
+        
+        """
+        prefix = number[:IIN_DIGITS].ljust(IIN_DIGITS, '0')
+        i = bisect_right(self.lows, prefix) - 1
+        if i < 0 or prefix > self.highs[i] or \
+                len(number) not in self.lengths[i]:
+            return None
+        return self.cards[i]
+
+
+_iin_table = None
+
+
+def load_iin_table(path=None):
+    """
+    (Re)loads the IIN ranges from the file at path, by default
+    settings.SKIPJACK_IIN_RANGES or the one included, returning the table.
+    
+    """
+    global _iin_table
+    if path is None:
+        from django.conf import settings
+        path = getattr(settings, 'SKIPJACK_IIN_RANGES', DEFAULT_IIN_RANGES)
+    _iin_table = IINTable.load(path)
+    return _iin_table
+
+
+def get_iin_table():
+    """The IIN table, loaded on first use."""
+    if _iin_table is None:
+        return load_iin_table()
+    return _iin_table
+
+
+def card_type(number):
+    """The type of a string of digits, or None if not a well known card."""
+    return get_iin_table().lookup(number)
 
 
 def verify_credit_card(number, allow_test=False):
@@ -31,6 +193,37 @@ def verify_credit_card(number, allow_test=False):
     return CreditCard(number).verify(allow_test)
 
 
+def verify_credit_cards(numbers, allow_test=False):
+    """
+    Bulk version of verify_credit_card(), for checking many numbers at once,
+    such as a card on file import.
+    
+    Yields a (card type, reason) tuple for each of the numbers, in order,
+    where reason is None for a valid number, and otherwise one of
+    NOT_A_NUMBER, TEST_NUMBER, FAILED_MOD10 or UNKNOWN_TYPE (with a card
+    type of None).
+    
+    """
+    lookup = get_iin_table().lookup
+    for number in numbers:
+        if not isinstance(number, basestring):
+            yield None, NOT_A_NUMBER
+            continue
+        number = only_digits(number)
+        if not number:
+            yield None, NOT_A_NUMBER
+        elif not allow_test and number in TEST_NUMBER_SET:
+            yield None, TEST_NUMBER
+        elif not is_mod10(number):
+            yield None, FAILED_MOD10
+        else:
+            card = lookup(number)
+            if card is None:
+                yield None, UNKNOWN_TYPE
+            else:
+                yield card, None
+
+
 class CreditCard(object):
     """
     An object to represent a Credit Card.
@@ -44,30 +237,21 @@ class CreditCard(object):
     def is_number(self):
         """Returns True if there is at least one digit in number."""
         if isinstance(self.number, basestring):
-            self.number = "".join([c for c in self.number if c in digits])
+            self.number = only_digits(self.number)
             return self.number.isdigit()
         return False
 
     def is_mod10(self):
         """Returns True if number is valid according to mod10."""
-        double = 0
-        total = 0
-        for i in range(len(self.number) - 1, -1, -1):
-            for c in str((double + 1) * int(self.number[i])):
-                total = total + int(c)
-            double = (double + 1) % 2
-        return (total % 10) == 0
+        return is_mod10(self.number)
 
     def is_test(self):
         """Returns True if number is a test card number."""
-        return self.number in TEST_NUMBERS
+        return self.number in TEST_NUMBER_SET
 
     def get_type(self):
         """Return the type if it matches one of the cards."""
-        for card, pattern in CARDS.iteritems():
-            if pattern.match(self.number):
-                return card
-        return None
+        return card_type(self.number)
 
     def verify(self, allow_test):
         """Returns the card type if valid else None."""
@@ -0,0 +1,81 @@
+"""
+CSV export of Transactions, in constant memory however many there are.
+
+Rows are fetched a chunk at a time, by primary key, and only the exported
+columns are selected. See the export_as_csv admin action and the
+export_skipjack_transactions management command.
+
+"""
+import csv
+from cStringIO import StringIO
+from decimal import Decimal
+
+from django.db import models
+from django.utils.encoding import smart_str
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+EXPORT_FIELDS = ('transaction_id', 'order_number', 'auth_code', 'amount',
+                 'approved', 'return_code', 'current_status',
+                 'pending_status', 'status_text', 'status_date',
+                 'creation_date', 'is_live', 'merchant', 'batch_number')
+
+
+def chunked_values(queryset, fields, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields lists of tuples of the fields' values for the queryset, up to
+    chunk_size at a time, in primary key order.
+
+    Each chunk is a separate query continuing from the last primary key
+    seen, rather than an OFFSET or one huge result set.
+
+    """
+    queryset = queryset.order_by('pk').values_list('pk', *fields)
+    last_pk = None
+    while True:
+        if last_pk is None:
+            chunk = list(queryset[:chunk_size])
+        else:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return
+        last_pk = chunk[-1][0]
+        yield [row[1:] for row in chunk]
+
+
+def formatter(field):
+    """
+    Returns the function formatting the field's values for the CSV.
+    Decimals always have the field's decimal places, whatever the database
+    returns.
+
+    """
+    if isinstance(field, models.DecimalField):
+        exponent = Decimal(10) ** -field.decimal_places
+        return lambda value: str(Decimal(value).quantize(exponent))
+    return smart_str
+
+
+def export_csv(queryset, fields=EXPORT_FIELDS,
+               chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yields the queryset as CSV (UTF-8) a chunk of rows at a time, starting
+    with a header of the field names.
+
+    """
+    formatters = [formatter(queryset.model._meta.get_field(field))
+                  for field in fields]
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for chunk in chunked_values(queryset, fields, chunk_size):
+        for row in chunk:
+            writer.writerow(['' if value is None else format(value)
+                             for format, value in zip(formatters, row)])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # No rows, just the header.
+        yield buffer.getvalue()
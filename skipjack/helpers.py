@@ -1,13 +1,9 @@
 """Helpers for performing operations directly with Skipjack."""
-import csv
-import datetime
-from decimal import Decimal
-import re
 import urllib
-import urllib2
 
 from django.conf import settings
 
+from skipjack import transport
 from skipjack import SKIPJACK_POST_URL, SKIPJACK_TEST_POST_URL, \
                      SKIPJACK_TEST_STATUS_POST_URL, SKIPJACK_STATUS_POST_URL, \
                      SKIPJACK_TEST_STATUS_CHANGE_POST_URL, \
@@ -16,13 +12,24 @@ from skipjack import SKIPJACK_POST_URL, SKIPJACK_TEST_POST_URL, \
                      SKIPJACK_CLOSE_OPEN_BATCH_POST_URL, \
                      SKIPJACK_TEST_REPORT_DOWNLOAD_URL, \
                      SKIPJACK_REPORT_DOWNLOAD_URL
-from skipjack.models import CURRENT_STATUS_CHOICES, PENDING_STATUS_CHOICES
+from skipjack.models import TransactionError
+from skipjack.parsers import parse_authorize, parse_status, \
+                             parse_change_status, parse_close_batch, \
+                             parse_report_data, report_data_chunks
+
+
+# The Customized Report API request fields for the page size and number.
+REPORT_PAGE_SIZE_FIELD = 'sRecsPerPage'
+REPORT_PAGE_FIELD = 'sPageNumber'
 
 
 class PaymentHelper(object):
     """Helper for sending payment data and receiving data from Skipjack."""
-    def __init__(self, defaults):
+    name = 'authorize'
+    
+    def __init__(self, defaults, merchant=None):
         self.defaults = defaults
+        self.merchant = merchant
         if settings.SKIPJACK_DEBUG:
             self.endpoint = SKIPJACK_TEST_POST_URL
         else:
@@ -38,17 +45,15 @@ class PaymentHelper(object):
         
         """
         if type(data) is dict:
-            data = d.items()
+            data = data.items()
         elif type(data) is tuple:
             data = list(data)
         final_data = self.defaults + data  # These must be lists, not dicts.
         request_string = urllib.urlencode(final_data)
-        response = urllib2.urlopen(self.endpoint, data=request_string).read()
-        response_dict = dict(zip(*[row for row in csv.reader(
-                                                           response.split("\n"),
-                                                           delimiter=',',
-                                                           quotechar='"')]))
-        return response_dict
+        response = transport.post(self.endpoint, request_string,
+                                  endpoint=self.name,
+                                  merchant=self.merchant)
+        return parse_authorize(response)
 
 
 class StatusHelper(object):
@@ -67,60 +72,49 @@ class StatusHelper(object):
     
     
     """
-    def __init__(self, defaults):
+    name = 'status'
+    
+    def __init__(self, defaults, merchant=None):
         self.defaults = defaults
+        self.merchant = merchant
         if settings.SKIPJACK_DEBUG:
             self.endpoint = SKIPJACK_TEST_STATUS_POST_URL
         else:
             self.endpoint = SKIPJACK_STATUS_POST_URL
     
     def get_response(self, order_number, transaction_id=None):
-        """Gets the response from Skipjack from the supplied data."""
+        """
+        Gets the response from Skipjack from the supplied data.
+        
+        Returns a Status object, or None if Skipjack has no transactions for
+        the given order_number.
+        
+        """
         final_data = self.defaults + [('szOrderNumber', order_number)]
         request_string = urllib.urlencode(final_data)
-        response = urllib2.urlopen(self.endpoint, data=request_string).read()
+        response = transport.post(self.endpoint, request_string,
+                                  endpoint=self.name,
+                                  merchant=self.merchant)
         # First line of the response is the header, lines that follow are
         # individual transactions relating to the given order_number.
-        response = [row for row in csv.reader(response.strip().split('\n'),
-                                              delimiter=',', quotechar='"')][1:]
-        response_dict = None
+        return self.select(parse_status(response), transaction_id)
+    
+    @staticmethod
+    def select(history, transaction_id=None):
+        """
+        Returns the Status for transaction_id from the order's history, or
+        the latest Status if transaction_id isn't given or present.
+        
+        """
         if transaction_id:
-            for row in response:
-                if len(row) is 9 and row[6] == transaction_id:
-                    response_dict = {'amount': row[1],
-                                     'code': row[2],
-                                     'message': row[3],
-                                     'order_number': row[4],
-                                     'date': row[5],
-                                     'transaction_id': row[6],
-                                     'approval_code': row[8],
-                                     'batch_number': row[8]}
-                    break
-        if not response_dict:
-            # Transaction id either not specified, or no longer present,
-            # return the latest Transaction from Skipjack...
-            row = response[-1]
-            if len(row) is 9:
-                response_dict = {'amount': row[1],
-                                 'code': row[2],
-                                 'message': row[3],
-                                 'order_number': row[4],
-                                 'date': row[5],
-                                 'transaction_id': row[6],
-                                 'approval_code': row[7],
-                                 'batch_number': row[8]}
-        # Add the Status Code interpretation directly for more detail than the
-        # status_message return value gives us.
-        if response_dict:
-            status = []
-            if response_dict['code'][0] != '0':
-                status.append(
-                    dict(CURRENT_STATUS_CHOICES)[int(response_dict['code'][0])])
-            if response_dict['code'][1] != '0':
-                status.append(
-                    dict(PENDING_STATUS_CHOICES)[int(response_dict['code'][1])])
-            response_dict['message_detail'] = ', '.join(status)
-        return response_dict
+            for status in history:
+                if status.transaction_id == transaction_id:
+                    return status
+        # Transaction id either not specified, or no longer present,
+        # return the latest Transaction from Skipjack...
+        if history:
+            return history[-1]
+        return None
 
 
 class StatusHistoryHelper(object):
@@ -133,12 +127,16 @@ class StatusHistoryHelper(object):
     
     This helper differs from the StatusHelper in that it returns the entire
     history of the given order_number along with Transaction Ids, amounts,
-    and so forth.
+    and so forth, as a list of Status objects built directly from the
+    response rows.
     
     
     """
-    def __init__(self, defaults):
+    name = 'status'
+    
+    def __init__(self, defaults, merchant=None):
         self.defaults = defaults
+        self.merchant = merchant
         if settings.SKIPJACK_DEBUG:
             self.endpoint = SKIPJACK_TEST_STATUS_POST_URL
         else:
@@ -148,34 +146,12 @@ class StatusHistoryHelper(object):
         """Gets the response from Skipjack from the supplied data."""
         final_data = self.defaults + [('szOrderNumber', order_number)]
         request_string = urllib.urlencode(final_data)
-        response = urllib2.urlopen(self.endpoint, data=request_string).read()
+        response = transport.post(self.endpoint, request_string,
+                                  endpoint=self.name,
+                                  merchant=self.merchant)
         # First line of the response is the header, lines that follow are
         # individual transactions relating to the given order_number.
-        response = [row for row in csv.reader(response.strip().split('\n'),
-                                              delimiter=',', quotechar='"')][1:]
-        responses = []
-        for row in response:
-            if len(row) is 9:
-                response_dict = {'amount': row[1],
-                                 'code': row[2],
-                                 'message': row[3],
-                                 'order_number': row[4],
-                                 'date': row[5],
-                                 'transaction_id': row[6],
-                                 'approval_code': row[7],
-                                 'batch_number': row[8]}
-                # Add the Status Code interpretation directly for more detail than the
-                # status_message return value gives us.
-                status = []
-                if response_dict['code'][0] != '0':
-                    status.append(
-                        dict(CURRENT_STATUS_CHOICES)[int(response_dict['code'][0])])
-                if response_dict['code'][1] != '0':
-                    status.append(
-                        dict(PENDING_STATUS_CHOICES)[int(response_dict['code'][1])])
-                response_dict['message_detail'] = ', '.join(status)
-                responses.append(response_dict)
-        return responses
+        return parse_status(response)
 
 
 class ChangeStatusHelper(object):
@@ -189,8 +165,11 @@ class ChangeStatusHelper(object):
     Naturally transaction id will change when a transaction is settled. Ouch.
     
     """
-    def __init__(self, defaults):
+    name = 'change_status'
+    
+    def __init__(self, defaults, merchant=None):
         self.defaults = defaults
+        self.merchant = merchant
         if settings.SKIPJACK_DEBUG:
             self.endpoint = SKIPJACK_TEST_STATUS_CHANGE_POST_URL
         else:
@@ -200,21 +179,12 @@ class ChangeStatusHelper(object):
         """Gets the response from Skipjack from the supplied data."""
         final_data = self.defaults + data  # These must be lists, not dicts.
         request_string = urllib.urlencode(final_data)
-        response = urllib2.urlopen(self.endpoint, data=request_string).read()
+        response = transport.post(self.endpoint, request_string,
+                                  endpoint=self.name,
+                                  merchant=self.merchant)
         # First line of the response is the header, second line is the
         # main response detail OR a textual description of an error.
-        response = [row for row in csv.reader(response.strip().split('\n'),
-                                              delimiter=',', quotechar='"')][1:]
-        response_dict = None
-        row = response[-1]
-        if len(row) is 7:
-            response_dict = {'amount': row[1],
-                             'desired_status': row[2],
-                             'status': row[3],
-                             'message': row[4],
-                             'order_number': row[5],
-                             'transaction_id': row[6]}
-        return response_dict
+        return parse_change_status(response)
 
 
 class CloseBatchHelper(object):
@@ -223,8 +193,11 @@ class CloseBatchHelper(object):
     Skipjack.
     
     """
-    def __init__(self, defaults):
+    name = 'close_batch'
+    
+    def __init__(self, defaults, merchant=None):
         self.defaults = defaults
+        self.merchant = merchant
         if settings.SKIPJACK_DEBUG:
             self.endpoint = SKIPJACK_TEST_CLOSE_OPEN_BATCH_POST_URL
         else:
@@ -233,14 +206,10 @@ class CloseBatchHelper(object):
     def get_response(self):
         """Gets the response from Skipjack (no supplied data required)."""
         request_string = urllib.urlencode(self.defaults)
-        response = urllib2.urlopen(self.endpoint, data=request_string).read()
-        response = [row for row in csv.reader(response.strip().split('\n'),
-                                              delimiter=',', quotechar='"')]
-        response_dict = None
-        row = response[0]
-        if len(row) is 12:
-            response_dict = {'status': row[1]}
-        return response_dict
+        response = transport.post(self.endpoint, request_string,
+                                  endpoint=self.name,
+                                  merchant=self.merchant)
+        return parse_close_batch(response)
 
 
 class ReportHelper(object):
@@ -248,57 +217,78 @@ class ReportHelper(object):
     Helper for getting Report API data from Skipjack.
     
     """
-    def __init__(self, defaults):
+    name = 'report'
+    
+    def __init__(self, defaults, merchant=None):
         self.defaults = defaults
+        self.merchant = merchant
         if settings.SKIPJACK_DEBUG:
             self.endpoint = SKIPJACK_TEST_REPORT_DOWNLOAD_URL
         else:
             self.endpoint = SKIPJACK_REPORT_DOWNLOAD_URL
     
-    def get_response(self, data):
-        """Gets the response from Skipjack from the supplied data."""
+    def get_response(self, data, columnar=False):
+        """
+        Gets the response from Skipjack from the supplied data, as a list of
+        dicts or with columnar, a ReportColumns.
+        
+        """
+        return parse_report_data(self.get_all_data(data), columnar)
+    
+    def get_all_data(self, data):
+        """
+        As get_data(), but requesting page after page of the report until
+        one comes back short, and returning the CSV data of them all (with
+        just the first page's header).
+        
+        Raises TransactionError if a page repeats the one before, as if
+        Skipjack ignored the page number, rather than looping forever.
+        
+        """
+        page_size = dict(data).get(REPORT_PAGE_SIZE_FIELD)
+        if not page_size:
+            return self.get_data(data)
+        page_size = int(page_size)
+        pages = []
+        previous = None
+        number = 1
+        while True:
+            page = self.get_data(data + [(REPORT_PAGE_FIELD, number)])
+            # The header, then a line per row.
+            header, rows = (page.split('\n', 1) + [''])[:2]
+            if rows and rows == previous:
+                raise TransactionError('Skipjack repeated page %d of the '
+                                       'report.' % (number - 1))
+            if not pages:
+                pages.append(header)
+            if rows:
+                pages.append(rows)
+            if not rows or rows.count('\n') + 1 < page_size:
+                return '\n'.join(pages)
+            previous = rows
+            number += 1
+    
+    def get_data(self, data):
+        """
+        Gets just the CSV data of the report from Skipjack.
+        
+        Raises TransactionError if the response isn't a report (it's missing
+        the Begin/End Data markers, e.g. an error or login page), rather than
+        passing it off as a report of no transactions.
+        
+        The response is scanned for the data as it arrives, rather than
+        being read into memory whole.
+        
+        """
         final_data = self.defaults + data  # These must be lists, not dicts.
         request_string = urllib.urlencode(final_data)
-        response = urllib2.urlopen(
-            SKIPJACK_TEST_REPORT_DOWNLOAD_URL, data=request_string).read()
-        response_data = re.search(
-                r'<!--\sBegin\sData\s-->(?P<data>.*)<!--\sEnd\sData\s-->',
-                response, re.M|re.S).group('data').replace('<br>\r\n',
-                                                           '\n').strip()
-        response_csv = list(csv.reader(response_data.split("\n"),
-                                       delimiter=',', quotechar='"'))
-        response_list = []
-        headers = response_csv[0]
-        date_re = re.compile(r"""
-            (?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})\s
-            (?P<hour>\d{1,2}):(?P<minute>\d{1,2}):(?P<second>\d{1,2})\s
-            (?P<am_pm>AM|PM)""", re.VERBOSE)
-        for row in response_csv[1:]:
-            as_dict = dict(zip(*[item for item in (headers, row)]))
-            for key, val in as_dict.items():
-                if not key:
-                    del as_dict[key]
-                if key[-6:] == 'Amount':
-                    # Convert currencies to a decimal value.
-                    # Report API returns $123.45 and ($123.45) for these fields.
-                    if val[0] == '(':
-                        as_dict[key] = Decimal('-%s' % val[2:-1])
-                    else:
-                        as_dict[key] = Decimal(val[1:])
-                if key[-4:] == 'Date':
-                    # Convert to a Python datetime.datetime object.
-                    # NB: Could just be lazy and use the dateutil.parser module,
-                    # but I'd rather avoid introducing the dependency.
-                    match = date_re.match(val)
-                    hour = int(match.group('hour'))
-                    if match.group('am_pm') == 'PM' and hour != 12:
-                        hour += 12
-                    as_dict[key] = datetime.datetime(
-                                    year=int(match.group('year')),
-                                    month=int(match.group('month')),
-                                    day=int(match.group('day')),
-                                    hour=hour,
-                                    minute=int(match.group('minute')),
-                                    second=int(match.group('second')))
-            response_list.append(as_dict)
-        return response_list
\ No newline at end of file
+        chunks = transport.post_chunks(self.endpoint, request_string,
+                                       endpoint=self.name,
+                                       merchant=self.merchant)
+        data = report_data_chunks(chunks)
+        # Read the rest of the page, so that the connection can be reused.
+        for chunk in chunks:
+            pass
+        if data is None:
+            raise TransactionError('Skipjack did not return a report.')
+        return data
@@ -0,0 +1,202 @@
+"""
+Importing Customized Report API rows into Transactions: backfilling those
+created outside this site (through the virtual terminal, recurring billing,
+etc.) and bringing the status of the rest up to date. See the
+import_skipjack_reports management command.
+
+Report rows are matched to the merchant account's Transactions on their
+order number and approval code. Missing Transactions are inserted and
+changed ones updated in bulk, a chunk of rows (and a database transaction)
+at a time. No signals are sent, but the DailyRollups are kept up to date.
+Rows of transactions that have been archived (see skipjack.archive) are left
+alone, as they're in a final state, and so are rows whose status isn't one
+we know, rather than erasing the status we have.
+
+"""
+import time
+
+from django.conf import settings
+from django.db import transaction
+
+from skipjack.models import Transaction, ArchivedTransaction, DailyRollup, \
+                            CURRENT_STATUS_CHOICES, PENDING_STATUS_CHOICES, \
+                            AUTHORIZED, SETTLED, PENDING_CREDIT, \
+                            ROLLUP_FIELDS, rollups_enabled, \
+                            status_message_detail
+from skipjack.utils import transaction_reports, report_windows
+from skipjack.workers import imap_unordered
+
+
+DEFAULT_CHUNK_SIZE = 500
+
+CURRENT_STATUS_LABELS = dict((label.lower(), code)
+                             for code, label in CURRENT_STATUS_CHOICES if code)
+PENDING_STATUS_LABELS = dict((label.lower(), code)
+                             for code, label in PENDING_STATUS_CHOICES if code)
+
+
+def report_status(text):
+    """
+    Returns the (current_status, pending_status) for a report's status text,
+    e.g. 'Settled' or 'Pending Settlement'. A pending credit is taken to be
+    of a settled transaction and other pending statuses of an authorized one.
+    Returns None for an unknown status.
+
+    """
+    text = text.strip().lower()
+    if text in CURRENT_STATUS_LABELS:
+        return CURRENT_STATUS_LABELS[text], 0
+    if text in PENDING_STATUS_LABELS:
+        pending_status = PENDING_STATUS_LABELS[text]
+        if pending_status == PENDING_CREDIT:
+            return SETTLED, pending_status
+        return AUTHORIZED, pending_status
+    return None
+
+
+def row_values(row):
+    """
+    Maps a report row onto Transaction field values, or returns None if its
+    status is unknown.
+
+    """
+    status = report_status(row.get('TransactionStatus', ''))
+    if status is None:
+        return None
+    current_status, pending_status = status
+    return {
+        'transaction_id': row.get('TransactionFileName', ''),
+        'order_number': row.get('OrderNumber', ''),
+        'auth_code': row.get('ApprovalCode', ''),
+        'amount': row.get('Amount'),
+        'current_status': current_status,
+        'pending_status': pending_status,
+        'status_text': status_message_detail('%d%d' % (current_status,
+                                                       pending_status)),
+        'status_date': row.get('TransactionDate'),
+    }
+
+
+def new_transaction(values, merchant=''):
+    """An unsaved Transaction for a report row not in the database."""
+    return Transaction(auth_response_code=values['auth_code'],
+                       approved='1', return_code=1, avs_code='',
+                       is_live=not settings.SKIPJACK_DEBUG, merchant=merchant,
+                       amount=values['amount'] or 0,
+                       **dict((field, value) for field, value in
+                              values.items() if field != 'amount'))
+
+
+# The fields brought up to date on existing Transactions.
+STATUS_FIELDS = ('transaction_id', 'current_status', 'pending_status',
+                 'status_text')
+
+
+def import_chunk(rows, merchant=None):
+    """
+    Imports a chunk of the merchant account's report rows in one database
+    transaction, returning the number of Transactions (created, updated,
+    unchanged) and of rows skipped for an unknown status. Archived
+    Transactions count as unchanged.
+
+    """
+    # Later rows for the same transaction win.
+    by_key = {}
+    skipped = 0
+    for row in rows:
+        values = row_values(row)
+        if values is None:
+            skipped += 1
+        elif values['order_number']:
+            by_key[(values['order_number'], values['auth_code'])] = values
+    merchant = merchant or ''
+    existing = {}
+    for row in Transaction.objects.filter(merchant=merchant,
+            order_number__in=set(key[0] for key in by_key)).order_by(
+            'pk').values_list('pk', 'order_number', 'auth_code',
+                              *(STATUS_FIELDS + ('creation_date', 'amount') +
+                                ROLLUP_FIELDS)):
+        # The latest Transaction for each order and approval code.
+        existing[(row[1], row[2])] = row
+    missing = set(by_key) - set(existing)
+    archived = set(ArchivedTransaction.objects.filter(merchant=merchant,
+            order_number__in=set(key[0] for key in missing)).values_list(
+            'order_number', 'auth_code')) & missing
+    created = []
+    updates = {}
+    renumbered = []
+    rollups = {}
+    for key, values in by_key.items():
+        if key in archived:
+            continue
+        if key not in existing:
+            created.append(new_transaction(values, merchant))
+            continue
+        row = existing[key]
+        status = tuple(values[field] for field in STATUS_FIELDS)
+        if status == row[3:7]:
+            continue
+        if status[1] != row[4]:
+            # Move it to the rollup for its new status.
+            old_key = (row[7].date(),) + row[9:]
+            new_key = (old_key[0], status[1]) + old_key[2:]
+            for rollup, sign in ((old_key, -1), (new_key, 1)):
+                count, amount = rollups.get(rollup, (0, 0))
+                rollups[rollup] = (count + sign, amount + sign * row[8])
+        if values['transaction_id'] != row[3]:
+            # Skipjack changes the transaction id as it settles, etc.
+            renumbered.append((row[0], status))
+        else:
+            updates.setdefault(status[1:], []).append(row[0])
+    Transaction.objects.bulk_insert(created)
+    # One UPDATE per distinct status, not per row.
+    for status, pks in updates.items():
+        Transaction.objects.filter(pk__in=pks).update(
+                                    **dict(zip(STATUS_FIELDS[1:], status)))
+    for pk, status in renumbered:
+        Transaction.objects.filter(pk=pk).update(
+                                    **dict(zip(STATUS_FIELDS, status)))
+    if rollups_enabled():
+        for rollup, (count, amount) in rollups.items():
+            if count or amount:
+                DailyRollup.objects.add(rollup, count, amount)
+    updated = len(renumbered) + sum(len(pks) for pks in updates.values())
+    return (len(created), updated, len(by_key) - len(created) - updated,
+            skipped)
+import_chunk = transaction.commit_on_success(import_chunk)
+
+
+def import_reports(start_date, end_date, split_days=1, workers=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE, merchant=None, **kwargs):
+    """
+    Imports the merchant account's reports for start_date..end_date,
+    requesting `split_days` days at a time, `workers` at a time, and
+    importing each report as it arrives. kwargs are passed on to
+    transaction_reports().
+
+    Returns a dict of the number of rows imported and Transactions created,
+    updated and unchanged, of rows skipped for an unknown status, and the
+    seconds taken.
+
+    """
+    started = time.time()
+    counts = {'rows': 0, 'created': 0, 'updated': 0, 'unchanged': 0,
+              'skipped': 0}
+    def fetch(window):
+        return transaction_reports(window[0], window[1], merchant=merchant,
+                                   **kwargs)
+    windows = report_windows(start_date, end_date, split_days)
+    for window, rows, error in imap_unordered(fetch, windows, workers):
+        if error:
+            raise error[0], error[1], error[2]
+        for i in xrange(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            created, updated, unchanged, skipped = import_chunk(chunk,
+                                                                merchant)
+            counts['rows'] += len(chunk)
+            counts['created'] += created
+            counts['updated'] += updated
+            counts['unchanged'] += unchanged
+            counts['skipped'] += skipped
+    counts['seconds'] = time.time() - started
+    return counts
@@ -0,0 +1,11 @@
+"""Shared handling of the date options of the Skipjack commands."""
+import datetime
+from django.core.management.base import CommandError
+
+
+def parse_date(value):
+    """Parses a YYYY-MM-DD date option."""
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise CommandError('Invalid date %r, expected YYYY-MM-DD.' % value)
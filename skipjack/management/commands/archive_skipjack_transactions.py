@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+"""
+Moves Transactions in a final state (settled, credited, archived, deleted or
+denied, with nothing pending) older than SKIPJACK_ARCHIVE_AFTER days (90 by
+default) to the ArchivedTransaction table, a batch at a time.
+
+You will want to execute this command as a regular scheduled task, so that
+the Transaction table stays small however much history there is.
+
+"""
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = 'Archive old Skipjack Transactions in a final state.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+                    help='Archive Transactions created more than this many '
+                         'days ago.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=None,
+                    help='Transactions to move per database transaction.'),
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Archive at most this many Transactions.'),
+    )
+
+    def handle_noargs(self, **options):
+        """Archive the Transactions."""
+        from skipjack.archive import archive, DEFAULT_BATCH_SIZE
+        archived = archive(days=options['days'],
+                           batch_size=options['batch_size'] or
+                                      DEFAULT_BATCH_SIZE,
+                           limit=options['limit'])
+        if archived:
+            self.stdout.write('Archived %d transactions.\n' % archived)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Exports the stored Transactions as CSV, to a file or standard output.
+
+Transactions can be limited to those created within a range of dates, given
+as YYYY-MM-DD. Rows are fetched and written a chunk at a time, so exports of
+any size run in constant memory.
+
+"""
+import datetime
+import sys
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+from skipjack.management.commands._dates import parse_date
+
+
+class Command(NoArgsCommand):
+    help = 'Export the stored Skipjack Transactions as CSV.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default=None,
+                    help='File to write to (default standard output).'),
+        make_option('--start', dest='start', default=None,
+                    help='Only Transactions created on or after this day.'),
+        make_option('--end', dest='end', default=None,
+                    help='Only Transactions created on or before this day.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=None,
+                    help='Rows to fetch from the database at a time.'),
+    )
+
+    def handle_noargs(self, **options):
+        """Write the Transactions out as CSV."""
+        from skipjack.export import export_csv, DEFAULT_CHUNK_SIZE
+        from skipjack.models import Transaction
+        queryset = Transaction.objects.all()
+        if options['start']:
+            queryset = queryset.filter(
+                        creation_date__gte=parse_date(options['start']))
+        if options['end']:
+            queryset = queryset.filter(creation_date__lt=parse_date(
+                        options['end']) + datetime.timedelta(days=1))
+        if options['output']:
+            output = open(options['output'], 'wb')
+        else:
+            output = sys.stdout
+        try:
+            for data in export_csv(queryset, chunk_size=options['chunk_size']
+                                                    or DEFAULT_CHUNK_SIZE):
+                output.write(data)
+        finally:
+            if output is not sys.stdout:
+                output.close()
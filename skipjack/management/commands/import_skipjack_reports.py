@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+"""
+Imports the Skipjack Customized Report rows for a range of dates into the
+database: Transactions created outside this site are added, and the status
+of those already stored brought up to date.
+
+Dates are given as YYYY-MM-DD, and both default to yesterday. The reports
+of every merchant account are imported, unless --merchant names one.
+
+"""
+import datetime
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+
+from skipjack.management.commands._dates import parse_date
+
+
+class Command(NoArgsCommand):
+    help = 'Import Skipjack report rows into the stored Transactions.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+                    help='First day to import (YYYY-MM-DD).'),
+        make_option('--end', dest='end', default=None,
+                    help='Last day to import (YYYY-MM-DD).'),
+        make_option('--split-days', type='int', dest='split_days', default=1,
+                    help='Days of the report to request at a time.'),
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of concurrent requests to Skipjack.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=None,
+                    help='Rows to import per database transaction.'),
+        make_option('--merchant', dest='merchant', default=None,
+                    help='Only import the reports of this merchant account.'),
+    )
+
+    def handle_noargs(self, **options):
+        """Import the reports and print the counts and throughput."""
+        from skipjack.importer import import_reports, DEFAULT_CHUNK_SIZE
+        from skipjack.merchants import merchant_names
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        start = options['start'] and parse_date(options['start']) or yesterday
+        end = options['end'] and parse_date(options['end']) or start
+        if end < start:
+            raise CommandError('The end date is before the start date.')
+        if options['merchant'] is not None:
+            merchants = [options['merchant']]
+        else:
+            merchants = merchant_names()
+        for merchant in merchants:
+            counts = import_reports(start, end,
+                                    split_days=options['split_days'],
+                                    workers=options['workers'],
+                                    chunk_size=options['chunk_size'] or
+                                               DEFAULT_CHUNK_SIZE,
+                                    merchant=merchant)
+            self.write_counts(merchant, counts)
+    
+    def write_counts(self, merchant, counts):
+        """Print the counts and throughput of one merchant's import."""
+        if merchant:
+            self.stdout.write('%s: ' % merchant)
+        self.stdout.write('Imported %d report rows in %.1f seconds (%d rows '
+                          'per second): %d created, %d updated, '
+                          '%d unchanged, %d skipped.\n' % (
+                            counts['rows'], counts['seconds'],
+                            counts['rows'] / max(counts['seconds'], 0.001),
+                            counts['created'], counts['updated'],
+                            counts['unchanged'], counts['skipped']))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""
+Makes the status changes queued for Skipjack: the deletes queued when
+Transactions are deleted from the database, and settlements, refunds etc.
+queued with Transaction.settle(queued=True) and so on.
+
+You will want to execute this command as a regular scheduled task. Several
+can run at once.
+
+"""
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = 'Process the queued Skipjack status changes.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of concurrent requests to Skipjack.'),
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Process at most this many queued changes.'),
+        make_option('--max-attempts', type='int', dest='max_attempts',
+                    default=None,
+                    help='Attempts before giving up on a queued change.'),
+        make_option('--rate', type='float', dest='rate', default=None,
+                    help='Process at most this many changes per second.'),
+    )
+
+    def handle_noargs(self, **options):
+        """Process the queued changes that are due."""
+        from skipjack.models import DONE, FAILED, QUEUED
+        from skipjack.outbox import process
+        counts = process(limit=options['limit'], workers=options['workers'],
+                         max_attempts=options['max_attempts'],
+                         rate=options['rate'])
+        if sum(counts.values()):
+            self.stdout.write('Processed %d queued changes: %d done, '
+                              '%d failed, %d to retry.\n' % (
+                                sum(counts.values()), counts[DONE],
+                                counts[FAILED], counts[QUEUED]))
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""
+Recounts the DailyRollups from the stored Transactions, for all days or a
+range of days given as YYYY-MM-DD.
+
+Run it once after setting SKIPJACK_ROLLUPS = True, to count the existing
+Transactions; the rollups are kept up to date from then on.
+
+"""
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from skipjack.management.commands._dates import parse_date
+
+
+class Command(NoArgsCommand):
+    help = 'Rebuild the daily rollups of the Skipjack Transactions.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+                    help='First day to rebuild (YYYY-MM-DD).'),
+        make_option('--end', dest='end', default=None,
+                    help='Last day to rebuild (YYYY-MM-DD).'),
+    )
+
+    def handle_noargs(self, **options):
+        """Rebuild the rollups in a single database transaction."""
+        from skipjack.models import DailyRollup
+        start = options['start'] and parse_date(options['start'])
+        end = options['end'] and parse_date(options['end'])
+        counted = transaction.commit_on_success(DailyRollup.objects.rebuild)(
+                                                start_date=start, end_date=end)
+        self.stdout.write('Rebuilt the rollups of %d transactions.\n' %
+                                                                    counted)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""
+Compares the count and total of each settlement batch at Skipjack with the
+stored Transactions in it, for a range of dates, and prints just the batches
+that don't match. See skipjack.reconcile.
+
+Dates are given as YYYY-MM-DD, and both default to yesterday. The batches
+of every merchant account are reconciled, unless --merchant names one.
+
+"""
+import datetime
+from optparse import make_option
+from django.core.management.base import NoArgsCommand, CommandError
+
+from skipjack.management.commands._dates import parse_date
+
+
+def describe(totals):
+    """Formats a batch's (count, total in cents), or None."""
+    if totals is None:
+        return 'missing'
+    return '%d for %d.%02d' % (totals[0], totals[1] // 100, totals[1] % 100)
+
+
+class Command(NoArgsCommand):
+    help = 'Reconcile Skipjack settlement batches with the stored ' \
+           'Transactions.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--start', dest='start', default=None,
+                    help='First day to reconcile (YYYY-MM-DD).'),
+        make_option('--end', dest='end', default=None,
+                    help='Last day to reconcile (YYYY-MM-DD).'),
+        make_option('--split-days', type='int', dest='split_days', default=1,
+                    help='Days of the report to request at a time.'),
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of concurrent requests to Skipjack.'),
+        make_option('--merchant', dest='merchant', default=None,
+                    help='Only reconcile the batches of this merchant '
+                         'account.'),
+    )
+
+    def handle_noargs(self, **options):
+        """Reconcile the batches and print the discrepancies."""
+        from skipjack.merchants import merchant_names
+        from skipjack.reconcile import reconcile
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        start = options['start'] and parse_date(options['start']) or yesterday
+        end = options['end'] and parse_date(options['end']) or start
+        if end < start:
+            raise CommandError('The end date is before the start date.')
+        if options['merchant'] is not None:
+            merchants = [options['merchant']]
+        else:
+            merchants = merchant_names()
+        for merchant in merchants:
+            for batch, reported, local in reconcile(
+                    start, end, merchant, split_days=options['split_days'],
+                    workers=options['workers']):
+                if merchant:
+                    self.stdout.write('%s: ' % merchant)
+                self.stdout.write('Batch %s: Skipjack %s, database %s.\n' % (
+                                    batch, describe(reported),
+                                    describe(local)))
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Settles the authorized Transactions that are due to be, and once a day after
+SKIPJACK_BATCH_CUTOFF closes the current batch and refreshes the status of
+the Transactions in it. See skipjack.settlement.
+
+--close closes the batch now, whatever the time, and --no-close leaves it
+open. --merchant settles just one merchant account.
+
+You will want to execute this command as a regular scheduled task, e.g.
+every 15 minutes.
+
+"""
+from optparse import make_option
+from django.core.management.base import NoArgsCommand
+
+
+class Command(NoArgsCommand):
+    help = 'Settle authorized Skipjack Transactions and close the batch.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of concurrent requests to Skipjack.'),
+        make_option('--merchant', dest='merchant', default=None,
+                    help='Only settle the Transactions of this merchant '
+                         'account.'),
+        make_option('--hours', type='float', dest='hours', default=None,
+                    help='Only settle Transactions authorized at least this '
+                         'many hours ago.'),
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Settle at most this many Transactions per '
+                         'merchant account.'),
+        make_option('--close', action='store_true', dest='close',
+                    default=None, help='Close the current batch now.'),
+        make_option('--no-close', action='store_false', dest='close',
+                    help="Don't close the current batch."),
+    )
+
+    def handle_noargs(self, **options):
+        """Settle, and close the batch of, each merchant account."""
+        from skipjack.merchants import get_merchant, merchant_names
+        from skipjack.settlement import settle, close, scheduled_close
+        if options['merchant'] is not None:
+            merchants = [get_merchant(options['merchant']).name]
+        else:
+            merchants = merchant_names()
+        for merchant in merchants:
+            label = merchant and ' for %s' % merchant or ''
+            settled, failures = settle(merchant, options['hours'],
+                                       options['workers'], options['limit'])
+            if settled:
+                self.stdout.write('Settled %d transactions%s.\n' % (
+                                    settled, label))
+            if failures:
+                self.stderr.write('Failed to settle %d transactions%s.\n' % (
+                                    failures, label))
+            if options['close'] is False:
+                continue
+            if options['close']:
+                closed = close(merchant, options['workers'])
+            else:
+                closed = scheduled_close(merchant, options['workers'])
+            if closed is not None:
+                response, updated, failures = closed
+                self.stdout.write('Closed the batch%s: %s. Synced %d '
+                                  'transactions.\n' % (label, response,
+                                                       updated))
+                if failures:
+                    self.stderr.write('Failed to sync %d transactions%s.\n' %
+                                      (failures, label))
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""
+Measures the round trip to Skipjack, e.g. before a large batch of work or
+during an incident.
+
+Sends --requests lightweight, read only requests to each endpoint, --workers
+at a time: a status request for --order-number (default
+SKIPJACK_PROBE_ORDER_NUMBER), and with --endpoints=status,report also a one
+row report for today. They're sent once over new connections and once
+reusing connections, and the connect, TLS handshake, time to first byte and
+total latency percentiles reported, with the throughput of each.
+
+"""
+import datetime
+import urllib
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+
+ENDPOINTS = ('status', 'report')
+
+PERCENTILES = (0.5, 0.9, 0.99, 1.0)
+
+
+class Command(NoArgsCommand):
+    help = 'Measure the latency of requests to Skipjack.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--requests', type='int', dest='requests', default=20,
+                    help='Requests to send to each endpoint, each way.'),
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of concurrent requests to Skipjack.'),
+        make_option('--order-number', dest='order_number', default=None,
+                    help='The order number to request the status of.'),
+        make_option('--endpoints', dest='endpoints', default='status',
+                    help='Comma separated endpoints to probe: status, '
+                         'report.'),
+        make_option('--merchant', dest='merchant', default=None,
+                    help='The merchant account to probe as.'),
+    )
+    
+    def requests(self, endpoint, order_number, merchant):
+        """The (url, data) of the probe request for an endpoint."""
+        from skipjack.helpers import StatusHelper, ReportHelper
+        from skipjack.merchants import get_merchant
+        from skipjack.utils import _report_request
+        if endpoint == 'status':
+            helper = StatusHelper(get_merchant(merchant).sz_default_list)
+            data = [('szOrderNumber', order_number)]
+        else:
+            helper = ReportHelper(get_merchant(merchant).report_default_list)
+            today = datetime.date.today()
+            data = [(field, 1 if field == 'sRecsPerPage' else value)
+                    for field, value in _report_request(today, today, None,
+                                                        None)]
+        return helper.endpoint, urllib.urlencode(helper.defaults + data)
+    
+    def handle_noargs(self, **options):
+        """Probe each endpoint and print the latencies."""
+        from skipjack.probe import probe, percentile, PHASES
+        from skipjack.workers import default_workers
+        order_number = options['order_number'] or getattr(
+                            settings, 'SKIPJACK_PROBE_ORDER_NUMBER', None)
+        endpoints = [endpoint.strip() for endpoint in
+                     options['endpoints'].split(',') if endpoint.strip()]
+        for endpoint in endpoints:
+            if endpoint not in ENDPOINTS:
+                raise CommandError('Unknown endpoint %r, choose from %s.' % (
+                                    endpoint, ', '.join(ENDPOINTS)))
+        if 'status' in endpoints and not order_number:
+            raise CommandError('Give an --order-number to request the status '
+                               'of, or set SKIPJACK_PROBE_ORDER_NUMBER.')
+        workers = options['workers'] or default_workers()
+        for endpoint in endpoints:
+            url, data = self.requests(endpoint, order_number,
+                                      options['merchant'])
+            self.stdout.write('%s %s: %d requests, %d workers\n' % (
+                                endpoint, url, options['requests'], workers))
+            self.stdout.write('%-24s%9s%9s%9s%9s\n' % (
+                                'milliseconds', 'p50', 'p90', 'p99', 'max'))
+            for reuse in (False, True):
+                results = probe(url, data, options['requests'], workers,
+                                reuse, endpoint, options['merchant'])
+                label = 'reused' if reuse else 'new'
+                for phase in PHASES:
+                    if reuse and phase in ('connect', 'tls'):
+                        # Only the first request of each worker connects.
+                        continue
+                    values = [percentile(results[phase], fraction)
+                              for fraction in PERCENTILES]
+                    self.stdout.write('%-24s%s\n' % (
+                        '  %s %s' % (phase.replace('_', ' '), label),
+                        ''.join(['%9s' % '-' if value is None else
+                                 '%9.1f' % (value * 1000)
+                                 for value in values])))
+                succeeded = options['requests'] - results['errors']
+                self.stdout.write('  %s connections: %.1f requests/second'
+                                  '%s\n' % (label,
+                                    succeeded / max(results['seconds'], 0.001),
+                                    ', %d errors' % results['errors']
+                                    if results['errors'] else ''))
@@ -3,15 +3,27 @@
 Updates the status of Transactions stored in the database that have a
 pending status (or no status at all).
 
+The Transactions of every merchant account are synced together, `--workers`
+status requests at a time, each merchant's within its own connections and
+rate limits (see skipjack.merchants). --merchant syncs just one account.
+
 You will want to execute this command as a regular scheduled task.
 
 """
 import datetime
+from optparse import make_option
 from django.core.management.base import NoArgsCommand, CommandError
 
 
 class Command(NoArgsCommand):
     help = 'Sync the status of stored Skipjack Transactions.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--workers', type='int', dest='workers', default=None,
+                    help='Number of concurrent requests to Skipjack.'),
+        make_option('--merchant', dest='merchant', default=None,
+                    help='Only sync the Transactions of this merchant '
+                         'account.'),
+    )
     
     def handle_noargs(self, **options):
         """
@@ -22,14 +34,17 @@ class Command(NoArgsCommand):
         
         """
         from skipjack.models import Transaction, AUTHORIZED, PRE_AUTHORIZED
-        num_updated = 0
-        for obj in Transaction.objects.exclude(transaction_id='').filter(
-                        current_status__in=(0, AUTHORIZED, PRE_AUTHORIZED)):
-            obj.update_status()
-            num_updated += 1
+        from skipjack.settlement import refresh
+        payments = Transaction.objects.exclude(transaction_id='').filter(
+                        current_status__in=(0, AUTHORIZED, PRE_AUTHORIZED))
+        if options['merchant'] is not None:
+            payments = payments.filter(merchant=options['merchant'])
+        num_updated, failures = refresh(payments, options['workers'])
         if num_updated > 1:
             self.stdout.write('Successfully synced %d transactions.\n' %
                                                                 num_updated)
         elif num_updated == 1:
             self.stdout.write('Successfully synced %d transaction.\n' %
                                                                 num_updated)
+        if failures:
+            self.stderr.write('Failed to sync %d transactions.\n' % failures)
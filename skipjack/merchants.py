@@ -0,0 +1,93 @@
+"""
+The Skipjack merchant accounts a site takes payments for.
+
+The SKIPJACK_* credential settings are the default merchant account, named
+''. Further accounts are configured by name in SKIPJACK_MERCHANTS, each with
+its own credentials and, optionally, its own connection pool size and rate
+limits. Anything an account doesn't set is taken from the SKIPJACK_* setting
+of the same name, e.g.
+
+    SKIPJACK_MERCHANTS = {
+        'outlet': {
+            'SERIAL_NUMBER': '000111222333',
+            'LOGIN_SERIAL_NUMBER': '000111222334',
+            'LOGIN_USERNAME': 'outlet',
+            'LOGIN_PASSWORD': 'secret',
+            'POOL_SIZE': 4,
+            'RATE_LIMITS': {'status': 5},
+        },
+    }
+
+Transactions record the name of their merchant account, and every request
+about them is made with that account's credentials, over that account's
+connections and within its rate limits.
+
+"""
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+DEFAULT_MERCHANT = ''
+
+
+class Merchant(object):
+    """A Skipjack merchant account, and the request fields it's sent as."""
+    def __init__(self, name, config=None):
+        self.name = name
+        self.config = config or {}
+
+    def get(self, key, default=''):
+        """The account's value for SKIPJACK_<key>."""
+        if key in self.config:
+            return self.config[key]
+        return getattr(settings, 'SKIPJACK_%s' % key, default)
+
+    @property
+    def default_list(self):
+        """Leading fields of an authorize request."""
+        return [
+            ('SerialNumber', self.get('SERIAL_NUMBER')),
+            ('DeveloperSerialNumber', self.get('DEVELOPER_SERIAL_NUMBER'))
+        ]
+
+    @property
+    def sz_default_list(self):
+        """Leading fields of status, change status and close batch requests."""
+        return [
+            ('szSerialNumber', self.get('SERIAL_NUMBER')),
+            ('szDeveloperSerialNumber', self.get('DEVELOPER_SERIAL_NUMBER'))
+        ]
+
+    @property
+    def report_default_list(self):
+        """Leading fields of a Customized Report request."""
+        return [
+            ('sSerialNumber_Merchant', self.get('SERIAL_NUMBER')),
+            ('sSerialNumber_Login', self.get('LOGIN_SERIAL_NUMBER')),
+            ('sUsername', self.get('LOGIN_USERNAME')),
+            ('sPassword', self.get('LOGIN_PASSWORD')),
+        ]
+
+
+def merchant_names():
+    """The names of every configured merchant account, the default first."""
+    return [DEFAULT_MERCHANT] + sorted(getattr(settings, 'SKIPJACK_MERCHANTS',
+                                               {}))
+
+
+def get_merchant(name=None):
+    """
+    Returns the Merchant with the given name, or the default merchant when
+    no name is given.
+
+    Raises ImproperlyConfigured for names not in SKIPJACK_MERCHANTS.
+
+    """
+    if not name:
+        return Merchant(DEFAULT_MERCHANT)
+    try:
+        config = getattr(settings, 'SKIPJACK_MERCHANTS', {})[name]
+    except KeyError:
+        raise ImproperlyConfigured('No Skipjack merchant named %r in '
+                                   'SKIPJACK_MERCHANTS.' % name)
+    return Merchant(name, config)
@@ -1,13 +1,17 @@
 """Skipjack response models."""
 import datetime
 from decimal import Decimal
-import time
+import re
 
-from django.db import models
-from django.db.models.signals import pre_delete, post_save
+from django.conf import settings
+from django.db import models, transaction, IntegrityError, DEFAULT_DB_ALIAS
+from django.db.models import F
+from django.db.models.signals import pre_delete, post_save, post_delete, \
+                                     post_init
 from django.utils.encoding import smart_unicode
 
-from skipjack import signals
+from skipjack import counts, signals
+from skipjack.workers import defer_using
 
 
 RETURN_CODE_CHOICES = (
@@ -138,6 +142,7 @@ TRANSACTION_MAPPING = {
     'szAuthorizationResponseCode': 'auth_response_code',
     # Fields that map directly to what we store in the Transaction.
     'is_live': 'is_live',
+    'merchant': 'merchant',
     # Fields that don't map to what we store in the Transaction.
     'szSerialNumber': ''
 }
@@ -197,23 +202,47 @@ CLOSE_BATCH_STATUS_CHOICES = (
     ('-503', 'Request timed out'),
 )
 
+# States of a QueuedStatusChange.
+QUEUED = 0
+PROCESSING = 1
+DONE = 2
+FAILED = 3
+
+QUEUE_STATE_CHOICES = (
+    (QUEUED, 'Queued'),
+    (PROCESSING, 'Processing'),
+    (DONE, 'Done'),
+    (FAILED, 'Failed'),
+)
+
 class TransactionError(StandardError):
     """Use for Transaction related errors."""
     pass
 
 
+class BulkTransactionError(TransactionError):
+    """
+    Raised once a bulk operation has finished if some of its requests to
+    Skipjack failed. failures is a list of (data, exc_info) tuples.
+    
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        TransactionError.__init__(self, '%d requests to Skipjack failed' %
+                                        len(failures))
+
+
 class TransactionManager(models.Manager):
     """
     To provide:
     
     1. A create_from_dict() shortcut method.
+    2. A bulk_create_from_dict() method for many Transactions at once.
+    3. A bulk_insert() method for saving many new Transactions at once.
     
     """
-    def create_from_dict(self, params):
-        """
-        Handle creation of a Transaction object directly from a
-        dictionary returned by SkipJack.
-        """
+    def _kwargs_from_dict(self, params):
+        """Map a dictionary returned by Skipjack onto Transaction fields."""
         kwargs = dict(map(lambda x: (TRANSACTION_MAPPING[x[0]], x[1]),
                           params.items()))
         del kwargs['']  # We mapped szSerialNumber to the empty string.
@@ -226,26 +255,75 @@ class TransactionManager(models.Manager):
         if 'auth_code' in kwargs and kwargs['auth_code'] == 'EMPTY':
             # Auth Code value of 'EMPTY' means we need to "empty" it...
             del kwargs['auth_code']
-        return self.create(**kwargs)
-
-
-class Transaction(models.Model):
-    """
-    Skipjack Transaction.
+        return kwargs
     
-    Contains the fields returned by a SkipJack Authorize request, plus a few
-    that are useful based on getting the transaction status, and providing
-    for methods to change the Transaction status.
+    def create_from_dict(self, params):
+        """
+        Handle creation of a Transaction object directly from a
+        dictionary returned by SkipJack.
+        """
+        return self.create(**self._kwargs_from_dict(params))
     
-    The transaction_id can be blank, and will be blank if return_code is
-    something other than 1. These indicate failed transactions.
+    def bulk_create_from_dict(self, params_list):
+        """
+        Create a Transaction for each dictionary returned by Skipjack, in a
+        single database transaction, and return the list of Transactions.
+        
+        Uses a single multi-row INSERT where the Django version provides
+        bulk_create (in which case the Transactions may not have a pk,
+        depending on the database backend).
+        
+        The payment signals are NOT sent, as they would be from post_save
+        for a single create(); that's left to the caller, after commit.
+        
+        """
+        return self.bulk_insert([self.model(**self._kwargs_from_dict(params))
+                                 for params in params_list])
     
-    WARNING: The transaction_id changes when a transaction moves through
-             processing at Skipjack. This does not appear to be documented
-             anywhere. For instance, a transaction is authorized, and then
-             settle() is called to settle the transaction, then later the
-             transaction id will change when the transaction is actually
-             settled. This is incredibly annoying.
+    def bulk_insert(self, objs):
+        """
+        INSERT the unsaved Transactions in a single database transaction (or
+        as part of the current one, if under transaction management), and
+        return them. The payment signals are not sent.
+        
+        """
+        if not objs:
+            return objs
+        using = self.db
+        bulk_create = getattr(self, 'bulk_create', None)
+        managed = transaction.is_managed(using=using)
+        if not managed:
+            transaction.enter_transaction_management(using=using)
+            transaction.managed(True, using=using)
+        try:
+            if bulk_create is not None:
+                bulk_create(objs)
+                # No post_save signals to do these.
+                counts.invalidate()
+                if rollups_enabled():
+                    for obj in objs:
+                        DailyRollup.objects.add(rollup_key(obj), 1,
+                                                obj.amount)
+            else:
+                for obj in objs:
+                    obj._skip_payment_signals = True
+                    obj.save(force_insert=True, using=using)
+            if not managed:
+                transaction.commit(using=using)
+        except:
+            if not managed:
+                transaction.rollback(using=using)
+            raise
+        finally:
+            if not managed:
+                transaction.leave_transaction_management(using=using)
+        return objs
+
+
+class BaseTransaction(models.Model):
+    """
+    The fields of a Skipjack Transaction, shared by Transaction and
+    ArchivedTransaction.
     
     """
     transaction_id = models.CharField(max_length=18, db_index=True)
@@ -271,6 +349,8 @@ class Transaction(models.Model):
     cavv_response = models.CharField('CAVV response', max_length=2, blank=True,
                                      choices=CAVV_RESPONSE_CODE_CHOICES)
     is_live = models.BooleanField(default=True)
+    # The name of the merchant account, see skipjack.merchants.
+    merchant = models.CharField(max_length=30, blank=True, db_index=True)
     
     creation_date = models.DateTimeField(auto_now_add=True)
     mod_date = models.DateTimeField(auto_now=True)
@@ -278,12 +358,12 @@ class Transaction(models.Model):
     # Updated with a self.update_status() call.
     status_text = models.CharField(max_length=50, blank=True)
     current_status = models.PositiveSmallIntegerField(default=0,
-                                choices=CURRENT_STATUS_CHOICES)
+                                choices=CURRENT_STATUS_CHOICES, db_index=True)
     pending_status = models.PositiveSmallIntegerField(default=0,
                                 choices=PENDING_STATUS_CHOICES)
     status_date = models.DateTimeField(blank=True, null=True)
-    
-    objects = TransactionManager()
+    # The settlement batch, once settled.
+    batch_number = models.CharField(max_length=20, blank=True, db_index=True)
     
     @property
     def is_approved(self):
@@ -297,6 +377,31 @@ class Transaction(models.Model):
         return u"Transaction ID: %s, Amount: %s, Auth code: %s" % \
                 (self.transaction_id, self.amount, self.auth_response_code)
     
+    class Meta:
+        abstract = True
+
+
+class Transaction(BaseTransaction):
+    """
+    Skipjack Transaction.
+    
+    Contains the fields returned by a SkipJack Authorize request, plus a few
+    that are useful based on getting the transaction status, and providing
+    for methods to change the Transaction status.
+    
+    The transaction_id can be blank, and will be blank if return_code is
+    something other than 1. These indicate failed transactions.
+    
+    WARNING: The transaction_id changes when a transaction moves through
+             processing at Skipjack. This does not appear to be documented
+             anywhere. For instance, a transaction is authorized, and then
+             settle() is called to settle the transaction, then later the
+             transaction id will change when the transaction is actually
+             settled. This is incredibly annoying.
+    
+    """
+    objects = TransactionManager()
+    
     def get_status(self):
         """
         Updates the current status directly with a call to Skipjack.
@@ -317,21 +422,31 @@ class Transaction(models.Model):
               This is where `self.is_approved == True`
         
         """
-        from skipjack.utils import get_transaction_status
+        from skipjack.helpers import StatusHelper
+        from skipjack.utils import get_order_transaction_history
         if self.transaction_id and not self.is_approved:
             transaction_id = self.transaction_id
         else:
             # Approved transactions need the latest data.
             transaction_id = None
-        status = get_transaction_status(self.order_number,
-                                        transaction_id=transaction_id)
+        history = get_order_transaction_history(self.order_number,
+                                                merchant=self.merchant)
+        status = StatusHelper.select(history, transaction_id)
         self.status_text = status.message_detail
         self.current_status = status.current_status
         self.pending_status = status.pending_status
         self.status_date = status.date
+        # The batch is this transaction's own, not that of the latest entry
+        # in the order's history, which may be a credit of it.
+        own = [entry for entry in history
+               if entry.transaction_id == self.transaction_id]
         if status.transaction_id != self.transaction_id and \
                                         status.approval_code == self.auth_code:
             self.transaction_id = status.transaction_id
+            # Renumbered by Skipjack as it settled.
+            own = own or [status]
+        if own:
+            self.batch_number = own[-1].batch_number or ''
         return status
     
     def update_status(self):
@@ -360,9 +475,52 @@ class Transaction(models.Model):
         """
         from skipjack.utils import change_transaction_status
         return change_transaction_status(self.transaction_id, status, amount,
-                                         force_settlement)
+                                         force_settlement, self.merchant)
     
-    def settle(self, force_settlement=True):
+    def _queue_changes(self, queued):
+        """Whether to queue status changes rather than make them now."""
+        if queued is None:
+            return getattr(settings, 'SKIPJACK_QUEUE_STATUS_CHANGES', False)
+        return queued
+    
+    def queue_status_change(self, status, amount=None, force_settlement=True):
+        """
+        Queue a status change to be made by the process_skipjack_queue
+        command, returning the QueuedStatusChange.
+        
+        The same change (status and amount) can only be pending once for a
+        Transaction; queueing it again returns the entry already queued.
+        
+        """
+        key = '%s:%s' % (status, self.transaction_id)
+        if amount is not None:
+            key = '%s:%s' % (key, amount)
+        try:
+            return QueuedStatusChange.objects.get(key=key)
+        except QueuedStatusChange.DoesNotExist:
+            pass
+        sid = transaction.savepoint()
+        try:
+            entry = QueuedStatusChange.objects.create(
+                key=key,
+                payment=self,
+                merchant=self.merchant,
+                transaction_id=self.transaction_id,
+                order_number=self.order_number,
+                auth_code=self.auth_code,
+                is_approved=self.is_approved,
+                desired_status=status,
+                amount=amount,
+                force_settlement=force_settlement)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Queued by someone else in the meantime.
+            transaction.savepoint_rollback(sid)
+            entry = QueuedStatusChange.objects.get(key=key)
+        return entry
+    queue_status_change.alters_data = True
+    
+    def settle(self, force_settlement=True, queued=None):
         """
         Settle a previously Authorized transaction.
         
@@ -370,11 +528,19 @@ class Transaction(models.Model):
         settled according to the preferences set for the Merchant Account in
         the Skipjack system.
         
+        With queued=True (default settings.SKIPJACK_QUEUE_STATUS_CHANGES) the
+        request to Skipjack is queued for the process_skipjack_queue command
+        instead, and the QueuedStatusChange is returned. The same goes for
+        refund(), partial_refund() and authorize_additional().
+        
         """
         if self.current_status != AUTHORIZED or self.pending_status == \
                                                     SUBMITTED_FOR_SETTLEMENT:
             raise TransactionError(
                 'Settlement not allowed for %s transactions' % self.status_text)
+        if self._queue_changes(queued):
+            return self.queue_status_change('SETTLE',
+                                            force_settlement=force_settlement)
         # Need to report back if this request was not successful.
         response = self._change_status('SETTLE',
                                        force_settlement=force_settlement)
@@ -382,17 +548,20 @@ class Transaction(models.Model):
             raise TransactionError('Sorry, Skipjack said %s - %s' % (
                                     response.status, response.message))
     
-    def refund(self, force_settlement=True):
+    def refund(self, force_settlement=True, queued=None):
         """Full refund."""
         if self.current_status != SETTLED or self.pending_status:
             raise TransactionError('Transaction must be Settled to refund.')
+        if self._queue_changes(queued):
+            return self.queue_status_change('CREDIT', amount=self.amount,
+                                            force_settlement=force_settlement)
         response = self._change_status('CREDIT', amount=self.amount,
                                        force_settlement=force_settlement)
         if response.status != SUCCESSFUL:
             raise TransactionError('Sorry, Skipjack said %s - %s' % (
                                     response.status, response.message))
     
-    def partial_refund(self, amount=None, force_settlement=True):
+    def partial_refund(self, amount=None, force_settlement=True, queued=None):
         """Partially refund the Transaction."""
         if not amount:
             raise TransactionError('Partial refund requires an amount.')
@@ -405,6 +574,11 @@ class Transaction(models.Model):
                                                             self.pending_status:
             raise TransactionError('Transaction status prevents a partial '\
                                    'refund at this time.')
+        if self._queue_changes(queued):
+            return self.queue_status_change(
+                                    'CREDIT',
+                                    amount=amount.quantize(Decimal('0.01')),
+                                    force_settlement=force_settlement)
         response = self._change_status('CREDIT',
                                        amount=amount.quantize(Decimal('0.01')),
                                        force_settlement=force_settlement)
@@ -412,12 +586,18 @@ class Transaction(models.Model):
             raise TransactionError('Sorry, Skipjack said %s - %s' % (
                                     response.status, response.message))
     
-    def authorize_additional(self, amount=None, force_settlement=True):
+    def authorize_additional(self, amount=None, force_settlement=True,
+                             queued=None):
         """Authorized an additional amount for the Transaction."""
         if not amount:
             raise TransactionError('Authorize additional requires an amount.')
         if type(amount) is not Decimal:
             amount = Decimal(amount)
+        if self._queue_changes(queued):
+            return self.queue_status_change(
+                                    'AuthorizeAdditional',
+                                    amount=amount.quantize(Decimal('0.01')),
+                                    force_settlement=force_settlement)
         response = self._change_status('AuthorizeAdditional',
                                        amount=amount.quantize(Decimal('0.01')),
                                        force_settlement=force_settlement)
@@ -431,8 +611,9 @@ class Transaction(models.Model):
         
         You will also want to delete this object if you call this directly.
         
-        NOTE: Calling self.delete() will call this automatically so that the
-              transaction is deleted (if it can be) from the Skipjack system.
+        NOTE: Calling self.delete() queues the equivalent of this so that the
+              transaction is deleted (if it can be) from the Skipjack system
+              by the process_skipjack_queue command.
         
         """
         if self.current_status in (SETTLED, CREDITED, ARCHIVED, SPLIT_SETTLED):
@@ -447,58 +628,440 @@ class Transaction(models.Model):
         ordering = ['-creation_date']
 
 
+def _send_payment_signals(instance):
+    if instance.is_approved:
+        signals.payment_was_successful.send(sender=Transaction,
+                                            instance=instance)
+    else:
+        signals.payment_was_flagged.send(sender=Transaction, instance=instance)
+
+
+def dispatch_payment_signals(instance):
+    """
+    Send payment_was_successful or payment_was_flagged for a Transaction.
+    
+    With settings.SKIPJACK_DEFER_SIGNALS the receivers are instead run on a
+    background thread after the database transaction commits, so that slow
+    receivers (emails, fulfillment) don't hold up the authorize request.
+    
+    """
+    if getattr(settings, 'SKIPJACK_DEFER_SIGNALS', False):
+        defer_using(instance._state.db or DEFAULT_DB_ALIAS,
+                    _send_payment_signals, instance)
+    else:
+        _send_payment_signals(instance)
+
+
 def send_payment_signals(sender, instance, created, *args, **kwargs):
     """Send the payment signals as required."""
-    if created:
-        if instance.is_approved:
-            signals.payment_was_successful.send(sender=sender,
-                                                instance=instance)
-        else:
-            signals.payment_was_flagged.send(sender=sender, instance=instance)
+    if created and not getattr(instance, '_skip_payment_signals', False):
+        dispatch_payment_signals(instance)
 post_save.connect(send_payment_signals, sender=Transaction)
 
 def delete_transaction(sender, instance, using, *args, **kwargs):
-    """Also delete from Skipjack when a Transaction is deleted from the db."""
-    if instance.transaction_id:
-        instance.get_status()
-        try:
-            instance.delete_transaction()
-        except TransactionError:
-            pass # If the transaction can't be deleted, just ignore the issue.
+    """
+    Also delete from Skipjack when a Transaction is deleted from the db.
+    
+    The request to Skipjack is queued rather than made here, inside the
+    database transaction, see the process_skipjack_queue command. If a
+    delete of the same transaction id is already pending, that one stands.
+    
+    """
+    if not instance.transaction_id:
+        return
+    key = 'DELETE:%s' % instance.transaction_id
+    sid = transaction.savepoint(using=using)
+    try:
+        QueuedStatusChange.objects.using(using).create(
+            key=key,
+            merchant=instance.merchant,
+            transaction_id=instance.transaction_id,
+            order_number=instance.order_number,
+            auth_code=instance.auth_code,
+            is_approved=instance.is_approved,
+            desired_status='DELETE')
+        transaction.savepoint_commit(sid, using=using)
+    except IntegrityError:
+        transaction.savepoint_rollback(sid, using=using)
 
 pre_delete.connect(delete_transaction, sender=Transaction)
 
+def invalidate_counts(sender, instance, created=True, *args, **kwargs):
+    """Discard the admin's cached counts as Transactions come and go."""
+    if created:
+        counts.invalidate()
+post_save.connect(invalidate_counts, sender=Transaction)
+post_delete.connect(invalidate_counts, sender=Transaction)
+
+def rollups_enabled():
+    """If the DailyRollups are kept up to date, see SKIPJACK_ROLLUPS."""
+    return getattr(settings, 'SKIPJACK_ROLLUPS', False)
+
+
+# The Transaction fields, after the creation day, that it's rolled up by.
+ROLLUP_FIELDS = ('current_status', 'approved', 'return_code', 'is_live')
+
+
+def rollup_key(instance):
+    """
+    The (day, current_status, approved, return_code, is_live) DailyRollup
+    key for a Transaction, or None if it hasn't been saved (or was loaded
+    without those fields).
+    
+    """
+    values = instance.__dict__
+    try:
+        return (values['creation_date'].date(),) + \
+               tuple([values[field] for field in ROLLUP_FIELDS])
+    except (KeyError, AttributeError):
+        return None
+
+
+def remember_rollup(sender, instance, *args, **kwargs):
+    """Note what a Transaction is rolled up as, to spot changes on save."""
+    if rollups_enabled():
+        instance._rollup = (rollup_key(instance),
+                            instance.__dict__.get('amount'))
+post_init.connect(remember_rollup, sender=Transaction)
+
+def update_rollups(sender, instance, created, raw=False, *args, **kwargs):
+    """Count a Transaction in the DailyRollups as it's created or changed."""
+    if raw or not rollups_enabled():
+        return
+    key = rollup_key(instance)
+    old_key, old_amount = getattr(instance, '_rollup', (None, None))
+    if created:
+        DailyRollup.objects.add(key, 1, instance.amount)
+    elif old_key is not None and (old_key, old_amount) != (key,
+                                                            instance.amount):
+        DailyRollup.objects.add(old_key, -1, -old_amount)
+        DailyRollup.objects.add(key, 1, instance.amount)
+    instance._rollup = (key, instance.amount)
+post_save.connect(update_rollups, sender=Transaction)
+
+def remove_rollup(sender, instance, *args, **kwargs):
+    """Stop counting a deleted Transaction in the DailyRollups."""
+    if rollups_enabled():
+        key, amount = getattr(instance, '_rollup', (None, None))
+        if key is not None:
+            DailyRollup.objects.add(key, -1, -amount)
+post_delete.connect(remove_rollup, sender=Transaction)
+
+
+class QueuedStatusChange(models.Model):
+    """
+    A status change to be made at Skipjack outside of the request (and
+    database transaction) that asked for it.
+    
+    Processed by the process_skipjack_queue management command. The
+    Transaction may no longer exist (e.g. for a DELETE), so what's needed
+    to find it at Skipjack is copied here.
+    
+    key identifies the change (e.g. 'DELETE:<transaction_id>') so that the
+    same change is never pending twice. Once the change is done (or has
+    failed) the entry's id is appended, so the key may be used again.
+    
+    """
+    key = models.CharField(max_length=80, unique=True)
+    # The Transaction to mark once the change is made, if there is one.
+    payment = models.ForeignKey(Transaction, verbose_name='transaction',
+                                blank=True, null=True,
+                                on_delete=models.SET_NULL)
+    merchant = models.CharField(max_length=30, blank=True)
+    transaction_id = models.CharField(max_length=18, db_index=True)
+    order_number = models.CharField(max_length=20)
+    auth_code = models.CharField(max_length=6, blank=True)
+    is_approved = models.BooleanField(default=False)
+    desired_status = models.CharField(max_length=20)
+    amount = models.DecimalField(max_digits=12, decimal_places=2,
+                                 blank=True, null=True)
+    force_settlement = models.BooleanField(default=True)
+    
+    state = models.PositiveSmallIntegerField(default=QUEUED,
+                                             choices=QUEUE_STATE_CHOICES)
+    # When the entry is next due to be (re)tried.
+    next_attempt = models.DateTimeField(default=datetime.datetime.now,
+                                        db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    status = models.CharField(max_length=20, blank=True)
+    message = models.CharField(max_length=255, blank=True)
+    
+    creation_date = models.DateTimeField(auto_now_add=True)
+    mod_date = models.DateTimeField(auto_now=True)
+    
+    def __unicode__(self):
+        return u"%s %s: %s" % (self.desired_status, self.transaction_id,
+                               self.get_state_display())
+    
+    class Meta:
+        ordering = ['next_attempt']
+
+
+class DailyRollupManager(models.Manager):
+    """
+    To provide:
+    
+    1. An add() method for counting Transactions in the rollups.
+    2. A rebuild() method for recounting them from the Transactions.
+    
+    """
+    def add(self, key, count, amount):
+        """
+        Add count Transactions totalling amount (both may be negative) to
+        the rollup for the rollup_key() key, creating it if need be.
+        
+        """
+        day, current_status, approved, return_code, is_live = key
+        rollups = self.filter(day=day, current_status=current_status,
+                              approved=approved, return_code=return_code,
+                              is_live=is_live)
+        if rollups.update(count=F('count') + count,
+                          amount=F('amount') + amount):
+            return
+        sid = transaction.savepoint()
+        try:
+            self.create(day=day, current_status=current_status,
+                        approved=approved, return_code=return_code,
+                        is_live=is_live, count=count, amount=amount)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            # Created by someone else in the meantime.
+            transaction.savepoint_rollback(sid)
+            rollups.update(count=F('count') + count,
+                           amount=F('amount') + amount)
+    
+    def rebuild(self, start_date=None, end_date=None, chunk_size=1000):
+        """
+        Replace the rollups (for the days from start_date to end_date) with
+        those counted from the stored Transactions (archived or not),
+        returning the number of Transactions counted.
+        
+        The Transactions are read a chunk at a time, so this runs in
+        constant memory however many there are.
+        
+        """
+        from skipjack.export import chunked_values
+        rollups = self.all()
+        if start_date:
+            rollups = rollups.filter(day__gte=start_date)
+        if end_date:
+            rollups = rollups.filter(day__lte=end_date)
+        totals = {}
+        counted = 0
+        for model in (Transaction, ArchivedTransaction):
+            payments = model.objects.all()
+            if start_date:
+                payments = payments.filter(creation_date__gte=start_date)
+            if end_date:
+                payments = payments.filter(creation_date__lt=end_date +
+                                           datetime.timedelta(days=1))
+            for chunk in chunked_values(payments, ('creation_date', 'amount') +
+                                                  ROLLUP_FIELDS, chunk_size):
+                for row in chunk:
+                    key = (row[0].date(),) + row[2:]
+                    count, amount = totals.get(key, (0, 0))
+                    totals[key] = (count + 1, amount + row[1])
+                counted += len(chunk)
+        rollups.delete()
+        for key, (count, amount) in totals.items():
+            day, current_status, approved, return_code, is_live = key
+            self.create(day=day, current_status=current_status,
+                        approved=approved, return_code=return_code,
+                        is_live=is_live, count=count, amount=amount)
+        return counted
+    rebuild.alters_data = True
+
+
+class DailyRollup(models.Model):
+    """
+    The number and total amount of the Transactions created each day, by
+    status, approval, return code and whether they were live.
+    
+    Kept up to date as Transactions are created, change status and are
+    deleted with settings.SKIPJACK_ROLLUPS, so that totals never need a
+    query over every Transaction. Use the rebuild_skipjack_rollups command
+    to count existing Transactions.
+    
+    """
+    day = models.DateField(db_index=True)
+    current_status = models.PositiveSmallIntegerField(
+                                choices=CURRENT_STATUS_CHOICES)
+    approved = models.CharField(max_length=1, blank=True,
+                                choices=IS_APPROVED_CHOICES)
+    return_code = models.IntegerField(choices=RETURN_CODE_CHOICES)
+    is_live = models.BooleanField()
+    count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    objects = DailyRollupManager()
+    
+    def __unicode__(self):
+        return u"%s %s: %d, %s" % (self.day, self.get_current_status_display(),
+                                   self.count, self.amount)
+    
+    class Meta:
+        ordering = ['-day']
+        unique_together = (('day', 'current_status', 'approved',
+                            'return_code', 'is_live'),)
+
+
+class ArchivedTransaction(BaseTransaction):
+    """
+    A Transaction in a final state, moved out of the Transaction table by
+    the archive_skipjack_transactions command so that the table the site
+    works with stays small. Keeps the id it had as a Transaction.
+    
+    See skipjack.archive.history() for looking up Transactions whether
+    archived or not.
+    
+    """
+    archived_date = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ['-creation_date']
+
+
+class ClosedBatch(models.Model):
+    """
+    Records that a merchant account's batch was closed on a day by the
+    settle_skipjack_transactions command, so that only one run closes it,
+    whichever process it's in. See skipjack.settlement.scheduled_close().
+    
+    """
+    merchant = models.CharField(max_length=30, blank=True)
+    day = models.DateField()
+    response = models.CharField(max_length=30, blank=True)
+    creation_date = models.DateTimeField(auto_now_add=True)
+    
+    def __unicode__(self):
+        return u"%s %s: %s" % (self.merchant, self.day, self.response)
+    
+    class Meta:
+        ordering = ['-day']
+        unique_together = (('merchant', 'day'),)
+
+
+# Precomputed lookups for interpreting the two digit Skipjack status code.
+CURRENT_STATUS_LOOKUP = dict(CURRENT_STATUS_CHOICES)
+PENDING_STATUS_LOOKUP = dict(PENDING_STATUS_CHOICES)
+
+# Date format used by the Transaction Status request.
+STATUS_DATE_FORMAT = '%m/%d/%y %H:%M:%S'
+STATUS_DATE_RE = re.compile(
+    r'(\d{1,2})/(\d{1,2})/(\d{2}) (\d{1,2}):(\d{1,2}):(\d{1,2})$')
+
+
+def parse_status_date(value):
+    """
+    Parse a Transaction Status date, e.g. '10/19/11 13:02:03'.
+    
+    Much cheaper than time.strptime for the common case; two digit years are
+    interpreted the same way strptime does.
+    
+    """
+    match = STATUS_DATE_RE.match(value)
+    if not match:
+        return datetime.datetime.strptime(value, STATUS_DATE_FORMAT)
+    month, day, year, hour, minute, second = map(int, match.groups())
+    if year < 69:
+        year += 2000
+    else:
+        year += 1900
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+def status_message_detail(code):
+    """
+    Interpret a two digit Skipjack status code, e.g. '12' gives
+    'Authorized, Pending Settlement'.
+    
+    """
+    status = []
+    if code[0] != '0':
+        status.append(CURRENT_STATUS_LOOKUP[int(code[0])])
+    if code[1] != '0':
+        status.append(PENDING_STATUS_LOOKUP[int(code[1])])
+    return ', '.join(status)
+
 
 class Status(object):
     """
     A helper object for the Transaction Status function.
     
+    Slotted, and the date, amount and message_detail values are only converted
+    from the Skipjack text on first access, as report-scale status histories
+    can produce a great many of these.
+    
     """
+    __slots__ = ('transaction_id', 'code', 'message', 'order_number',
+                 'approval_code', 'batch_number', '_amount', '_date',
+                 '_message_detail', '_transaction')
+    
     def __init__(self, **kwargs):
         """
         Initialize from the keyword arguments.
         
         """
-        self.transaction_id = None
-        self.amount = None
-        self.code = None
-        self.message = None
-        self.message_detail = None
-        self.order_number = None
-        self.date = None
-        self.approval_code = None
-        self.batch_number = None
+        self.transaction_id = kwargs.get('transaction_id')
+        self.code = kwargs.get('code')
+        self.message = kwargs.get('message')
+        self.order_number = kwargs.get('order_number')
+        self.approval_code = kwargs.get('approval_code')
+        self.batch_number = kwargs.get('batch_number')
+        self._amount = kwargs.get('amount')
+        self._date = kwargs.get('date')
+        self._message_detail = kwargs.get('message_detail')
+    
+    @classmethod
+    def from_row(cls, row):
+        """
+        Build directly from a parsed Transaction Status response row:
+        serial number, amount, status code, status message, order number,
+        date, transaction id, approval code and batch number.
         
-        for key, value in kwargs.iteritems():
-            setattr(self, key, value)
-        # Special properties (we don't want to leave these as text):
-        if type(self.date) is not datetime.datetime:
-            self.date = datetime.datetime.fromtimestamp(
-                time.mktime(time.strptime(self.date, "%m/%d/%y %H:%M:%S")))
-        if type(self.amount) is not Decimal:
-            self.amount = Decimal(self.amount)
-        self.current_status = int(self.code[0])
-        self.pending_status = int(self.code[1])
+        """
+        status = cls.__new__(cls)
+        (_, status._amount, status.code, status.message, status.order_number,
+         status._date, status.transaction_id, status.approval_code,
+         status.batch_number) = row
+        status._message_detail = None
+        return status
+    
+    def _get_amount(self):
+        if self._amount is not None and type(self._amount) is not Decimal:
+            self._amount = Decimal(self._amount)
+        return self._amount
+    
+    def _set_amount(self, value):
+        self._amount = value
+    amount = property(_get_amount, _set_amount)
+    
+    def _get_date(self):
+        if self._date is not None and \
+                                type(self._date) is not datetime.datetime:
+            self._date = parse_status_date(self._date)
+        return self._date
+    
+    def _set_date(self, value):
+        self._date = value
+    date = property(_get_date, _set_date)
+    
+    def _get_message_detail(self):
+        if self._message_detail is None and self.code:
+            self._message_detail = status_message_detail(self.code)
+        return self._message_detail
+    
+    def _set_message_detail(self, value):
+        self._message_detail = value
+    message_detail = property(_get_message_detail, _set_message_detail)
+    
+    @property
+    def current_status(self):
+        return int(self.code[0])
+    
+    @property
+    def pending_status(self):
+        return int(self.code[1])
     
     def __repr__(self):
         return smart_unicode('<Status: %s>' % str(self))
@@ -528,24 +1091,46 @@ class StatusChange(object):
     """
     A helper object for the Change Transaction Status function.
     
+    Slotted, with the amount converted on first access.
+    
     """
+    __slots__ = ('desired_status', 'status', 'message', 'order_number',
+                 'transaction_id', '_amount', '_transaction')
+    
     def __init__(self, **kwargs):
         """
         Initialize from the keyword arguments.
         
         """
-        self.amount = None
-        self.desired_status = None
-        self.status = None  # SUCCESSFUL, UNSUCCESSFUL, or NOT_ALLOWED.
-        self.message = None
-        self.order_number = None
-        self.transaction_id = None
+        self.desired_status = kwargs.get('desired_status')
+        # SUCCESSFUL, UNSUCCESSFUL, or NOT_ALLOWED.
+        self.status = kwargs.get('status')
+        self.message = kwargs.get('message')
+        self.order_number = kwargs.get('order_number')
+        self.transaction_id = kwargs.get('transaction_id')
+        self._amount = kwargs.get('amount')
+    
+    @classmethod
+    def from_row(cls, row):
+        """
+        Build directly from a parsed Change Transaction Status response row:
+        serial number, amount, desired status, status, message, order number
+        and transaction id.
         
-        for key, value in kwargs.iteritems():
-            setattr(self, key, value)
-        # Special properties (we don't want to leave these as text):
-        if type(self.amount) is not Decimal:
-            self.amount = Decimal(self.amount)
+        """
+        change = cls.__new__(cls)
+        (_, change._amount, change.desired_status, change.status,
+         change.message, change.order_number, change.transaction_id) = row
+        return change
+    
+    def _get_amount(self):
+        if self._amount is not None and type(self._amount) is not Decimal:
+            self._amount = Decimal(self._amount)
+        return self._amount
+    
+    def _set_amount(self, value):
+        self._amount = value
+    amount = property(_get_amount, _set_amount)
     
     def __repr__(self):
         return smart_unicode('<ChangeStatus: %s>' % str(self))
@@ -570,4 +1155,3 @@ class StatusChange(object):
             except Transaction.DoesNotExist:
                 self._transaction = None
         return self._transaction
-        
\ No newline at end of file
@@ -0,0 +1,275 @@
+"""
+Processing of the QueuedStatusChange outbox: status changes to make at
+Skipjack outside of the request (and database transaction) that asked for
+them, such as deletes and queued settlements and refunds. See the
+process_skipjack_queue management command.
+
+Deletes are safe to retry: each attempt checks the status at Skipjack
+first. Settlements, credits and additional authorizations aren't, so when a
+request may have reached Skipjack without its response coming back (or a
+worker's lease ran out with it in flight), a settlement is only resent once
+the status shows it wasn't made, and a credit or additional authorization,
+whose effect the status can't show, fails for manual review instead.
+
+Optional settings:
+    SKIPJACK_QUEUE_MAX_ATTEMPTS - tries before an entry fails (default 5).
+
+"""
+import datetime
+import errno
+import socket
+
+from django.conf import settings
+
+from skipjack import signals
+from skipjack.models import Transaction, QueuedStatusChange, \
+                            StatusChange, QUEUED, PROCESSING, DONE, FAILED, \
+                            AUTHORIZED, SETTLED, CREDITED, ARCHIVED, \
+                            SPLIT_SETTLED, SUCCESSFUL, PENDING_SETTLEMENT, \
+                            SUBMITTED_FOR_SETTLEMENT, PENDING_CREDIT, \
+                            status_message_detail
+from skipjack.ratelimit import TokenBucket
+from skipjack.utils import get_transaction_status, change_transaction_status
+from skipjack.workers import imap_unordered, default_workers
+
+
+DEFAULT_MAX_ATTEMPTS = 5
+
+# How long a claimed entry is left to its worker before another may take it.
+LEASE = datetime.timedelta(minutes=10)
+
+# Delay before the first retry, doubled for each attempt after that.
+RETRY_DELAY = datetime.timedelta(minutes=1)
+
+# Errors raised before a connection was made, so before anything was sent.
+UNSENT_ERRNOS = (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH)
+
+UNKNOWN_OUTCOME = 'May have been made at Skipjack, check before requeueing'
+
+
+def claim(limit):
+    """
+    Claims up to `limit` entries that are due, returning them.
+
+    Each entry is claimed with a conditional UPDATE, so that several workers
+    can drain the outbox at once without making the same change twice. An
+    entry whose worker died is claimable again once its lease runs out, and
+    is marked as `reclaimed`, as its change may have been made.
+
+    """
+    now = datetime.datetime.now()
+    lease = now + LEASE
+    claimed = []
+    due = QueuedStatusChange.objects.filter(state__in=(QUEUED, PROCESSING),
+                                            next_attempt__lte=now)
+    for entry in due[:limit]:
+        if QueuedStatusChange.objects.filter(
+                pk=entry.pk, state=entry.state,
+                next_attempt=entry.next_attempt).update(state=PROCESSING,
+                                                        next_attempt=lease):
+            entry.reclaimed = entry.state == PROCESSING
+            entry.state = PROCESSING
+            entry.next_attempt = lease
+            claimed.append(entry)
+    return claimed
+
+
+def perform_delete(entry):
+    """
+    Deletes the transaction at Skipjack, if its current status allows.
+
+    Mirrors Transaction.get_status() followed by
+    Transaction.delete_transaction().
+
+    """
+    if entry.transaction_id and not entry.is_approved:
+        transaction_id = entry.transaction_id
+    else:
+        transaction_id = None
+    status = get_transaction_status(entry.order_number,
+                                    transaction_id=transaction_id,
+                                    merchant=entry.merchant)
+    if status is None:
+        return None, 'Transaction not found at Skipjack'
+    if status.current_status in (SETTLED, CREDITED, ARCHIVED, SPLIT_SETTLED):
+        return None, 'Deletion not allowed for %s transactions' % \
+                                                        status.message_detail
+    transaction_id = entry.transaction_id
+    if status.transaction_id != transaction_id and \
+                                    status.approval_code == entry.auth_code:
+        transaction_id = status.transaction_id
+    return change_transaction_status(transaction_id, 'DELETE',
+                                     merchant=entry.merchant), None
+
+
+def perform_settle(entry):
+    """
+    Settles the transaction. If an earlier attempt may have reached
+    Skipjack, it's only settled if its status shows that attempt didn't.
+
+    """
+    if entry.attempts or getattr(entry, 'reclaimed', False):
+        status = get_transaction_status(entry.order_number,
+                                        transaction_id=entry.transaction_id,
+                                        merchant=entry.merchant)
+        if status is None:
+            return None, 'Transaction not found at Skipjack'
+        if status.current_status == SETTLED or status.pending_status in (
+                            PENDING_SETTLEMENT, SUBMITTED_FOR_SETTLEMENT):
+            # Made by the earlier attempt.
+            return StatusChange(desired_status=entry.desired_status,
+                                status=SUCCESSFUL,
+                                message='Already submitted for settlement',
+                                order_number=entry.order_number,
+                                transaction_id=entry.transaction_id), None
+        if (status.current_status, status.pending_status) != (AUTHORIZED, 0):
+            return None, 'Settlement not allowed for %s transactions' % \
+                                                        status.message_detail
+        if getattr(entry, 'reclaimed', False):
+            # Its worker may yet make the request.
+            return None, UNKNOWN_OUTCOME
+    return perform_change(entry)
+
+
+def perform_change(entry):
+    """
+    Makes a settle, credit or authorize additional change, unless an
+    earlier attempt's worker lost its lease, as it may have been made.
+
+    """
+    if getattr(entry, 'reclaimed', False):
+        return None, UNKNOWN_OUTCOME
+    return change_transaction_status(entry.transaction_id,
+                                     entry.desired_status,
+                                     entry.amount,
+                                     entry.force_settlement,
+                                     entry.merchant), None
+
+
+PERFORMERS = {
+    'DELETE': perform_delete,
+    'SETTLE': perform_settle,
+    'CREDIT': perform_change,
+    'AuthorizeAdditional': perform_change,
+}
+
+# The pending status a Transaction is marked with once a change is made.
+PENDING_STATUSES = {
+    'SETTLE': SUBMITTED_FOR_SETTLEMENT,
+    'CREDIT': PENDING_CREDIT,
+}
+
+
+def perform(entry):
+    """
+    Makes the entry's change at Skipjack, for imap_unordered().
+
+    Returns a tuple of (StatusChange or None, message).
+
+    """
+    return PERFORMERS[entry.desired_status](entry)
+
+
+def mark_transaction(entry):
+    """Marks the entry's Transaction as pending the change just made."""
+    pending_status = PENDING_STATUSES.get(entry.desired_status)
+    if entry.payment_id is None or pending_status is None:
+        return
+    try:
+        payment = Transaction.objects.get(pk=entry.payment_id)
+    except Transaction.DoesNotExist:
+        return
+    payment.pending_status = pending_status
+    payment.status_text = status_message_detail(
+                            '%d%d' % (payment.current_status, pending_status))
+    # Only these fields, so as not to overwrite anything changed meanwhile.
+    Transaction.objects.filter(pk=payment.pk).update(
+                                        pending_status=payment.pending_status,
+                                        status_text=payment.status_text)
+    signals.payment_status_changed.send(sender=Transaction, instance=payment)
+
+
+def unsent(exc):
+    """If the error means the request can't have reached Skipjack."""
+    if isinstance(exc, socket.gaierror):
+        return True
+    return isinstance(exc, EnvironmentError) and exc.errno in UNSENT_ERRNOS
+
+
+def retryable(entry, exc):
+    """If the change can be tried again after the error."""
+    if entry.desired_status in ('DELETE', 'SETTLE'):
+        # Checked at Skipjack before they're made again.
+        return True
+    return unsent(exc)
+
+
+def record(entry, result, error, max_attempts):
+    """Records the outcome of perform() on the entry."""
+    entry.attempts += 1
+    if error:
+        entry.message = str(error[1])[:255]
+        if entry.attempts >= max_attempts:
+            entry.state = FAILED
+        elif not retryable(entry, error[1]):
+            entry.state = FAILED
+            entry.message = ('%s: %s' % (UNKNOWN_OUTCOME, error[1]))[:255]
+        else:
+            # Try again later.
+            entry.state = QUEUED
+            entry.next_attempt = datetime.datetime.now() + \
+                                    RETRY_DELAY * 2 ** (entry.attempts - 1)
+    else:
+        change, message = result
+        if change is None:
+            entry.state = FAILED
+            entry.message = (message or 'No response from Skipjack')[:255]
+        else:
+            entry.status = change.status
+            entry.message = (change.message or '')[:255]
+            if change.status == SUCCESSFUL:
+                entry.state = DONE
+                mark_transaction(entry)
+            else:
+                entry.state = FAILED
+    if entry.state in (DONE, FAILED):
+        # Free up the key, so the same change can be queued again.
+        entry.key = '%s#%d' % (entry.key, entry.pk)
+    entry.save()
+
+
+def process(limit=None, workers=None, max_attempts=None, rate=None):
+    """
+    Claims and processes due entries, `workers` at a time, until there are
+    none left (or `limit` have been processed). With `rate`, no more than
+    that many entries are processed per second.
+
+    Returns a dict of counts of the entries now DONE, FAILED and QUEUED
+    (for a retry).
+
+    """
+    workers = workers or default_workers()
+    max_attempts = max_attempts or getattr(settings,
+                                           'SKIPJACK_QUEUE_MAX_ATTEMPTS',
+                                           DEFAULT_MAX_ATTEMPTS)
+    if rate:
+        bucket = TokenBucket(rate)
+        def run(entry):
+            bucket.acquire()
+            return perform(entry)
+    else:
+        run = perform
+    counts = {DONE: 0, FAILED: 0, QUEUED: 0}
+    processed = 0
+    while limit is None or processed < limit:
+        batch_size = workers * 10
+        if limit is not None:
+            batch_size = min(batch_size, limit - processed)
+        entries = claim(batch_size)
+        if not entries:
+            break
+        for entry, result, error in imap_unordered(run, entries, workers):
+            record(entry, result, error, max_attempts)
+            counts[entry.state] += 1
+        processed += len(entries)
+    return counts
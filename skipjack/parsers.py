@@ -0,0 +1,414 @@
+"""
+Parsers for the responses returned by the Skipjack endpoints.
+
+Each response layout is declared once below, and every parser works straight
+from the raw response buffer (no intermediate list of lines).
+
+"""
+from array import array
+import calendar
+from cStringIO import StringIO
+import csv
+import datetime
+from decimal import Decimal
+import re
+
+from skipjack.models import Status, StatusChange, TransactionError
+
+
+class Layout(object):
+    """
+    Declares the columns of a Skipjack CSV response.
+
+    Rows that don't have exactly the declared number of columns (width) are
+    ignored, as Skipjack uses short rows to return textual error descriptions.
+    Only the leading columns we use need to be named.
+
+    """
+    def __init__(self, name, columns, width=None, header=True):
+        self.name = name
+        self.columns = tuple(columns)
+        self.width = width or len(self.columns)
+        self.header = header
+
+    def rows(self, response):
+        """Yields the rows of the raw response matching this layout."""
+        reader = csv.reader(StringIO(response.strip()),
+                            delimiter=',', quotechar='"')
+        if self.header:
+            next(reader, None)
+        width = self.width
+        for row in reader:
+            if len(row) == width:
+                yield row
+
+    def to_dict(self, row):
+        """Maps a row onto the declared column names."""
+        return dict(zip(self.columns, row))
+
+
+# Transaction Status request: a header, then one row per transaction relating
+# to the order number.
+STATUS_LAYOUT = Layout('status', ('serial_number', 'amount', 'code',
+                                  'message', 'order_number', 'date',
+                                  'transaction_id', 'approval_code',
+                                  'batch_number'))
+
+# Change Transaction Status request: a header, then the response detail OR a
+# textual description of an error.
+CHANGE_STATUS_LAYOUT = Layout('change_status', ('serial_number', 'amount',
+                                                'desired_status', 'status',
+                                                'message', 'order_number',
+                                                'transaction_id'))
+
+# Close Current Batch request: a single twelve column row, no header.
+CLOSE_BATCH_LAYOUT = Layout('close_batch', ('serial_number', 'status'),
+                            width=12, header=False)
+
+
+def parse_authorize(response):
+    """
+    Parses the AuthorizeAPI response: a line of field names followed by a
+    line of values. Returns a dict keyed on the Skipjack field names.
+
+    """
+    rows = csv.reader(StringIO(response), delimiter=',', quotechar='"')
+    return dict(zip(*[row for row in rows]))
+
+
+def parse_status(response):
+    """Returns a list of Status objects from a Transaction Status response."""
+    return [Status.from_row(row) for row in STATUS_LAYOUT.rows(response)]
+
+
+def parse_change_status(response):
+    """
+    Returns a StatusChange from a Change Transaction Status response, or
+    None if Skipjack returned an error description instead.
+
+    """
+    change = None
+    for row in CHANGE_STATUS_LAYOUT.rows(response):
+        change = StatusChange.from_row(row)
+    return change
+
+
+def parse_close_batch(response):
+    """Returns a dict from a Close Current Batch response, or None."""
+    for row in CLOSE_BATCH_LAYOUT.rows(response):
+        return CLOSE_BATCH_LAYOUT.to_dict(row)
+    return None
+
+
+REPORT_BEGIN_DATA = '<!-- Begin Data -->'
+REPORT_END_DATA = '<!-- End Data -->'
+
+REPORT_DATE_RE = re.compile(r"""
+    (?P<month>\d{1,2})/(?P<day>\d{1,2})/(?P<year>\d{4})\s
+    (?P<hour>\d{1,2}):(?P<minute>\d{1,2}):(?P<second>\d{1,2})\s
+    (?P<am_pm>AM|PM)""", re.VERBOSE)
+
+
+def report_amount(value):
+    """Report API returns $123.45 and ($123.45) for currency fields."""
+    if not value:
+        return None
+    if value[0] == '(':
+        return Decimal('-%s' % value[2:-1])
+    return Decimal(value[1:])
+
+
+def report_date(value):
+    """
+    Report API returns dates as 10/19/2011 1:02:03 PM.
+
+    NB: Could just be lazy and use the dateutil.parser module,
+    but I'd rather avoid introducing the dependency.
+
+    """
+    match = REPORT_DATE_RE.match(value)
+    if not match:
+        return None
+    month, day, year, hour, minute, second, am_pm = match.groups()
+    hour = int(hour) % 12
+    if am_pm == 'PM':
+        hour += 12
+    return datetime.datetime(int(year), int(month), int(day), hour,
+                             int(minute), int(second))
+
+
+def report_converter(header):
+    """Returns the converter for values in the given report column."""
+    if header[-6:] == 'Amount':
+        return report_amount
+    if header[-4:] == 'Date':
+        return report_date
+    return None
+
+
+def report_cents(value):
+    """As report_amount(), but as integer cents (0 if blank)."""
+    if not value:
+        return 0
+    if value[0] == '(':
+        sign, value = -1, value[2:-1]
+    else:
+        sign, value = 1, value[1:]
+    dollars, _, cents = value.partition('.')
+    return sign * (int(dollars or 0) * 100 + int((cents + '00')[:2]))
+
+
+def report_timestamp(value):
+    """
+    As report_date(), but as seconds since the epoch, taking the time as
+    UTC (0 if blank).
+
+    """
+    match = REPORT_DATE_RE.match(value)
+    if not match:
+        return 0
+    month, day, year, hour, minute, second, am_pm = match.groups()
+    hour = int(hour) % 12
+    if am_pm == 'PM':
+        hour += 12
+    return calendar.timegm((int(year), int(month), int(day), hour,
+                            int(minute), int(second)))
+
+
+# The array type of the status columns' codes, and the largest code it holds.
+STATUS_TYPECODE = 'H'
+MAX_STATUS_CODE = 0xFFFF
+
+
+class ReportColumns(object):
+    """
+    Customized report data held by column rather than as a dict per row,
+    for aggregating large reports.
+
+    Each column is indexed by its report header:
+        Amount columns are arrays of integer cents.
+        Date columns are arrays of seconds since the epoch (UTC).
+        Status columns are arrays of 16 bit integer codes, labels[header]
+        being the list of the statuses they stand for.
+        Other columns are lists of strings.
+
+    Blank amounts and dates are 0.
+
+    """
+    def __init__(self, headers=()):
+        self.headers = []
+        self.columns = {}
+        self.labels = {}
+        self._codes = {}
+        self.length = 0
+        for header in headers:
+            if header:
+                self.add_column(header)
+
+    def add_column(self, header):
+        """Adds an empty column, blank for the rows so far."""
+        self.headers.append(header)
+        if header[-6:] == 'Status':
+            self.columns[header] = array(STATUS_TYPECODE)
+            self.labels[header] = []
+            self._codes[header] = {}
+        elif header[-6:] == 'Amount' or header[-4:] == 'Date':
+            self.columns[header] = array('l')
+        else:
+            self.columns[header] = []
+        self.pad(header, self.length)
+
+    def pad(self, header, count):
+        """Appends count blank values to the column."""
+        if count:
+            convert = self.converter(header)
+            blank = convert('') if convert else ''
+            self.columns[header].extend([blank] * count)
+
+    def converter(self, header):
+        """Returns the function converting values for the column."""
+        if header[-6:] == 'Amount':
+            return report_cents
+        if header[-4:] == 'Date':
+            return report_timestamp
+        if header[-6:] == 'Status':
+            codes, labels = self._codes[header], self.labels[header]
+            def code(value):
+                try:
+                    return codes[value]
+                except KeyError:
+                    if len(labels) > MAX_STATUS_CODE:
+                        raise ValueError('More than %d distinct values in '
+                                         'the %s column.' % (
+                                            MAX_STATUS_CODE + 1, header))
+                    codes[value] = len(labels)
+                    labels.append(value)
+                    return codes[value]
+            return code
+        return None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, header):
+        return self.columns[header]
+
+    def extend(self, other):
+        """Appends the rows of another ReportColumns."""
+        for header in other.headers:
+            if header not in self.columns:
+                self.add_column(header)
+        for header in self.headers:
+            column = self.columns[header]
+            if header not in other.columns:
+                self.pad(header, other.length)
+            elif header in self.labels:
+                # Codes are per instance, so translate them.
+                code = self.converter(header)
+                codes = [code(label) for label in other.labels[header]]
+                column.extend(array(STATUS_TYPECODE, [codes[i]
+                                          for i in other.columns[header]]))
+            else:
+                column.extend(other.columns[header])
+        self.length += other.length
+
+    def to_numpy(self):
+        """
+        Returns the columns as a NumPy structured array. Raises ImportError
+        if NumPy isn't installed.
+
+        """
+        import numpy
+        dtype = []
+        for header in self.headers:
+            column = self.columns[header]
+            if header in self.labels:
+                dtype.append((header, numpy.uint16))
+            elif isinstance(column, array):
+                dtype.append((header, numpy.int64))
+            else:
+                dtype.append((header, object))
+        result = numpy.empty(self.length, dtype=dtype)
+        for header in self.headers:
+            result[header] = self.columns[header]
+        return result
+
+
+def report_data(response):
+    """
+    Extracts the CSV data between the Begin/End Data report markers, or
+    returns None if they're missing (e.g. for an error page).
+
+    """
+    start = response.find(REPORT_BEGIN_DATA)
+    end = response.find(REPORT_END_DATA, start)
+    if start == -1 or end == -1:
+        return None
+    data = response[start + len(REPORT_BEGIN_DATA):end]
+    return data.replace('<br>\r\n', '\n').strip()
+
+
+def report_data_chunks(chunks):
+    """
+    As report_data(), but scanning the response as an iterable of chunks,
+    so that only the data (not the whole page) is held in memory.
+
+    """
+    begin_length = len(REPORT_BEGIN_DATA)
+    # Enough of the end of each chunk to hold a marker split across chunks.
+    overlap = max(begin_length, len(REPORT_END_DATA)) - 1
+    parts = []
+    buffer = ''
+    started = False
+    for chunk in chunks:
+        buffer += chunk
+        if not started:
+            start = buffer.find(REPORT_BEGIN_DATA)
+            if start == -1:
+                buffer = buffer[-overlap:]
+                continue
+            started = True
+            buffer = buffer[start + begin_length:]
+        end = buffer.find(REPORT_END_DATA)
+        if end != -1:
+            parts.append(buffer[:end])
+            return ''.join(parts).replace('<br>\r\n', '\n').strip()
+        if len(buffer) > overlap:
+            parts.append(buffer[:-overlap])
+            buffer = buffer[-overlap:]
+    return None
+
+
+def parse_report_data(data, columnar=False):
+    """
+    Parses the CSV data of a customized report into a list of dicts keyed
+    on the report column headers, with amounts as Decimals and dates as
+    datetime.datetime objects.
+
+    With columnar, returns a ReportColumns instead.
+
+    """
+    return parse_report_lines(StringIO(data), columnar)
+
+
+def parse_report_lines(lines, columnar=False):
+    """
+    As parse_report_data(), but reading the CSV from an iterable of lines,
+    such as an open file.
+
+    """
+    reader = csv.reader(lines, delimiter=',', quotechar='"')
+    headers = next(reader, None)
+    if columnar:
+        return parse_report_columns(headers or (), reader)
+    if not headers:
+        return []
+    # Work out the conversion for each column once, not once per cell.
+    columns = [(i, header, report_converter(header))
+               for i, header in enumerate(headers) if header]
+    response_list = []
+    for row in reader:
+        as_dict = {}
+        for i, header, convert in columns:
+            if i >= len(row):
+                break
+            if convert:
+                as_dict[header] = convert(row[i])
+            else:
+                as_dict[header] = row[i]
+        response_list.append(as_dict)
+    return response_list
+
+
+def parse_report_columns(headers, reader):
+    """Reads the rows of a customized report into a ReportColumns."""
+    report = ReportColumns(headers)
+    columns = [(i, report.columns[header].append, report.converter(header))
+               for i, header in enumerate(headers) if header]
+    length = 0
+    for row in reader:
+        width = len(row)
+        for i, append, convert in columns:
+            value = row[i] if i < width else ''
+            if convert:
+                append(convert(value))
+            else:
+                append(value)
+        length += 1
+    report.length = length
+    return report
+
+
+def parse_report(response, columnar=False):
+    """
+    Parses a Customized Report API response into a list of dicts, or with
+    columnar, a ReportColumns.
+
+    Raises TransactionError if the response isn't a report (it's missing the
+    Begin/End Data markers, e.g. an error or login page).
+
+    """
+    data = report_data(response)
+    if data is None:
+        raise TransactionError('Skipjack did not return a report.')
+    return parse_report_data(data, columnar)
@@ -0,0 +1,170 @@
+"""
+Pre-warming of the connections to Skipjack, so that the first requests after
+a deploy or worker restart don't pay for DNS, the TCP connection and the TLS
+handshake while a customer waits.
+
+prewarm() opens SKIPJACK_PREWARM_CONNECTIONS connections to the host of each
+of the SKIPJACK_PREWARM_ENDPOINTS, for every merchant account, and puts them
+in the transport's pools. It then keeps them warm in the background:
+connections left idle for SKIPJACK_PREWARM_REFRESH seconds are replaced with
+new ones before Skipjack can time them out, and any that were used up are
+reopened.
+
+It's opt-in. Call it from the WSGI script, once the application is loaded:
+
+    from skipjack.prewarm import prewarm
+    prewarm()
+
+Servers that fork their workers from a master process should call it in each
+worker after the fork instead (e.g. gunicorn's post_fork hook), as the
+connections and the background thread are not shared with forked processes.
+
+Optional settings:
+    SKIPJACK_PREWARM_CONNECTIONS - connections kept warm per host (default
+        2, at most the pool size).
+    SKIPJACK_PREWARM_ENDPOINTS - the endpoints whose hosts are warmed
+        (default ('authorize',)), from authorize, status, change_status,
+        close_batch and report.
+    SKIPJACK_PREWARM_REFRESH - seconds a warm connection may sit idle before
+        it's replaced (default 60), or 0 not to keep them warm.
+
+"""
+import logging
+import threading
+import urlparse
+
+from django.conf import settings
+
+from skipjack import transport
+from skipjack.merchants import merchant_names
+
+
+DEFAULT_PREWARM_CONNECTIONS = 2
+DEFAULT_PREWARM_ENDPOINTS = ('authorize',)
+DEFAULT_PREWARM_REFRESH = 60
+
+logger = logging.getLogger('skipjack')
+
+
+def endpoint_urls(endpoints, merchant=None):
+    """The urls of the named endpoints, e.g. ['authorize']."""
+    from skipjack.helpers import PaymentHelper, StatusHelper, \
+                                 ChangeStatusHelper, CloseBatchHelper, \
+                                 ReportHelper
+    helpers = dict((helper.name, helper) for helper in (
+                        PaymentHelper, StatusHelper, ChangeStatusHelper,
+                        CloseBatchHelper, ReportHelper))
+    urls = []
+    for endpoint in endpoints:
+        if endpoint not in helpers:
+            raise ValueError('Unknown Skipjack endpoint %r.' % endpoint)
+        urls.append(helpers[endpoint]([], merchant).endpoint)
+    return urls
+
+
+def get_pools(endpoints=None, merchants=None):
+    """
+    The transport's pools for the hosts of the endpoints, for each of the
+    merchant accounts (by default every configured one).
+
+    """
+    if endpoints is None:
+        endpoints = getattr(settings, 'SKIPJACK_PREWARM_ENDPOINTS',
+                            DEFAULT_PREWARM_ENDPOINTS)
+    if merchants is None:
+        merchants = merchant_names()
+    pools = []
+    for merchant in merchants:
+        for url in endpoint_urls(endpoints, merchant):
+            scheme, host = urlparse.urlsplit(url)[:2]
+            pool = transport.get_pool(scheme, host, merchant)
+            if pool not in pools:
+                pools.append(pool)
+    return pools
+
+
+def warm(pools, connections):
+    """
+    Tops each pool up to `connections` idle connections, returning the
+    number opened. Failures are logged, not raised.
+
+    """
+    opened = 0
+    for pool in pools:
+        try:
+            opened += pool.warm(connections)
+        except Exception:
+            logger.warning('Could not open a connection to %s', pool.host,
+                           exc_info=True)
+    return opened
+
+
+class Refresher(object):
+    """
+    Keeps the pools warm on a background thread, replacing connections that
+    have been idle for `max_idle` seconds and topping the pools back up to
+    `connections`, every `max_idle / 2` seconds.
+
+    """
+    def __init__(self, pools, connections, max_idle):
+        self.pools = pools
+        self.connections = connections
+        self.max_idle = max_idle
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,
+                                       name='skipjack-prewarm')
+        self.thread.setDaemon(True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.max_idle / 2.0)
+            if self.stopped.isSet():
+                return
+            self.refresh()
+
+    def refresh(self):
+        for pool in self.pools:
+            pool.expire(self.max_idle)
+        return warm(self.pools, self.connections)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+_refresher = None
+
+
+def prewarm(connections=None, endpoints=None, merchants=None, refresh=None):
+    """
+    Opens the warm connections to Skipjack, see above, returning the number
+    opened. Arguments not given are taken from the settings.
+
+    Calling it again replaces the background refresher of an earlier call.
+
+    """
+    global _refresher
+    if connections is None:
+        connections = getattr(settings, 'SKIPJACK_PREWARM_CONNECTIONS',
+                              DEFAULT_PREWARM_CONNECTIONS)
+    if refresh is None:
+        refresh = getattr(settings, 'SKIPJACK_PREWARM_REFRESH',
+                          DEFAULT_PREWARM_REFRESH)
+    pools = get_pools(endpoints, merchants)
+    opened = warm(pools, connections)
+    stop()
+    if refresh:
+        _refresher = Refresher(pools, connections, refresh)
+        _refresher.start()
+    return opened
+
+
+def stop():
+    """Stops keeping the connections warm."""
+    global _refresher
+    if _refresher is not None:
+        _refresher.stop()
+        _refresher = None
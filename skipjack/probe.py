@@ -0,0 +1,142 @@
+"""
+Latency probing of the Skipjack endpoints, see the skipjack_probe management
+command.
+
+Requests are made over connections of their own, rather than the transport's
+pool, so that each phase of a request can be timed: the TCP connect, the TLS
+handshake, the wait for the first byte of the response and the total.
+
+"""
+import httplib
+import math
+import socket
+import ssl
+import threading
+import time
+import urllib2
+import urlparse
+
+from django.conf import settings
+
+from skipjack import ratelimit
+from skipjack.transport import HEADERS
+from skipjack.workers import imap_unordered
+
+
+PHASES = ('connect', 'tls', 'first_byte', 'total')
+
+
+def open_connection(url, timeout=None):
+    """
+    Opens a connection to the url's host, returning a tuple of the
+    connection and the seconds taken to connect, and for the TLS handshake.
+
+    """
+    parts = urlparse.urlsplit(url)
+    https = parts.scheme == 'https'
+    port = parts.port or (443 if https else 80)
+    started = time.time()
+    sock = socket.create_connection((parts.hostname, port), timeout)
+    connected = time.time()
+    if https:
+        if hasattr(ssl, 'create_default_context'):
+            sock = ssl.create_default_context().wrap_socket(
+                                        sock, server_hostname=parts.hostname)
+        else:
+            sock = ssl.wrap_socket(sock)
+        connection = httplib.HTTPSConnection(parts.netloc, timeout=timeout)
+    else:
+        connection = httplib.HTTPConnection(parts.netloc, timeout=timeout)
+    connection.sock = sock
+    return connection, connected - started, time.time() - connected
+
+
+def timed_post(url, data, connection=None, timeout=None):
+    """
+    POSTs the data to the url, over the given connection or a new one.
+
+    Returns a tuple of a dict of the seconds each of the PHASES took, and
+    the connection if it may be reused (otherwise it's closed, and None).
+
+    """
+    timings = {'connect': 0.0, 'tls': 0.0}
+    started = time.time()
+    if connection is None:
+        connection, timings['connect'], timings['tls'] = open_connection(
+                                                                url, timeout)
+    parts = urlparse.urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path = '%s?%s' % (path, parts.query)
+    try:
+        sent = time.time()
+        connection.request('POST', path, data, HEADERS)
+        response = connection.getresponse()
+        timings['first_byte'] = time.time() - sent
+        response.read()
+    except:
+        connection.close()
+        raise
+    timings['total'] = time.time() - started
+    if response.status != 200:
+        connection.close()
+        raise urllib2.HTTPError(url, response.status, response.reason,
+                                response.msg, None)
+    if response.will_close:
+        connection.close()
+        connection = None
+    return timings, connection
+
+
+def probe(url, data, requests=10, workers=1, reuse=False, endpoint=None,
+          merchant=None):
+    """
+    Makes `requests` POSTs of the data to the url, `workers` at a time,
+    each over a new connection or, with reuse, over the connection its
+    worker last used. Requests to a named endpoint are kept within its rate
+    limit, see skipjack.ratelimit.
+
+    Returns a dict of the list of timings of each of the PHASES, the number
+    of 'errors' and the wall clock 'seconds' taken.
+
+    """
+    timeout = getattr(settings, 'SKIPJACK_TIMEOUT', None)
+    local = threading.local()
+    opened = []
+    def run(i):
+        if endpoint:
+            ratelimit.acquire(endpoint, merchant)
+        previous = getattr(local, 'connection', None)
+        local.connection = None
+        timings, connection = timed_post(url, data, previous, timeout)
+        if connection is not None and reuse:
+            if connection is not previous:
+                opened.append(connection)
+            local.connection = connection
+        elif connection is not None:
+            connection.close()
+        return timings
+    results = dict((phase, []) for phase in PHASES)
+    results['errors'] = 0
+    started = time.time()
+    try:
+        for i, timings, error in imap_unordered(run, xrange(requests),
+                                                workers):
+            if error:
+                results['errors'] += 1
+                continue
+            for phase in PHASES:
+                results[phase].append(timings[phase])
+    finally:
+        for connection in opened:
+            connection.close()
+    results['seconds'] = time.time() - started
+    return results
+
+
+def percentile(values, fraction):
+    """The nearest rank percentile of the values, e.g. 0.9 for the 90th."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, int(math.ceil(fraction * len(values))) - 1)]
@@ -0,0 +1,167 @@
+"""
+Client side rate limiting of requests to Skipjack.
+
+Every request the helpers make goes through the limit configured for its
+endpoint ('authorize', 'status', 'change_status', 'close_batch' or
+'report'), if there is one. Each merchant account (see skipjack.merchants)
+has a budget of its own, set by its RATE_LIMITS or else by
+SKIPJACK_RATE_LIMITS.
+
+Optional settings:
+    SKIPJACK_RATE_LIMITS - requests per second for each endpoint, either a
+        number or a (rate, burst) tuple, e.g.
+            {'authorize': 10, 'status': (5, 20), 'report': 1}
+        Endpoints not listed aren't limited.
+    SKIPJACK_RATE_LIMIT_CACHE - the name of a cache (in CACHES) to share the
+        limits through, so that every process using it shares one budget.
+        It must be memcached: the other backends' incr() isn't atomic across
+        processes. By default each process has its own budget.
+
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from skipjack.merchants import get_merchant
+
+
+def wait_for(take, tokens=1):
+    """
+    Blocks until take(tokens), a bucket's take() method, returns 0, meaning
+    the tokens were taken.
+
+    """
+    wait = take(tokens)
+    while wait:
+        time.sleep(wait)
+        wait = take(tokens)
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket allowing `rate` requests per second on
+    average, in bursts of up to `capacity` requests.
+
+    take() takes tokens if available, returning 0, otherwise returns the
+    number of seconds until they will be. acquire() blocks until they are.
+
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1, rate))
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self, tokens=1):
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+        finally:
+            self.lock.release()
+
+    def acquire(self, tokens=1):
+        wait_for(self.take, tokens)
+
+
+class SharedBucket(object):
+    """
+    Allows `rate` requests per second on average, in bursts of up to
+    `capacity` requests, across every process sharing the cache, with the
+    same take() and acquire() as TokenBucket.
+
+    The token bucket is approximated by allowing `capacity` requests in each
+    window of capacity / rate seconds, counted with the cache's add() and
+    incr(). Those are only atomic with memcached; the database, file and
+    local memory caches read and then write the count, so concurrent
+    requests can exceed the limit.
+
+    """
+    def __init__(self, key, rate, capacity=None, cache=None):
+        self.key = key
+        self.rate = float(rate)
+        self.capacity = int(capacity or max(1, rate))
+        self.window = self.capacity / self.rate
+        self.cache = cache
+
+    def take(self, tokens=1):
+        now = time.time()
+        slot = int(now / self.window)
+        key = '%s:%d' % (self.key, slot)
+        self.cache.add(key, 0, int(self.window) + 1)
+        try:
+            count = self.cache.incr(key, tokens)
+        except ValueError:
+            # Expired between the add() and the incr().
+            self.cache.set(key, tokens, int(self.window) + 1)
+            count = tokens
+        if count <= self.capacity:
+            return 0
+        return (slot + 1) * self.window - now
+
+    def acquire(self, tokens=1):
+        wait_for(self.take, tokens)
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def make_bucket(endpoint, limit, merchant=None):
+    """Builds the bucket for an endpoint's configured limit."""
+    if isinstance(limit, (tuple, list)):
+        rate, capacity = limit
+    else:
+        rate, capacity = limit, None
+    cache_name = getattr(settings, 'SKIPJACK_RATE_LIMIT_CACHE', None)
+    if cache_name:
+        from django.core.cache import get_cache
+        key = 'skipjack-rate-limit:%s' % endpoint
+        if merchant:
+            key = '%s:%s' % (key, merchant)
+        return SharedBucket(key, rate, capacity, get_cache(cache_name))
+    return TokenBucket(rate, capacity)
+
+
+def get_bucket(endpoint, merchant=None):
+    """
+    Returns the bucket limiting the endpoint for the merchant account, or
+    None if not limited.
+
+    """
+    key = (endpoint, merchant or '')
+    try:
+        return _buckets[key]
+    except KeyError:
+        pass
+    _buckets_lock.acquire()
+    try:
+        if key not in _buckets:
+            limit = get_merchant(merchant).get('RATE_LIMITS',
+                                               {}).get(endpoint)
+            if limit:
+                _buckets[key] = make_bucket(endpoint, limit, merchant)
+            else:
+                _buckets[key] = None
+        return _buckets[key]
+    finally:
+        _buckets_lock.release()
+
+
+def acquire(endpoint, merchant=None):
+    """
+    Blocks until a request to the endpoint for the merchant account is
+    within its limit.
+
+    """
+    bucket = get_bucket(endpoint, merchant)
+    if bucket is not None:
+        bucket.acquire()
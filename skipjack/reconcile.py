@@ -0,0 +1,92 @@
+"""
+Reconciliation of the settlement batches at Skipjack with the Transactions
+in the database, see the reconcile_skipjack_batches management command.
+
+The count and total of the sales in each batch, according to the Customized
+Report for a range of dates, are compared with the count and total of the
+Transactions (and ArchivedTransactions) of the same dates with that
+batch_number, which is recorded as their status is synced. Both sides are
+aggregated a batch at a time, the report by column and the database with a
+GROUP BY, so nothing is looked up per transaction.
+
+Credits are reported as transactions of their own, with negative amounts,
+and aren't counted.
+
+"""
+import datetime
+from decimal import Decimal
+
+from django.db.models import Count, Sum
+
+from skipjack.models import Transaction, ArchivedTransaction
+from skipjack.utils import transaction_reports
+
+
+BATCH_FIELD = 'BatchNumber'
+
+
+def report_batches(start_date, end_date, merchant=None, **kwargs):
+    """
+    Returns a dict of batch number to the (count, total in cents) of the
+    sales in the merchant account's reports for start_date..end_date.
+    kwargs are passed on to transaction_reports().
+
+    """
+    report = transaction_reports(start_date, end_date,
+                                 extra_fields=(BATCH_FIELD,), columnar=True,
+                                 merchant=merchant, **kwargs)
+    batches = {}
+    if BATCH_FIELD not in report.columns or 'Amount' not in report.columns:
+        return batches
+    for batch, cents in zip(report[BATCH_FIELD], report['Amount']):
+        if batch and cents > 0:
+            count, total = batches.get(batch, (0, 0))
+            batches[batch] = (count + 1, total + cents)
+    return batches
+
+
+def local_batches(start_date, end_date, merchant=None):
+    """
+    Returns a dict of batch number to the (count, total in cents) of the
+    merchant account's Transactions and ArchivedTransactions created
+    start_date..end_date.
+
+    """
+    batches = {}
+    for model in (Transaction, ArchivedTransaction):
+        rows = model.objects.filter(
+                    merchant=merchant or '', amount__gt=0,
+                    creation_date__gte=start_date,
+                    creation_date__lt=end_date + datetime.timedelta(days=1)
+                ).exclude(batch_number='').values('batch_number').annotate(
+                    count=Count('pk'), total=Sum('amount')).order_by()
+        for row in rows:
+            count, total = batches.get(row['batch_number'], (0, 0))
+            batches[row['batch_number']] = (
+                count + row['count'],
+                total + int(Decimal(str(row['total'])) * 100))
+    return batches
+
+
+def discrepancies(reported, local):
+    """
+    Compares the batches of report_batches() and local_batches(), returning
+    a list of (batch number, reported, local) for the batches that differ,
+    in batch number order. A batch missing from either side is None there.
+
+    """
+    # Items in just one of the two sets are missing or different.
+    differ = set(reported.iteritems()) ^ set(local.iteritems())
+    return sorted((batch, reported.get(batch), local.get(batch))
+                  for batch in set(batch for batch, totals in differ))
+
+
+def reconcile(start_date, end_date, merchant=None, **kwargs):
+    """
+    Returns the discrepancies() between Skipjack's batches and the
+    database's for start_date..end_date.
+
+    """
+    return discrepancies(report_batches(start_date, end_date, merchant,
+                                        **kwargs),
+                         local_batches(start_date, end_date, merchant))
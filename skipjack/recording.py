@@ -0,0 +1,259 @@
+"""
+Recording and replaying of the traffic with Skipjack, so that benchmarks and
+tests can run against real response shapes without contacting Skipjack.
+
+With SKIPJACK_RECORD_FILE set, every request the transport makes is appended
+to that file along with its response and how long it took, as a line of
+JSON. Card numbers, CVV2 codes and credentials are masked before anything
+is written.
+
+install_replay() then stands a Replayer in for the transport, serving the
+recorded responses back (after the recorded latencies, optionally scaled):
+
+    from skipjack import recording
+
+    recording.install_replay('skipjack-traffic.jsonl', speed=0)
+    try:
+        ...
+    finally:
+        recording.uninstall_replay()
+
+Optional settings:
+    SKIPJACK_RECORD_FILE - the file to record the traffic to, if any.
+
+"""
+import re
+import threading
+import time
+import urllib
+import urlparse
+
+from django.conf import settings
+from django.utils import simplejson
+
+from skipjack import transport
+from skipjack.creditcard import card_type, is_mod10
+
+
+# Request fields holding card data or credentials, which are masked.
+MASKED_FIELDS = frozenset([
+    'AccountNumber', 'CVV2', 'Month', 'Year',
+    'SerialNumber', 'DeveloperSerialNumber',
+    'szSerialNumber', 'szDeveloperSerialNumber',
+    'sSerialNumber_Merchant', 'sSerialNumber_Login', 'sUsername',
+    'sPassword',
+])
+
+# Settings holding credentials, masked where they're echoed in a response.
+CREDENTIAL_SETTINGS = ('SERIAL_NUMBER', 'DEVELOPER_SERIAL_NUMBER',
+                       'LOGIN_SERIAL_NUMBER', 'LOGIN_USERNAME',
+                       'LOGIN_PASSWORD')
+
+# Where Skipjack echoes credentials, with a credential for %s: the first
+# field of a CSV line (the serial number leads every row of the authorize,
+# status, change status and close batch responses), quoted or not, and HTML
+# attribute values, e.g. a report login form's. Only whole values match.
+CREDENTIAL_PATTERN = (r'(?:^|(?<=\n))("?)(%s)\1(?=[,\r\n]|$)'
+                      r'|(?<=value=)(["\']?)(%s)\3(?=["\'\s/>])')
+
+CARD_NUMBER_RE = re.compile(r'(?<!\d)\d{12,19}(?!\d)')
+
+
+def mask(value):
+    """The value with every character replaced by an X."""
+    return 'X' * len(value)
+
+
+def mask_card_number(match):
+    """Masks all but the first six and last four digits of card numbers."""
+    number = match.group()
+    if is_mod10(number) and card_type(number):
+        return number[:6] + mask(number[6:-4]) + number[-4:]
+    return number
+
+
+def credentials():
+    """The credentials of every merchant account, longest first."""
+    from skipjack.merchants import get_merchant, merchant_names
+    values = set()
+    for name in merchant_names():
+        merchant = get_merchant(name)
+        for key in CREDENTIAL_SETTINGS:
+            value = merchant.get(key)
+            if value:
+                values.add(str(value))
+    return sorted(values, key=len, reverse=True)
+
+
+def mask_request(data):
+    """The urlencoded request data with the MASKED_FIELDS masked."""
+    return urllib.urlencode([(field, mask(value) if field in MASKED_FIELDS
+                                     else value)
+                             for field, value in urlparse.parse_qsl(
+                                data, keep_blank_values=True)])
+
+
+def mask_credential(match):
+    """Masks the credential a CREDENTIAL_PATTERN matched, not its quotes."""
+    quote = match.group(1) or match.group(3) or ''
+    return quote + mask(match.group(2) or match.group(4)) + quote
+
+
+def mask_response(body, secrets=None):
+    """
+    The response body with card numbers, and the credentials (by default
+    those of every merchant account) where they're echoed, masked.
+    Elsewhere, even a short credential such as '1' is left alone.
+
+    """
+    if secrets is None:
+        secrets = credentials()
+    if secrets:
+        alternatives = '|'.join(re.escape(secret) for secret in secrets)
+        body = re.sub(CREDENTIAL_PATTERN % (alternatives, alternatives),
+                      mask_credential, body)
+    return CARD_NUMBER_RE.sub(mask_card_number, body)
+
+
+class Recorder(object):
+    """Appends each request and its response to a file, masked."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        line = simplejson.dumps(record) + '\n'
+        self.lock.acquire()
+        try:
+            output = open(self.path, 'ab')
+            try:
+                output.write(line)
+            finally:
+                output.close()
+        finally:
+            self.lock.release()
+
+    def record(self, url, data, endpoint, merchant, chunks):
+        """
+        Passes on the response chunks, recording the exchange once the
+        response has been read to the end.
+
+        """
+        started = time.time()
+        first_byte = None
+        body = []
+        for chunk in chunks:
+            if first_byte is None:
+                first_byte = time.time() - started
+            body.append(chunk)
+            yield chunk
+        self.write({
+            'url': url,
+            'endpoint': endpoint,
+            'merchant': merchant or '',
+            'request': mask_request(data),
+            'response': mask_response(''.join(body)).decode('latin-1'),
+            'first_byte': first_byte or 0,
+            'elapsed': time.time() - started,
+        })
+
+
+_recorder = None
+
+
+def get_recorder():
+    """The Recorder for SKIPJACK_RECORD_FILE, or None if not recording."""
+    global _recorder
+    path = getattr(settings, 'SKIPJACK_RECORD_FILE', None)
+    if not path:
+        return None
+    if _recorder is None or _recorder.path != path:
+        _recorder = Recorder(path)
+    return _recorder
+
+
+def load(path):
+    """The records in a recording file."""
+    records = []
+    recording = open(path, 'rb')
+    try:
+        for line in recording:
+            if line.strip():
+                record = simplejson.loads(line)
+                record['response'] = record['response'].encode('latin-1')
+                records.append(record)
+    finally:
+        recording.close()
+    return records
+
+
+class Replayer(object):
+    """
+    Stands in for transport.post_chunks, serving recorded responses.
+
+    A request is answered with the response recorded for the same (masked)
+    request, if there is one, and otherwise with the next response recorded
+    for its endpoint, in turn. The response is held back for the recorded
+    latency multiplied by `speed` (0 for no delay).
+
+    """
+    def __init__(self, records, speed=1.0):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.exact = {}
+        self.by_endpoint = {}
+        self.turns = {}
+        for record in records:
+            self.exact.setdefault((record['url'], record['request']),
+                                  []).append(record)
+            self.by_endpoint.setdefault(record['endpoint'],
+                                        []).append(record)
+
+    def find(self, url, data, endpoint):
+        self.lock.acquire()
+        try:
+            exact = self.exact.get((url, mask_request(data)))
+            if exact:
+                # Repeats of a request get its recorded responses in turn.
+                record = exact.pop(0)
+                exact.append(record)
+                return record
+            records = self.by_endpoint.get(endpoint)
+            if not records:
+                raise LookupError('No recorded responses for %s' % endpoint)
+            turn = self.turns.get(endpoint, 0)
+            self.turns[endpoint] = turn + 1
+            return records[turn % len(records)]
+        finally:
+            self.lock.release()
+
+    def post_chunks(self, url, data, endpoint=None, merchant=None):
+        record = self.find(url, data, endpoint)
+        if self.speed:
+            time.sleep(record['first_byte'] * self.speed)
+        response = record['response']
+        for i in xrange(0, len(response), transport.CHUNK_SIZE):
+            yield response[i:i + transport.CHUNK_SIZE]
+        if self.speed:
+            time.sleep(max(0, record['elapsed'] - record['first_byte']) *
+                       self.speed)
+
+
+_replaced = []
+
+
+def install_replay(path, speed=1.0):
+    """
+    Serve the responses recorded in the file from now on, in place of
+    requests to Skipjack. Returns the Replayer.
+
+    """
+    replayer = Replayer(load(path), speed)
+    _replaced.append(transport.post_chunks)
+    transport.post_chunks = replayer.post_chunks
+    return replayer
+
+
+def uninstall_replay():
+    """Go back to whatever was serving requests before install_replay()."""
+    transport.post_chunks = _replaced.pop()
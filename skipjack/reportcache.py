@@ -0,0 +1,103 @@
+"""
+On-disk cache of the Customized Report API data for past days.
+
+Once a day's batches have closed its report doesn't change, so there's no
+need to download and parse it again on every rerun. Each day is stored as
+the CSV data Skipjack returned for it, which is compact and is streamed
+straight back through the report parser.
+
+Optional settings:
+    SKIPJACK_REPORT_CACHE_DIR - directory to keep cached reports in. Reports
+        aren't cached unless this is set.
+    SKIPJACK_REPORT_CACHE_AFTER - days after which a day's report is taken
+        to be final, allowing for batches still to close and the difference
+        between our timezone and Skipjack's (default 2).
+
+"""
+import datetime
+import errno
+from hashlib import sha1
+import os
+import tempfile
+
+from django.conf import settings
+
+from skipjack.parsers import parse_report_lines
+
+
+DEFAULT_CACHE_AFTER = 2
+
+
+def cache_dir():
+    """The configured cache directory, or None if caching is off."""
+    return getattr(settings, 'SKIPJACK_REPORT_CACHE_DIR', None)
+
+
+def is_final(day, today=None):
+    """True if the report for the day can no longer change."""
+    today = today or datetime.date.today()
+    after = getattr(settings, 'SKIPJACK_REPORT_CACHE_AFTER',
+                    DEFAULT_CACHE_AFTER)
+    return day <= today - datetime.timedelta(days=after)
+
+
+def cache_path(merchant, day, extra_fields=None, kwargs=None):
+    """
+    The path of the cache file for a day's report, keyed by everything that
+    changes its content: the merchant, the day, the extra fields and any
+    other request parameters.
+
+    """
+    key = repr((merchant, day.isoformat(), list(extra_fields or ()),
+                sorted((kwargs or {}).items())))
+    return os.path.join(cache_dir(), '%s-%s.csv' % (day.isoformat(),
+                                                    sha1(key).hexdigest()))
+
+
+def read(path, columnar=False):
+    """
+    Returns the report rows cached at path (as a ReportColumns with
+    columnar), or None if there aren't any.
+
+    """
+    try:
+        cached = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    try:
+        return parse_report_lines(cached, columnar)
+    finally:
+        cached.close()
+
+
+def write(path, data):
+    """
+    Caches the CSV data of a report at path.
+
+    The file is written under a temporary name and renamed into place, so
+    concurrent readers never see a partial file.
+
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            # Another process may have just created it.
+            if e.errno != errno.EEXIST:
+                raise
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        temp = os.fdopen(fd, 'wb')
+        try:
+            temp.write(data)
+            if data:
+                temp.write('\n')
+        finally:
+            temp.close()
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
@@ -0,0 +1,205 @@
+"""
+Scheduled settlement of authorized Transactions, and closing of the current
+batch at the end of the day. See the settle_skipjack_transactions management
+command.
+
+Each run settles the eligible Transactions: approved, Authorized with
+nothing pending, and at least SKIPJACK_SETTLE_AFTER hours old, `workers`
+requests at a time within the change_status rate limit (see
+skipjack.ratelimit). Each one is first claimed, by marking it Pending
+Settlement with a conditional UPDATE, so that overlapping runs don't both
+settle it, then marked Submitted for Settlement as Skipjack accepts it. One
+Skipjack refuses, or that couldn't be sent, is released for the next run,
+but one whose request may have reached Skipjack without an answer stays
+claimed until the batch is closed, when its status is refreshed.
+
+The first run at or after SKIPJACK_BATCH_CUTOFF each day then closes the
+merchant account's current batch and refreshes the status of just the
+Transactions that were settled (or claimed) into it. If the close doesn't
+succeed, the next run tries again.
+
+Optional settings:
+    SKIPJACK_SETTLE_AFTER - hours after authorization before a Transaction
+        is settled (default 0).
+    SKIPJACK_BATCH_CUTOFF - the time of day, e.g. '21:00', from which the
+        current batch is closed (default None, never).
+
+"""
+import datetime
+
+from django.conf import settings
+from django.db import transaction, IntegrityError
+
+from skipjack import signals
+from skipjack.models import Transaction, ClosedBatch, TransactionError, \
+                            status_message_detail, AUTHORIZED, \
+                            PENDING_SETTLEMENT, SUBMITTED_FOR_SETTLEMENT
+from skipjack.outbox import unsent
+from skipjack.workers import imap_unordered
+
+
+DEFAULT_SETTLE_AFTER = 0
+
+
+def eligible(merchant=None, hours=None):
+    """The Transactions of a merchant account that are due to be settled."""
+    if hours is None:
+        hours = getattr(settings, 'SKIPJACK_SETTLE_AFTER',
+                        DEFAULT_SETTLE_AFTER)
+    cutoff = datetime.datetime.now() - datetime.timedelta(hours=hours)
+    return Transaction.objects.filter(
+                current_status=AUTHORIZED, pending_status=0, return_code=1,
+                merchant=merchant or '', creation_date__lte=cutoff
+            ).exclude(transaction_id='').exclude(auth_code='')
+
+
+def in_batch(merchant=None):
+    """The Transactions of a merchant account settled into its open batch."""
+    return Transaction.objects.filter(
+                current_status=AUTHORIZED,
+                pending_status__in=(PENDING_SETTLEMENT,
+                                    SUBMITTED_FOR_SETTLEMENT),
+                merchant=merchant or '').exclude(transaction_id='')
+
+
+def claim(payments):
+    """
+    Yields the Transactions this caller claims for settlement, marking each
+    Pending Settlement with a conditional UPDATE, so that no other run
+    settles it too.
+
+    """
+    for obj in payments:
+        if Transaction.objects.filter(pk=obj.pk, current_status=AUTHORIZED,
+                                      pending_status=0).update(
+                                        pending_status=PENDING_SETTLEMENT):
+            yield obj
+
+
+def submit(obj):
+    """Settles the Transaction at Skipjack."""
+    obj.settle(queued=False)
+
+
+def settle(merchant=None, hours=None, workers=None, limit=None):
+    """
+    Settles the eligible() Transactions, up to `limit` of them, returning
+    the number settled and the number that failed.
+
+    """
+    payments = eligible(merchant, hours).order_by('pk')
+    if limit is not None:
+        payments = payments[:limit]
+    status_text = status_message_detail('%d%d' % (AUTHORIZED,
+                                                  SUBMITTED_FOR_SETTLEMENT))
+    settled = 0
+    failures = 0
+    for obj, result, error in imap_unordered(submit,
+                                             claim(payments.iterator()),
+                                             workers):
+        if error:
+            if unsent(error[1]) or isinstance(error[1], TransactionError):
+                # Never made, so the next run can try again.
+                Transaction.objects.filter(pk=obj.pk,
+                                           pending_status=PENDING_SETTLEMENT
+                                           ).update(pending_status=0)
+            failures += 1
+            continue
+        obj.pending_status = SUBMITTED_FOR_SETTLEMENT
+        obj.status_text = status_text
+        Transaction.objects.filter(pk=obj.pk).update(
+                                        pending_status=obj.pending_status,
+                                        status_text=obj.status_text)
+        signals.payment_status_changed.send(sender=Transaction, instance=obj)
+        settled += 1
+    return settled, failures
+
+
+def fetch_status(obj):
+    """
+    Gets the Transaction's status from Skipjack, returning its status from
+    before.
+
+    """
+    original_status = (obj.current_status, obj.pending_status)
+    obj.get_status()
+    return original_status
+
+
+def refresh(payments, workers=None):
+    """
+    Updates the status of the Transactions from Skipjack, `workers` at a
+    time, returning the number updated and the number that failed.
+
+    """
+    updated = 0
+    failures = 0
+    for obj, original_status, error in imap_unordered(
+            fetch_status, payments.iterator(), workers):
+        if error:
+            failures += 1
+            continue
+        obj.save()
+        if original_status != (obj.current_status, obj.pending_status):
+            signals.payment_status_changed.send(sender=Transaction,
+                                                instance=obj)
+        updated += 1
+    return updated, failures
+
+
+def cutoff_passed(now=None):
+    """If it's past today's SKIPJACK_BATCH_CUTOFF."""
+    cutoff = getattr(settings, 'SKIPJACK_BATCH_CUTOFF', None)
+    if not cutoff:
+        return False
+    now = now or datetime.datetime.now()
+    return now.time() >= datetime.datetime.strptime(cutoff, '%H:%M').time()
+
+
+def close(merchant=None, workers=None):
+    """
+    Closes the merchant account's current batch, then refreshes the status
+    of the Transactions in it. Returns Skipjack's response to the close,
+    and the number of Transactions updated and that failed to update.
+
+    """
+    from skipjack.utils import close_current_batch
+    response = close_current_batch(merchant)
+    updated, failures = refresh(in_batch(merchant), workers)
+    return response, updated, failures
+
+
+def scheduled_close(merchant=None, workers=None, now=None):
+    """
+    As close(), if it's past the cutoff and the batch hasn't been closed by
+    a run since, otherwise returns None. Only one caller closes the batch
+    each day, whichever process it's in, as it first creates the day's
+    ClosedBatch. If the close fails, that's deleted for the next run.
+
+    """
+    now = now or datetime.datetime.now()
+    if not cutoff_passed(now):
+        return None
+    sid = transaction.savepoint()
+    try:
+        marker = ClosedBatch.objects.create(merchant=merchant or '',
+                                            day=now.date())
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Closed (or being closed) by another run.
+        transaction.savepoint_rollback(sid)
+        return None
+    closed = False
+    try:
+        from skipjack.utils import close_current_batch
+        response = close_current_batch(merchant)
+        closed = response == 'Success'
+    finally:
+        if closed:
+            marker.response = response
+            marker.save()
+        else:
+            # Let the next run try again.
+            marker.delete()
+    updated, failures = refresh(in_batch(merchant), workers)
+    return response, updated, failures
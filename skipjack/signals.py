@@ -11,6 +11,8 @@ __all__ = ['payment_was_successful',
            'payment_status_changed']
 
 
+# Sent once for each new Transaction, see models.dispatch_payment_signals.
+# Usage: payment_was_successful.send(sender=Transaction, instance=trans)
 payment_was_successful = Signal(providing_args=['instance'])
 payment_was_flagged = Signal(providing_args=['instance'])
 
@@ -2,14 +2,72 @@
 Testing for the basic operation of django-skipjack.
 
 """
+import BaseHTTPServer
 import copy
+from cStringIO import StringIO
+import csv
+import datetime
+import gzip
+import httplib
+import os
+from decimal import Decimal
 import random
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import zlib
 
 from django.utils import unittest
 from django.conf import settings
+from django.contrib import admin
+from django.core.cache import cache, get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+from django.db import transaction
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from skipjack.models import Transaction
-from skipjack.utils import create_transaction
+from skipjack import ratelimit, signals, transport
+from skipjack.models import Transaction, BulkTransactionError, \
+                            QueuedStatusChange, TransactionError, DailyRollup, \
+                            ArchivedTransaction, ClosedBatch, \
+                            AUTHORIZED, SETTLED, \
+                            PENDING_SETTLEMENT, SUBMITTED_FOR_SETTLEMENT, \
+                            QUEUED, PROCESSING, DONE, FAILED
+from skipjack.admin import TransactionAdmin, ArchivedTransactionAdmin, \
+                           summarize_rollups
+from skipjack.archive import archive, history
+from skipjack.counts import CountingQuerySet
+from skipjack.creditcard import verify_credit_card, verify_credit_cards, \
+                                card_type, load_iin_table, IINTable, \
+                                NOT_A_NUMBER, TEST_NUMBER, FAILED_MOD10, \
+                                UNKNOWN_TYPE
+from skipjack.export import export_csv
+from skipjack.importer import import_reports
+from skipjack.merchants import get_merchant, merchant_names
+from skipjack.recording import install_replay, uninstall_replay, \
+                               mask_response
+from skipjack.outbox import process
+from skipjack.ratelimit import TokenBucket, SharedBucket
+from skipjack.probe import probe, percentile
+from skipjack.settlement import claim, settle, scheduled_close
+from skipjack.reconcile import reconcile
+from skipjack.prewarm import get_pools, warm, Refresher
+from skipjack.parsers import parse_status, parse_change_status, \
+                             parse_close_batch, parse_report, ReportColumns, \
+                             report_data, report_data_chunks
+from skipjack.utils import create_transaction, create_transactions, \
+                           get_transaction_status, \
+                           get_order_transaction_history, \
+                           transaction_reports, report_windows
+from skipjack.workers import background, flush_deferred
 
 
 class RandomOrderNumber(object):
@@ -49,9 +107,8 @@ class SkipjackTestCase(unittest.TestCase):
     and change status methods.
     
     Currently just testing the Authorize API and transaction deletion via the
-    signals we have hooked up to Transaction.delete() that call
-    Transaction.delete_transaction() to remove the transaction from
-    Skipjack.
+    signals we have hooked up to Transaction.delete() that queue the
+    transaction to be removed from Skipjack.
     
     """
     def setUp(self):
@@ -185,4 +242,1392 @@ class SkipjackTestCase(unittest.TestCase):
                          'Authorization failed, card declined.')
         # Now remove the transaction from Skipjack...
         transaction.delete()
-    
\ No newline at end of file
+
+
+REPORT_RESPONSE = ('<html><!-- Begin Data -->'
+                   'TransactionDate,OrderNumber,Amount,<br>\r\n'
+                   '10/19/2011 1:02:03 PM,12345,($150.00),<br>\r\n'
+                   '10/19/2011 12:00:00 PM,12346,$20.50,<br>\r\n'
+                   '<!-- End Data --></html>')
+
+
+class ParserTestCase(unittest.TestCase):
+    """
+    Run the response parsers against canned Skipjack responses.
+    
+    These don't need to talk to Skipjack.
+    
+    """
+    status_response = (
+        '"000111222333","2","","","","","","",""\r\n'
+        '"000111222333","150.00","12","Status message","12345",'
+        '"10/19/11 13:02:03","000000000001","123456","1042"\r\n'
+        '"000111222333","25.00","30","Status message","12345",'
+        '"10/20/11 09:00:00","000000000002","654321","1043"\r\n')
+    
+    def test_status(self):
+        """Rows map onto Status objects, values converted on access."""
+        history = parse_status(self.status_response)
+        self.assertEqual(len(history), 2)
+        status = history[0]
+        self.assertEqual(status.transaction_id, '000000000001')
+        self.assertEqual(status.approval_code, '123456')
+        self.assertEqual(status.batch_number, '1042')
+        self.assertEqual(status.amount, Decimal('150.00'))
+        self.assertEqual(status.date, datetime.datetime(2011, 10, 19,
+                                                        13, 2, 3))
+        self.assertEqual(status.current_status, AUTHORIZED)
+        self.assertEqual(status.pending_status, PENDING_SETTLEMENT)
+        self.assertEqual(status.message_detail,
+                         'Authorized, Pending Settlement')
+        self.assertEqual(history[1].message_detail, 'Settled')
+    
+    def test_change_status(self):
+        """The detail row is parsed, an error description is not."""
+        response = ('"000111222333","1","","","","",""\r\n'
+                    '"000111222333","150.00","SETTLE","SUCCESSFUL",'
+                    '"Valid","12345","000000000001"\r\n')
+        change = parse_change_status(response)
+        self.assertEqual(change.status, 'SUCCESSFUL')
+        self.assertEqual(change.amount, Decimal('150.00'))
+        self.assertEqual(change.transaction_id, '000000000001')
+        self.assertEqual(parse_change_status('"000111222333","-1"\r\n'
+                                             '"Invalid Serial Number"'),
+                         None)
+    
+    def test_close_batch(self):
+        """Only a twelve column row is a close batch response."""
+        response = '"000111222333","0"' + ',""' * 10
+        self.assertEqual(parse_close_batch(response)['status'], '0')
+        self.assertEqual(parse_close_batch('"Error"'), None)
+    
+    def test_report(self):
+        """Report amounts and dates are converted by column."""
+        rows = parse_report(REPORT_RESPONSE)
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(rows[0], {
+            'TransactionDate': datetime.datetime(2011, 10, 19, 13, 2, 3),
+            'OrderNumber': '12345',
+            'Amount': Decimal('-150.00')})
+        self.assertEqual(rows[1]['TransactionDate'].hour, 12)
+        self.assertEqual(rows[1]['Amount'], Decimal('20.50'))
+
+        self.assertEqual(parse_report('<!-- Begin Data --><!-- End Data -->'),
+                         [])
+        # An error page isn't a report of nothing.
+        self.assertRaises(TransactionError, parse_report,
+                          '<html>Invalid login</html>')
+    
+    def test_report_columns(self):
+        """Columnar reports hold cents, timestamps and status codes."""
+        response = ('<html><!-- Begin Data -->'
+                    'TransactionDate,TransactionStatus,OrderNumber,Amount,'
+                    '<br>\r\n'
+                    '10/19/2011 12:02:03 AM,Settled,12345,($150.00),<br>\r\n'
+                    '10/19/2011 12:00:00 PM,Authorized,12346,$20.50,<br>\r\n'
+                    '10/20/2011 1:00:00 PM,Settled,12347,<br>\r\n'
+                    '<!-- End Data --></html>')
+        report = parse_report(response, columnar=True)
+        self.assertEqual(len(report), 3)
+        self.assertEqual(list(report['Amount']), [-15000, 2050, 0])
+        self.assertEqual(list(report['TransactionDate']),
+                         [1318982523, 1319025600, 1319115600])
+        self.assertEqual(report['OrderNumber'], ['12345', '12346', '12347'])
+        statuses = report.labels['TransactionStatus']
+        self.assertEqual([statuses[code]
+                          for code in report['TransactionStatus']],
+                         ['Settled', 'Authorized', 'Settled'])
+        # Status codes are translated when appending another report.
+        other = parse_report('<!-- Begin Data -->TransactionStatus,Amount'
+                             '<br>\r\nCredited,$1.00<!-- End Data -->',
+                             columnar=True)
+        report.extend(other)
+        self.assertEqual(len(report), 4)
+        self.assertEqual(statuses[report['TransactionStatus'][3]], 'Credited')
+        self.assertEqual(report['OrderNumber'][3], '')
+        self.assertEqual(report['TransactionDate'][3], 0)
+    
+    def test_report_many_statuses(self):
+        """Status columns hold more than 256 distinct labels."""
+        rows = ['Status %d,$1.00' % i for i in range(300)]
+        report = parse_report('<!-- Begin Data -->TransactionStatus,Amount'
+                              '<br>\r\n%s<!-- End Data -->' %
+                              '<br>\r\n'.join(rows), columnar=True)
+        statuses = report.labels['TransactionStatus']
+        self.assertEqual(statuses[report['TransactionStatus'][299]],
+                         'Status 299')
+    
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_report_numpy(self):
+        """Columnar reports convert to NumPy structured arrays."""
+        report = parse_report('<!-- Begin Data -->OrderNumber,Amount<br>\r\n'
+                              '12345,$1.50<br>\r\n12346,$2.00'
+                              '<!-- End Data -->', columnar=True)
+        array = report.to_numpy()
+        self.assertEqual(array['Amount'].sum(), 350)
+        self.assertEqual(list(array['OrderNumber']), ['12345', '12346'])
+
+
+AUTHORIZE_FIELDS = ('szSerialNumber', 'szTransactionAmount',
+                    'szAuthorizationDeclinedMessage', 'szAVSResponseCode',
+                    'szAVSResponseMessage', 'szOrderNumber', 'AUTHCODE',
+                    'szReturnCode', 'szIsApproved', 'szCVV2ResponseCode',
+                    'szCVV2ResponseMessage', 'szTransactionFileName',
+                    'szCAVVResponseCode', 'szAuthorizationResponseCode')
+
+
+def fake_authorize(url, data, endpoint=None, merchant=None):
+    """
+    Stands in for transport.post, approving every order number except
+    'fail', for which the request itself fails.
+    
+    """
+    order_number = dict(urlparse.parse_qsl(data))['OrderNumber']
+    if order_number == 'fail':
+        raise IOError('Connection refused')
+    values = ('000111222333', '15000', '', 'Y', 'Match', order_number,
+              '123456', '1', '1', 'M', 'Match', '0000%s' % order_number,
+              '', '123456')
+    return '%s\r\n%s\r\n' % (','.join('"%s"' % f for f in AUTHORIZE_FIELDS),
+                               ','.join('"%s"' % v for v in values))
+
+
+class BulkTransactionTestCase(TestCase):
+    """
+    Run create_transactions() against a stand in for the Skipjack transport.
+    
+    """
+    def setUp(self):
+        self.old_post = transport.post
+        transport.post = fake_authorize
+        self.sent = []
+        signals.payment_was_successful.connect(self.receiver)
+    
+    def tearDown(self):
+        transport.post = self.old_post
+        signals.payment_was_successful.disconnect(self.receiver)
+    
+    def receiver(self, sender, instance, **kwargs):
+        self.sent.append((instance.order_number,
+                          threading.current_thread().name))
+    
+    def test_create_transaction(self):
+        """The payment signal is sent exactly once."""
+        create_transaction({'OrderNumber': 'bulk1'})
+        self.assertEqual(self.sent, [('bulk1', 'MainThread')])
+    
+    def test_deferred_signals(self):
+        """Deferred receivers run in the background after commit."""
+        settings.SKIPJACK_DEFER_SIGNALS = True
+        try:
+            create_transaction({'OrderNumber': 'bulk1'})
+            # Held until the (test case's) transaction is committed.
+            self.assertEqual(self.sent, [])
+            flush_deferred()
+            background().join()
+        finally:
+            settings.SKIPJACK_DEFER_SIGNALS = False
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.sent[0][0], 'bulk1')
+        self.assertNotEqual(self.sent[0][1], 'MainThread')
+    
+    def test_create_transactions(self):
+        """Every authorization is stored and signalled exactly once."""
+        data = [{'OrderNumber': 'bulk%d' % i} for i in range(25)]
+        created = list(create_transactions(data, workers=4, batch_size=10))
+        numbers = sorted('bulk%d' % i for i in range(25))
+        self.assertEqual(sorted(t.order_number for t in created), numbers)
+        self.assertEqual(sorted(n for n, thread in self.sent), numbers)
+        self.assertEqual(Transaction.objects.filter(
+                            order_number__startswith='bulk').count(), 25)
+        self.assertEqual(created[0].amount, Decimal('150.00'))
+    
+    def test_failures(self):
+        """A failed request is reported after the others are stored."""
+        data = [{'OrderNumber': 'bulk1'}, {'OrderNumber': 'fail'},
+                {'OrderNumber': 'bulk2'}]
+        created = []
+        try:
+            for transaction in create_transactions(data):
+                created.append(transaction)
+        except BulkTransactionError, e:
+            self.assertEqual(e.failures[0][0], {'OrderNumber': 'fail'})
+        else:
+            self.fail('BulkTransactionError not raised')
+        self.assertEqual(len(created), 2)
+    
+    def test_abandoned(self):
+        """Authorizations made are stored even if the caller stops early."""
+        data = [{'OrderNumber': 'bulk%d' % i} for i in range(25)]
+        transactions = create_transactions(data, workers=4, batch_size=10)
+        transactions.next()
+        transactions.close()
+        stored = Transaction.objects.filter(
+                    order_number__startswith='bulk').count()
+        # At least the first batch and whatever was in flight, and no
+        # requests were started after it was closed.
+        self.assertTrue(10 <= stored < 25)
+        self.assertEqual(len(self.sent), stored)
+
+
+class DeferredSignalTestCase(TransactionTestCase):
+    """
+    Deferred receivers against real commits and rollbacks, which TestCase
+    doesn't make.
+    
+    """
+    def setUp(self):
+        self.old_post = transport.post
+        transport.post = fake_authorize
+        self.sent = []
+        signals.payment_was_successful.connect(self.receiver)
+        settings.SKIPJACK_DEFER_SIGNALS = True
+    
+    def tearDown(self):
+        settings.SKIPJACK_DEFER_SIGNALS = False
+        transport.post = self.old_post
+        signals.payment_was_successful.disconnect(self.receiver)
+    
+    def receiver(self, sender, instance, **kwargs):
+        self.sent.append(instance.order_number)
+    
+    def test_commit(self):
+        """Receivers run once the transaction commits."""
+        @transaction.commit_on_success
+        def create():
+            create_transaction({'OrderNumber': 'commit1'})
+            self.assertEqual(self.sent, [])
+        create()
+        background().join()
+        self.assertEqual(self.sent, ['commit1'])
+    
+    def test_rollback(self):
+        """Receivers never run if the transaction rolls back."""
+        @transaction.commit_on_success
+        def create():
+            create_transaction({'OrderNumber': 'rollback1'})
+            raise ValueError
+        self.assertRaises(ValueError, create)
+        # Nothing is left to run at the end of the request either.
+        flush_deferred()
+        background().join()
+        self.assertEqual(self.sent, [])
+        self.assertFalse(Transaction.objects.filter(
+                                    order_number='rollback1').exists())
+
+
+class FakeSkipjack(object):
+    """
+    Stands in for transport.post, answering status and change status
+    requests from a dict of transaction id to status code, and recording
+    the change status requests made.
+    
+    """
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.changes = []
+    
+    def __call__(self, url, data, endpoint=None, merchant=None):
+        data = dict(urlparse.parse_qsl(data))
+        if 'CLOSEOPENBATCH' in url:
+            self.changes.append((None, 'CLOSE'))
+            return '"000111222333","0"' + ',""' * 10
+        if 'ChangeStatus' in url:
+            self.changes.append((data['szTransactionId'],
+                                 data['szDesiredStatus']))
+            return ('"000111222333","1","","","","",""\r\n'
+                    '"000111222333","0.00","%s","SUCCESSFUL","Valid",'
+                    '"12345","%s"\r\n' % (data['szDesiredStatus'],
+                                            data['szTransactionId']))
+        rows = ['"000111222333","%d","","","","","","",""' %
+                                                        len(self.statuses)]
+        for transaction_id, code in sorted(self.statuses.items()):
+            rows.append('"000111222333","150.00","%s","Message","%s",'
+                        '"10/19/11 13:02:03","%s","123456","1042"' % (
+                            code, data['szOrderNumber'], transaction_id))
+        return '\r\n'.join(rows)
+
+
+class OutboxTestCase(TestCase):
+    """
+    Deleting Transactions queues the delete at Skipjack, which is made by
+    processing the queue.
+    
+    """
+    def setUp(self):
+        self.old_post = transport.post
+        self.skipjack = transport.post = FakeSkipjack({'0001': '10',
+                                                       '0002': '30'})
+    
+    def tearDown(self):
+        transport.post = self.old_post
+    
+    def create(self, transaction_id):
+        return Transaction.objects.create(transaction_id=transaction_id,
+                                          order_number='12345',
+                                          amount=Decimal('150.00'),
+                                          return_code=1)
+    
+    def test_delete(self):
+        """Deletes are queued, then made by the queue processing."""
+        self.create('0001')
+        self.create('0002')
+        Transaction.objects.all().delete()
+        self.assertEqual(self.skipjack.changes, [])
+        self.assertEqual(QueuedStatusChange.objects.filter(
+                            state=QUEUED).count(), 2)
+        counts = process(workers=2)
+        self.assertEqual(counts[DONE], 1)
+        self.assertEqual(counts[FAILED], 1)
+        self.assertEqual(self.skipjack.changes, [('0001', 'DELETE')])
+        # The settled transaction can't be deleted.
+        failed = QueuedStatusChange.objects.get(state=FAILED)
+        self.assertEqual(failed.transaction_id, '0002')
+        # Nothing is left to do.
+        self.assertEqual(process(), {DONE: 0, FAILED: 0, QUEUED: 0})
+    
+    def test_duplicate_delete(self):
+        """Rows sharing a transaction id queue a single delete."""
+        self.create('0001')
+        self.create('0001')
+        Transaction.objects.all().delete()
+        self.assertFalse(Transaction.objects.exists())
+        self.assertEqual(QueuedStatusChange.objects.get().key, 'DELETE:0001')
+    
+    def test_retry(self):
+        """Failed requests are retried later."""
+        self.create('0001').delete()
+        def unavailable(url, data, endpoint=None, merchant=None):
+            raise IOError('Connection refused')
+        transport.post = unavailable
+        self.assertEqual(process()[QUEUED], 1)
+        entry = QueuedStatusChange.objects.get()
+        self.assertEqual(entry.attempts, 1)
+        self.assertEqual(entry.message, 'Connection refused')
+        self.assertEqual(process()[QUEUED], 0)  # Not due yet.
+    
+    def test_queued_settle(self):
+        """Queued settlements are made once, and mark the Transaction."""
+        transaction = self.create('0001')
+        transaction.current_status = AUTHORIZED
+        transaction.save()
+        entry = transaction.settle(queued=True)
+        self.assertEqual(transaction.settle(queued=True), entry)
+        self.assertEqual(self.skipjack.changes, [])
+        self.assertEqual(process()[DONE], 1)
+        self.assertEqual(self.skipjack.changes, [('0001', 'SETTLE')])
+        transaction = Transaction.objects.get(pk=transaction.pk)
+        self.assertEqual(transaction.pending_status, SUBMITTED_FOR_SETTLEMENT)
+        self.assertEqual(transaction.status_text,
+                         'Authorized, Submitted for Settlement')
+        self.assertRaises(TransactionError, transaction.settle)
+    
+    def test_queued_refunds(self):
+        """The same refund is only queued once, different ones aren't."""
+        transaction = self.create('0002')
+        transaction.current_status = SETTLED
+        first = transaction.partial_refund('10.00', queued=True)
+        self.assertEqual(transaction.partial_refund('10', queued=True), first)
+        transaction.partial_refund('20.00', queued=True)
+        self.assertEqual(process()[DONE], 2)
+        # Once made, the same refund can be queued again.
+        self.assertNotEqual(transaction.partial_refund('10.00', queued=True),
+                            first)
+    
+    def lost_response(self, url, data, endpoint=None, merchant=None):
+        """Makes the change, but the response never comes back."""
+        response = self.skipjack(url, data, endpoint, merchant)
+        if 'ChangeStatus' in url:
+            self.skipjack.statuses['0001'] = '17'
+            raise httplib.BadStatusLine('')
+        return response
+    
+    def test_settle_not_resent(self):
+        """A settlement that may have been made is checked, not resent."""
+        transaction = self.create('0001')
+        transaction.current_status = AUTHORIZED
+        transaction.save()
+        transaction.settle(queued=True)
+        transport.post = self.lost_response
+        self.assertEqual(process()[QUEUED], 1)
+        transport.post = self.skipjack
+        QueuedStatusChange.objects.update(next_attempt=datetime.datetime.now())
+        self.assertEqual(process()[DONE], 1)
+        self.assertEqual(self.skipjack.changes, [('0001', 'SETTLE')])
+    
+    def test_credit_not_resent(self):
+        """A refund that may have been made fails for manual review."""
+        transaction = self.create('0002')
+        transaction.current_status = SETTLED
+        transaction.refund(queued=True)
+        transport.post = self.lost_response
+        self.assertEqual(process()[FAILED], 1)
+        self.assertEqual(self.skipjack.changes, [('0002', 'CREDIT')])
+        self.assertTrue(QueuedStatusChange.objects.get().message.startswith(
+                            'May have been made'))
+    
+    def test_expired_lease(self):
+        """A change whose worker lost its lease isn't made again."""
+        transaction = self.create('0002')
+        transaction.current_status = SETTLED
+        transaction.refund(queued=True)
+        QueuedStatusChange.objects.update(state=PROCESSING)
+        self.assertEqual(process()[FAILED], 1)
+        self.assertEqual(self.skipjack.changes, [])
+
+
+class RateLimitTestCase(unittest.TestCase):
+    """Test the client side rate limiters."""
+    def test_token_bucket(self):
+        """Bursts are allowed up to the capacity, then the rate applies."""
+        bucket = TokenBucket(10, capacity=3)
+        self.assertEqual([bucket.take() for i in range(3)], [0, 0, 0])
+        wait = bucket.take()
+        self.assertTrue(0 < wait <= 0.1)
+        time.sleep(wait)
+        self.assertEqual(bucket.take(), 0)
+    
+    def test_shared_bucket(self):
+        """Buckets sharing a cache share one budget."""
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        first = SharedBucket('test', 1, capacity=2, cache=cache)
+        second = SharedBucket('test', 1, capacity=2, cache=cache)
+        taken = [first.take(), second.take(), first.take(), second.take()]
+        # Only two of the four fit in the window (three if it rolled over).
+        self.assertTrue(taken.count(0) in (2, 3))
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    """Concurrent status requests for the same order are shared."""
+    def setUp(self):
+        self.old_post = transport.post
+        self.skipjack = FakeSkipjack({'0001': '10', '0002': '30'})
+        self.requests = []
+        def slow_post(url, data, endpoint=None, merchant=None):
+            self.requests.append(data)
+            time.sleep(0.1)
+            return self.skipjack(url, data)
+        transport.post = slow_post
+    
+    def tearDown(self):
+        transport.post = self.old_post
+    
+    def test_single_flight(self):
+        """One request is made, and each caller gets its own answer."""
+        results = {}
+        def status(transaction_id):
+            results[transaction_id] = get_transaction_status(
+                                    '12345', transaction_id=transaction_id)
+        def history():
+            results['history'] = get_order_transaction_history('12345')
+        threads = [threading.Thread(target=status, args=('0001',)),
+                   threading.Thread(target=status, args=('0002',)),
+                   threading.Thread(target=history)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual(results['0001'].transaction_id, '0001')
+        self.assertEqual(results['0002'].transaction_id, '0002')
+        self.assertEqual(len(results['history']), 2)
+        # Later requests aren't shared with the finished one.
+        get_transaction_status('12345')
+        self.assertEqual(len(self.requests), 2)
+
+
+def fake_report(url, data, endpoint=None, merchant=None):
+    """
+    Stands in for transport.post, reporting two transactions for each day
+    requested, slower for earlier days so the responses arrive out of order.
+    
+    """
+    data = dict(urlparse.parse_qsl(data))
+    start = datetime.date(int(data['sYearStart']), int(data['sMonthStart']),
+                          int(data['sDayStart']))
+    end = datetime.date(int(data['sYearEnd']), int(data['sMonthEnd']),
+                        int(data['sDayEnd']))
+    time.sleep(0.01 * (31 - start.day))
+    rows = ['TransactionDate,TransactionStatus,TransactionFileName,'
+            'OrderNumber,ApprovalCode,Amount,']
+    day = start
+    while day <= end:
+        for hour in (1, 11):
+            rows.append('%d/%d/%d %d:00:00 AM,Settled,%s%02d00,%s%02d,'
+                        '1234%02d,$1.00,' % (
+                            day.month, day.day, day.year, hour,
+                            day.strftime('%Y%m%d'), hour,
+                            day.strftime('%Y%m%d'), hour, hour))
+        day += datetime.timedelta(days=1)
+    return '<!-- Begin Data -->%s<br>\r\n<!-- End Data -->' % \
+                                            '<br>\r\n'.join(rows)
+
+
+class CompressingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers POSTs with a report page, compressed as the path says: /gzip,
+    /deflate, /raw-deflate (without the zlib header) or /identity. /drop
+    closes the connection without answering, and /bye answers and then
+    closes the connection while it's idle.
+    
+    """
+    protocol_version = 'HTTP/1.1'
+    page = ('<html><body>' + ' ' * 5000 + REPORT_RESPONSE +
+            '</body></html>')
+    
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        # Before responding, as the client may check as soon as it has read.
+        self.server.requests.append(self.headers.get('Accept-Encoding'))
+        encoding = self.path[1:]
+        if encoding == 'drop':
+            self.close_connection = 1
+            return
+        if encoding == 'bye':
+            self.close_connection = 1
+            encoding = 'identity'
+        if encoding == 'gzip':
+            buffer = StringIO()
+            compressed = gzip.GzipFile(fileobj=buffer, mode='wb')
+            compressed.write(self.page)
+            compressed.close()
+            body = buffer.getvalue()
+        elif encoding == 'deflate':
+            body = zlib.compress(self.page)
+        elif encoding == 'raw-deflate':
+            body = zlib.compress(self.page)[2:-4]
+            encoding = 'deflate'
+        else:
+            body = self.page
+        self.send_response(200)
+        self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    """Serves each (keep-alive) connection on a thread of its own."""
+    daemon_threads = True
+
+
+class TransportTestCase(unittest.TestCase):
+    """Test the transport against a local HTTP server."""
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          CompressingHandler)
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+    
+    def tearDown(self):
+        transport.get_pool('http', '127.0.0.1:%d' %
+                                   self.server.server_port).clear()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def test_compression(self):
+        """Compressed responses are decompressed, on one connection."""
+        for encoding in ('gzip', 'deflate', 'raw-deflate', 'identity'):
+            self.assertEqual(transport.post(self.url + encoding, 'a=1'),
+                             CompressingHandler.page)
+        self.assertEqual(self.server.requests, ['gzip, deflate'] * 4)
+    
+    def test_resend(self):
+        """Only requests that may not have been processed are sent again."""
+        transport.post(self.url + 'identity', 'a=1')
+        self.assertRaises(httplib.BadStatusLine, transport.post,
+                          self.url + 'drop', 'a=1', endpoint='authorize')
+        self.assertEqual(len(self.server.requests), 2)
+        transport.post(self.url + 'identity', 'a=1')
+        self.assertRaises(httplib.BadStatusLine, transport.post,
+                          self.url + 'drop', 'a=1', endpoint='status')
+        self.assertEqual(len(self.server.requests), 5)
+        # Connections closed while idle aren't used.
+        transport.post(self.url + 'bye', 'a=1')
+        time.sleep(0.05)
+        self.assertEqual(transport.post(self.url + 'identity', 'a=1',
+                                        endpoint='authorize'),
+                         CompressingHandler.page)
+        self.assertEqual(len(self.server.requests), 7)
+    
+    def test_report_data(self):
+        """Report data is extracted from the response as it's read."""
+        old_chunk_size = transport.CHUNK_SIZE
+        transport.CHUNK_SIZE = 100
+        try:
+            data = report_data_chunks(transport.post_chunks(self.url + 'gzip',
+                                                            'a=1'))
+        finally:
+            transport.CHUNK_SIZE = old_chunk_size
+        self.assertEqual(data, report_data(CompressingHandler.page))
+        self.assertEqual(report_data_chunks(['<html>No data</html>']), None)
+    
+    def test_record_replay(self):
+        """Recorded traffic is masked, and can be served back."""
+        path = tempfile.mktemp()
+        settings.SKIPJACK_RECORD_FILE = path
+        request = [('SerialNumber', settings.SKIPJACK_SERIAL_NUMBER),
+                   ('AccountNumber', '4111111111111111'),
+                   ('OrderNumber', '1')]
+        try:
+            transport.post(self.url + 'gzip', urllib.urlencode(request),
+                           endpoint='authorize')
+        finally:
+            del settings.SKIPJACK_RECORD_FILE
+        try:
+            recording = open(path, 'rb').read()
+            self.assertFalse('SerialNumber=%s' %
+                             settings.SKIPJACK_SERIAL_NUMBER in recording)
+            self.assertFalse('4111111111111111' in recording)
+            self.assertTrue('OrderNumber=1' in recording)
+            replayer = install_replay(path, speed=0)
+            try:
+                # Served for any request to the same endpoint.
+                self.assertEqual(transport.post('https://example.com/',
+                                                'OrderNumber=2',
+                                                endpoint='authorize'),
+                                 CompressingHandler.page)
+                self.assertRaises(LookupError, transport.post,
+                                  self.url, '', endpoint='status')
+            finally:
+                uninstall_replay()
+        finally:
+            os.remove(path)
+        self.assertEqual(self.server.requests, ['gzip, deflate'])
+        self.assertEqual(mask_response(
+                            '"%s","4111111111111111","000011112222"' %
+                            settings.SKIPJACK_SERIAL_NUMBER),
+                         '"%s","411111XXXXXX1111","000011112222"' %
+                         ('X' * len(settings.SKIPJACK_SERIAL_NUMBER)))
+        # Only whole values where credentials are echoed, however short.
+        self.assertEqual(mask_response(
+                            '"szSerialNumber","szOrderNumber"\r\n'
+                            '"1","OrderNumber 1"\r\n1,1\r\n'
+                            '<input name="sUsername" value="u">',
+                            secrets=['1', 'u', 'p']),
+                         '"szSerialNumber","szOrderNumber"\r\n'
+                         '"X","OrderNumber 1"\r\nX,1\r\n'
+                         '<input name="sUsername" value="X">')
+    
+    def test_probe(self):
+        """Every phase of each probe request is timed."""
+        for reuse in (False, True):
+            results = probe(self.url + 'identity', 'a=1', requests=5,
+                            workers=2, reuse=reuse)
+            self.assertEqual(results['errors'], 0)
+            self.assertEqual(len(results['total']), 5)
+            self.assertTrue(percentile(results['first_byte'], 0.5) <=
+                            percentile(results['total'], 1.0))
+        self.assertEqual(len(self.server.requests), 10)
+        self.assertEqual(percentile(range(1, 101), 0.9), 90)
+        self.assertEqual(percentile([], 0.5), None)
+    
+    def test_prewarm(self):
+        """Warm connections are reused, and replaced once idle too long."""
+        pool = transport.get_pool('http', '127.0.0.1:%d' %
+                                          self.server.server_port)
+        self.assertEqual(warm([pool], 2), 2)
+        self.assertEqual(warm([pool], 2), 0)
+        warmed = [connection for connection, since in pool.idle]
+        transport.post(self.url + 'identity', 'a=1')
+        self.assertEqual(len(pool.idle), 2)
+        self.assertTrue(pool.idle[-1][0] in warmed)
+        # Nothing has been idle for an hour, everything for no time at all.
+        refresher = Refresher([pool], 2, 3600)
+        self.assertEqual(refresher.refresh(), 0)
+        refresher.max_idle = 0
+        time.sleep(0.01)
+        self.assertEqual(refresher.refresh(), 2)
+        self.assertFalse([connection for connection, since in pool.idle
+                          if connection in warmed])
+        # Unreachable hosts are logged, not raised.
+        closed = transport.ConnectionPool('http', '127.0.0.1:1')
+        self.assertEqual(warm([closed], 1), 0)
+        # The endpoints share hosts, and each merchant has its own pools.
+        settings.SKIPJACK_MERCHANTS = {'outlet': {}}
+        try:
+            self.assertEqual(len(get_pools(['authorize', 'status'])), 2)
+            self.assertEqual(len(get_pools(['authorize'], [''])), 1)
+            self.assertRaises(ValueError, get_pools, ['refund'])
+        finally:
+            del settings.SKIPJACK_MERCHANTS
+
+
+def chunked(post, size=7):
+    """
+    Makes a stand in for transport.post_chunks from one for transport.post,
+    with chunks small enough to split the report markers.
+    
+    """
+    def post_chunks(url, data, endpoint=None, merchant=None):
+        response = post(url, data, endpoint, merchant)
+        for i in xrange(0, len(response), size):
+            yield response[i:i + size]
+    return post_chunks
+
+
+class ReportTestCase(unittest.TestCase):
+    """Test transaction_reports() against a stand in for Skipjack."""
+    def setUp(self):
+        self.old_post_chunks = transport.post_chunks
+        transport.post_chunks = chunked(fake_report)
+    
+    def tearDown(self):
+        transport.post_chunks = self.old_post_chunks
+    
+    def test_windows(self):
+        """Date ranges are split into consecutive, inclusive windows."""
+        self.assertEqual(report_windows(datetime.date(2011, 10, 30),
+                                        datetime.date(2011, 11, 2), 3),
+                         [(datetime.date(2011, 10, 30),
+                           datetime.date(2011, 11, 1)),
+                          (datetime.date(2011, 11, 2),
+                           datetime.date(2011, 11, 2))])
+    
+    def test_split(self):
+        """Split reports are merged back in transaction date order."""
+        start, end = datetime.date(2011, 10, 1), datetime.date(2011, 10, 10)
+        whole = transaction_reports(start, end)
+        split = transaction_reports(start, end, split_days=1, workers=5)
+        self.assertEqual(len(split), 20)
+        self.assertEqual(split, whole)
+        dates = [row['TransactionDate'] for row in split]
+        self.assertEqual(dates, sorted(dates))
+        columns = transaction_reports(start, end, split_days=3,
+                                      columnar=True)
+        self.assertEqual(len(columns), 20)
+        self.assertEqual(sum(columns['Amount']), 2000)
+        self.assertEqual(list(columns['OrderNumber']),
+                         [row['OrderNumber'] for row in whole])
+    
+    def test_cache(self):
+        """Only days whose reports may still change are fetched again."""
+        requests = []
+        def post(url, data, endpoint=None, merchant=None):
+            requests.append(dict(urlparse.parse_qsl(data)))
+            return fake_report(url, data, endpoint)
+        transport.post_chunks = chunked(post)
+        settings.SKIPJACK_REPORT_CACHE_DIR = tempfile.mkdtemp()
+        try:
+            today = datetime.date.today()
+            start = today - datetime.timedelta(days=5)
+            first = transaction_reports(start, today)
+            self.assertEqual(len(requests), 5)
+            second = transaction_reports(start, today)
+            self.assertEqual(len(requests), 6)
+            self.assertEqual(second, first)
+            self.assertEqual(len(second), 12)
+            # A different set of fields is a different report.
+            transaction_reports(start, today, extra_fields=('CardType',))
+            self.assertEqual(len(requests), 11)
+        finally:
+            shutil.rmtree(settings.SKIPJACK_REPORT_CACHE_DIR)
+            del settings.SKIPJACK_REPORT_CACHE_DIR
+    
+    def test_error_page(self):
+        """A page without report data raises rather than reporting none."""
+        def post(url, data, endpoint=None, merchant=None):
+            return '<html>Invalid login</html>'
+        transport.post_chunks = chunked(post)
+        self.assertRaises(TransactionError, transaction_reports)
+    
+    def test_pages(self):
+        """Pages are requested until one comes back short."""
+        pages = []
+        def post(url, data, endpoint=None, merchant=None):
+            fields = dict(urlparse.parse_qsl(data))
+            size, number = int(fields['sRecsPerPage']), \
+                           int(fields['sPageNumber'])
+            pages.append(number)
+            response = fake_report(url, data, endpoint)
+            start = response.index('-->') + 3
+            end = response.index('<!-- End')
+            lines = response[start:end].split('<br>\r\n')
+            lines = lines[:1] + lines[1 + (number - 1) * size:][:size]
+            return '<!-- Begin Data -->%s<!-- End Data -->' % \
+                                                    '<br>\r\n'.join(lines)
+        transport.post_chunks = chunked(post)
+        start, end = datetime.date(2011, 10, 1), datetime.date(2011, 10, 5)
+        rows = transaction_reports(start, end, sRecsPerPage=4)
+        self.assertEqual(pages, [1, 2, 3])
+        self.assertEqual([row['OrderNumber'] for row in rows],
+                         [row['OrderNumber'] for row in
+                          transaction_reports(start, end, sRecsPerPage=20)])
+        self.assertEqual(len(rows), 10)
+        del pages[:]
+        columns = transaction_reports(start, end, sRecsPerPage=5,
+                                      columnar=True)
+        self.assertEqual(pages, [1, 2, 3])
+        self.assertEqual(len(columns), 10)
+        # A report that ignores the page number isn't repeated forever.
+        transport.post_chunks = chunked(fake_report)
+        self.assertRaises(TransactionError, transaction_reports, start, end,
+                          sRecsPerPage=4)
+
+
+class ImportReportTestCase(TestCase):
+    """Test import_reports() against a stand in for Skipjack."""
+    def setUp(self):
+        self.old_post_chunks = transport.post_chunks
+        transport.post_chunks = chunked(fake_report)
+    
+    def tearDown(self):
+        transport.post_chunks = self.old_post_chunks
+    
+    def add_authorized(self):
+        return Transaction.objects.bulk_insert([Transaction(
+                            transaction_id='201110010100',
+                            order_number='2011100101', auth_code='123401',
+                            amount=Decimal('1.00'), return_code=1,
+                            approved='1', current_status=AUTHORIZED)])[0]
+    
+    def test_import(self):
+        """Missing rows are inserted and changed statuses updated."""
+        authorized = self.add_authorized()
+        start, end = datetime.date(2011, 10, 1), datetime.date(2011, 10, 3)
+        counts = import_reports(start, end, chunk_size=4)
+        self.assertEqual((counts['rows'], counts['created'],
+                          counts['updated'], counts['unchanged']),
+                         (6, 5, 1, 0))
+        self.assertEqual(Transaction.objects.count(), 6)
+        self.assertEqual(Transaction.objects.filter(
+                            current_status=SETTLED,
+                            status_text='Settled').count(), 6)
+        self.assertEqual(Transaction.objects.get(
+                            order_number='2011100101').pk, authorized.pk)
+        counts = import_reports(start, end, split_days=3)
+        self.assertEqual((counts['created'], counts['unchanged']), (0, 6))
+    
+    def test_archived(self):
+        """Rows of archived Transactions aren't inserted again."""
+        authorized = self.add_authorized()
+        Transaction.objects.filter(pk=authorized.pk).update(
+                                                    current_status=SETTLED)
+        archive(days=0)
+        counts = import_reports(datetime.date(2011, 10, 1),
+                                datetime.date(2011, 10, 1))
+        self.assertEqual((counts['created'], counts['unchanged']), (1, 1))
+        self.assertFalse(Transaction.objects.filter(
+                            order_number='2011100101').exists())
+    
+    def test_unknown_status(self):
+        """Rows with a status we don't know are skipped, not imported."""
+        authorized = self.add_authorized()
+        def post(url, data, endpoint=None, merchant=None):
+            return fake_report(url, data, endpoint).replace(',Settled,',
+                                                            ',Reversed,')
+        transport.post_chunks = chunked(post)
+        counts = import_reports(datetime.date(2011, 10, 1),
+                                datetime.date(2011, 10, 1))
+        self.assertEqual((counts['rows'], counts['created'],
+                          counts['updated'], counts['skipped']), (2, 0, 0, 2))
+        authorized = Transaction.objects.get(pk=authorized.pk)
+        self.assertEqual(authorized.current_status, AUTHORIZED)
+        self.assertEqual(Transaction.objects.count(), 1)
+    
+    def test_rollups(self):
+        """Imported rows and status changes are counted in the rollups."""
+        settings.SKIPJACK_ROLLUPS = True
+        try:
+            self.add_authorized()
+            import_reports(datetime.date(2011, 10, 1),
+                           datetime.date(2011, 10, 2))
+            rollups = DailyRollup.objects.filter(count__gt=0)
+            self.assertEqual(set(rollup.current_status
+                                 for rollup in rollups), set([SETTLED]))
+            self.assertEqual(sum(rollup.count for rollup in rollups), 4)
+        finally:
+            del settings.SKIPJACK_ROLLUPS
+
+
+class ExportTestCase(TestCase):
+    """Test the CSV export of Transactions."""
+    def setUp(self):
+        Transaction.objects.bulk_insert([
+            Transaction(transaction_id='%012d' % i, order_number=str(i),
+                        amount=Decimal(i), return_code=1,
+                        status_text=u'Settled \u2713')
+            for i in range(1, 6)])
+    
+    def test_export(self):
+        """Every row is exported, whatever the chunk size."""
+        queryset = Transaction.objects.exclude(order_number='3')
+        chunks = list(export_csv(queryset, fields=('order_number', 'amount',
+                                                   'status_text',
+                                                   'status_date'),
+                                 chunk_size=2))
+        self.assertEqual(len(chunks), 2)
+        rows = list(csv.reader(StringIO(''.join(chunks))))
+        self.assertEqual(rows[0], ['order_number', 'amount', 'status_text',
+                                   'status_date'])
+        self.assertEqual([row[0] for row in rows[1:]], ['1', '2', '4', '5'])
+        self.assertEqual(rows[1][1:], ['1.00', 'Settled \xe2\x9c\x93', ''])
+        self.assertEqual(len(list(export_csv(queryset.none()))), 1)
+    
+    def test_admin_action(self):
+        """The admin action streams the selected transactions."""
+        model_admin = TransactionAdmin(Transaction, admin.site)
+        response = model_admin.export_as_csv(None, Transaction.objects.all())
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(len(list(csv.reader(StringIO(''.join(response))))),
+                         6)
+
+
+class CountTestCase(TestCase):
+    """Test the admin's cached counts."""
+    def setUp(self):
+        settings.SKIPJACK_ADMIN_COUNTS = 'cached'
+        self.add('1')
+    
+    def tearDown(self):
+        del settings.SKIPJACK_ADMIN_COUNTS
+    
+    def add(self, order_number):
+        return Transaction.objects.create(order_number=order_number,
+                                          amount=Decimal('1.00'),
+                                          return_code=1)
+    
+    def test_cached(self):
+        """Counts and dates are cached until a Transaction is created."""
+        queryset = Transaction.objects.all()._clone(klass=CountingQuerySet)
+        authorized = queryset.filter(current_status=AUTHORIZED)
+        self.assertEqual(authorized.count(), 0)
+        self.assertEqual(len(queryset.dates('creation_date', 'day')), 1)
+        # Status changes aren't noticed until the cached count expires.
+        Transaction.objects.update(current_status=AUTHORIZED)
+        self.assertEqual(authorized.count(), 0)
+        self.add('2')
+        self.assertEqual(authorized.count(), 1)
+        self.assertEqual(queryset.count(), 2)
+        self.assertEqual(queryset.filter(order_number='3').count(), 0)
+
+
+class RollupTestCase(TestCase):
+    """Test the DailyRollups are kept up to date."""
+    def setUp(self):
+        settings.SKIPJACK_ROLLUPS = True
+    
+    def tearDown(self):
+        del settings.SKIPJACK_ROLLUPS
+    
+    def add(self, amount, approved='1'):
+        return Transaction.objects.create(order_number='1', approved=approved,
+                                          amount=Decimal(amount),
+                                          return_code=1,
+                                          current_status=AUTHORIZED)
+    
+    def rollups(self):
+        return sorted((rollup.current_status, rollup.approved, rollup.count,
+                       rollup.amount) for rollup in DailyRollup.objects.all())
+    
+    def test_incremental(self):
+        """Creating, changing and deleting Transactions adjusts the totals."""
+        first = self.add('10.00')
+        self.add('5.50')
+        self.add('1.00', approved='0')
+        self.assertEqual(self.rollups(), [
+            (AUTHORIZED, '0', 1, Decimal('1.00')),
+            (AUTHORIZED, '1', 2, Decimal('15.50'))])
+        first.current_status = SETTLED
+        first.save()
+        Transaction.objects.get(pk=first.pk).save()
+        self.assertEqual(self.rollups(), [
+            (AUTHORIZED, '0', 1, Decimal('1.00')),
+            (AUTHORIZED, '1', 1, Decimal('5.50')),
+            (SETTLED, '1', 1, Decimal('10.00'))])
+        Transaction.objects.get(pk=first.pk).delete()
+        self.assertEqual(self.rollups()[-1], (SETTLED, '1', 0, Decimal('0')))
+        incremental = self.rollups()
+        self.assertEqual(DailyRollup.objects.rebuild(), 2)
+        self.assertEqual(self.rollups(), [rollup for rollup in incremental
+                                          if rollup[2]])
+    
+    def test_summary(self):
+        """The dashboard totals the rollups by day and return code."""
+        self.add('10.00')
+        self.add('1.00', approved='0')
+        daily, overall, return_codes = summarize_rollups(
+                                                    DailyRollup.objects.all())
+        self.assertEqual(len(daily), 1)
+        self.assertEqual((overall['count'], overall['amount'],
+                          overall['approved_count'],
+                          overall['approved_amount']),
+                         (2, Decimal('11.00'), 1, Decimal('10.00')))
+        self.assertEqual(overall['statuses'][AUTHORIZED], 2)
+        self.assertEqual(return_codes, [(1, 'Success', 2, Decimal('11.00'))])
+
+
+class ArchiveTestCase(TestCase):
+    """Test old Transactions in a final state are archived."""
+    def add(self, order_number, current_status, pending_status=0, days=100):
+        payment = Transaction.objects.create(order_number=order_number,
+                                        amount=Decimal('1.00'), return_code=1,
+                                        current_status=current_status,
+                                        pending_status=pending_status)
+        created = datetime.datetime.now() - datetime.timedelta(days=days)
+        Transaction.objects.filter(pk=payment.pk).update(
+                                                    creation_date=created)
+        return Transaction.objects.get(pk=payment.pk)
+    
+    def test_archive(self):
+        """Only old, final Transactions are moved, and without side effects."""
+        settled = self.add('1', SETTLED)
+        self.add('2', AUTHORIZED)
+        self.add('3', SETTLED, pending_status=PENDING_SETTLEMENT)
+        self.add('4', SETTLED, days=1)
+        self.assertEqual(archive(batch_size=1), 1)
+        self.assertEqual(Transaction.objects.count(), 3)
+        archived = ArchivedTransaction.objects.get()
+        self.assertEqual((archived.pk, archived.order_number,
+                          archived.creation_date, archived.amount),
+                         (settled.pk, '1', settled.creation_date,
+                          Decimal('1.00')))
+        self.assertFalse(QueuedStatusChange.objects.exists())
+        self.assertEqual(archive(), 0)
+        self.assertEqual(archive(days=0), 1)
+        self.assertEqual([payment.order_number for payment in
+                          history(current_status=SETTLED)], ['4', '3', '1'])
+    
+    def test_large_batch(self):
+        """Batches are selected by pk range, not by binding every pk."""
+        Transaction.objects.bulk_insert([Transaction(
+                            order_number=str(i), amount=Decimal('1.00'),
+                            return_code=1, current_status=SETTLED)
+                            for i in range(1200)])
+        Transaction.objects.update(creation_date=datetime.datetime.now() -
+                                                 datetime.timedelta(days=100))
+        self.assertEqual(archive(batch_size=2000), 1200)
+        self.assertEqual(ArchivedTransaction.objects.count(), 1200)
+    
+    def test_rollups(self):
+        """Rebuilt rollups still count the archived Transactions."""
+        settings.SKIPJACK_ROLLUPS = True
+        try:
+            self.add('1', SETTLED)
+            archive()
+            self.assertEqual(DailyRollup.objects.rebuild(), 1)
+            self.assertEqual(DailyRollup.objects.get().count, 1)
+        finally:
+            del settings.SKIPJACK_ROLLUPS
+    
+    def test_admin(self):
+        """The admin can't add, change or delete archived Transactions."""
+        model_admin = ArchivedTransactionAdmin(ArchivedTransaction, admin.site)
+        self.assertFalse(model_admin.has_add_permission(None))
+        self.assertFalse(model_admin.has_delete_permission(None))
+        self.assertEqual(set(model_admin.get_readonly_fields(None)),
+                         set(field.name for field in
+                             ArchivedTransaction._meta.fields))
+
+
+class MerchantTestCase(TestCase):
+    """Test requests are made for the Transaction's merchant account."""
+    def setUp(self):
+        settings.SKIPJACK_MERCHANTS = {'outlet': {
+            'SERIAL_NUMBER': '000999888777',
+            'RATE_LIMITS': {'status': 100},
+        }}
+        self.old_post = transport.post
+        self.skipjack = FakeSkipjack({'0001': '30', '0002': '30'})
+        self.requests = []
+        transport.post = self.post
+    
+    def tearDown(self):
+        transport.post = self.old_post
+        for merchant in ('', 'outlet'):
+            ratelimit._buckets.pop(('status', merchant), None)
+        del settings.SKIPJACK_MERCHANTS
+    
+    def post(self, url, data, endpoint=None, merchant=None):
+        fields = dict(urlparse.parse_qsl(data))
+        self.requests.append((merchant, fields.get('SerialNumber') or
+                                        fields.get('szSerialNumber')))
+        if endpoint == 'authorize':
+            return fake_authorize(url, data)
+        return self.skipjack(url, data)
+    
+    def test_merchants(self):
+        """Unset credentials default to the SKIPJACK_* settings."""
+        self.assertEqual(merchant_names(), ['', 'outlet'])
+        self.assertEqual(get_merchant('outlet').sz_default_list, [
+            ('szSerialNumber', '000999888777'),
+            ('szDeveloperSerialNumber',
+             settings.SKIPJACK_DEVELOPER_SERIAL_NUMBER)])
+        self.assertEqual(dict(get_merchant().default_list)['SerialNumber'],
+                         settings.SKIPJACK_SERIAL_NUMBER)
+        self.assertRaises(ImproperlyConfigured, get_merchant, 'missing')
+        self.assertNotEqual(transport.get_pool('https', 'example.com'),
+                            transport.get_pool('https', 'example.com',
+                                               'outlet'))
+        self.assertEqual(ratelimit.get_bucket('status'), None)
+        self.assertNotEqual(ratelimit.get_bucket('status', 'outlet'), None)
+    
+    def test_routing(self):
+        """A Transaction's requests use its merchant's credentials."""
+        payment = create_transaction({'OrderNumber': '1'}, merchant='outlet')
+        payment = Transaction.objects.get(pk=payment.pk)
+        self.assertEqual(payment.merchant, 'outlet')
+        payment.update_status()
+        self.assertEqual(self.requests, [('outlet', '000999888777')] * 2)
+        payment.delete()
+        self.assertEqual(QueuedStatusChange.objects.get().merchant, 'outlet')
+    
+    def test_sync(self):
+        """The sync command syncs every merchant's Transactions at once."""
+        for transaction_id, merchant in (('0001', ''), ('0002', 'outlet')):
+            Transaction.objects.create(transaction_id=transaction_id,
+                                       order_number='1', merchant=merchant,
+                                       amount=Decimal('1.00'), return_code=1,
+                                       current_status=AUTHORIZED)
+        call_command('sync_skipjack_transactions', workers=2,
+                     stdout=StringIO())
+        self.assertEqual(sorted(self.requests), [
+            ('', settings.SKIPJACK_SERIAL_NUMBER),
+            ('outlet', '000999888777')])
+        self.assertEqual(Transaction.objects.filter(
+                            current_status=SETTLED).count(), 2)
+
+
+class SettlementTestCase(TestCase):
+    """Authorized Transactions are settled, and the batch closed, on time."""
+    def setUp(self):
+        self.old_post = transport.post
+        self.skipjack = transport.post = FakeSkipjack({'0001': '17'})
+    
+    def tearDown(self):
+        transport.post = self.old_post
+    
+    def create(self, transaction_id, **kwargs):
+        values = dict(transaction_id=transaction_id, order_number='12345',
+                      amount=Decimal('150.00'), return_code=1,
+                      auth_code='123456', current_status=AUTHORIZED)
+        values.update(kwargs)
+        return Transaction.objects.create(**values)
+    
+    def test_settle(self):
+        """Only approved, Authorized, Transactions with nothing pending."""
+        self.create('0001')
+        self.create('0002', pending_status=SUBMITTED_FOR_SETTLEMENT)
+        self.create('0003', current_status=SETTLED)
+        self.create('0004', auth_code='')
+        self.create('0005', merchant='outlet')
+        self.assertEqual(settle(hours=1), (0, 0))
+        self.assertEqual(settle(workers=2), (1, 0))
+        self.assertEqual(self.skipjack.changes, [('0001', 'SETTLE')])
+        payment = Transaction.objects.get(transaction_id='0001')
+        self.assertEqual(payment.pending_status, SUBMITTED_FOR_SETTLEMENT)
+        self.assertEqual(payment.status_text,
+                         'Authorized, Submitted for Settlement')
+        self.assertEqual(settle(), (0, 0))
+    
+    def test_claim(self):
+        """Overlapping runs don't both settle the same Transaction."""
+        payment = self.create('0001')
+        self.assertEqual(list(claim([payment])), [payment])
+        self.assertEqual(list(claim([payment])), [])
+        self.assertEqual(settle(), (0, 0))
+        self.assertEqual(self.skipjack.changes, [])
+    
+    def test_refused(self):
+        """Settlements Skipjack refuses are left for the next run."""
+        self.create('0001')
+        def refuse(url, data, endpoint=None, merchant=None):
+            return ('"000111222333","1","","","","",""\r\n'
+                    '"000111222333","0.00","SETTLE","UNSUCCESSFUL",'
+                    '"Busy","12345","0001"\r\n')
+        transport.post = refuse
+        self.assertEqual(settle(), (0, 1))
+        transport.post = self.skipjack
+        self.assertEqual(settle(), (1, 0))
+    
+    def test_close(self):
+        """The batch is closed once after the cutoff, and then synced."""
+        self.create('0001', pending_status=SUBMITTED_FOR_SETTLEMENT)
+        self.skipjack.statuses['0001'] = '30'
+        today = datetime.date.today()
+        before = datetime.datetime.combine(today, datetime.time(20, 59))
+        after = datetime.datetime.combine(today, datetime.time(21, 0))
+        settings.SKIPJACK_BATCH_CUTOFF = '21:00'
+        try:
+            self.assertEqual(scheduled_close(now=before), None)
+            self.assertEqual(scheduled_close(now=after), ('Success', 1, 0))
+            # Whichever process the next run is in.
+            cache.clear()
+            self.assertEqual(scheduled_close(now=after), None)
+            self.assertEqual(ClosedBatch.objects.get().response, 'Success')
+        finally:
+            del settings.SKIPJACK_BATCH_CUTOFF
+        self.assertEqual(self.skipjack.changes, [(None, 'CLOSE')])
+        self.assertEqual(Transaction.objects.get().current_status, SETTLED)
+        # The command settles, then closes the batch when told to.
+        self.create('0002')
+        output = StringIO()
+        call_command('settle_skipjack_transactions', close=True,
+                     stdout=output)
+        self.assertEqual(self.skipjack.changes[1:], [('0002', 'SETTLE'),
+                                                     (None, 'CLOSE')])
+        self.assertEqual(output.getvalue(),
+                         'Settled 1 transactions.\n'
+                         'Closed the batch: Success. Synced 1 '
+                         'transactions.\n')
+    
+    def test_close_failed(self):
+        """If the close doesn't succeed, the next run tries again."""
+        today = datetime.date.today()
+        after = datetime.datetime.combine(today, datetime.time(21, 0))
+        def fail(url, data, endpoint=None, merchant=None):
+            return '"000111222333","-15"' + ',""' * 10
+        transport.post = fail
+        settings.SKIPJACK_BATCH_CUTOFF = '21:00'
+        try:
+            self.assertEqual(scheduled_close(now=after), ('Failure', 0, 0))
+            transport.post = self.skipjack
+            self.assertEqual(scheduled_close(now=after), ('Success', 0, 0))
+            self.assertEqual(scheduled_close(now=after), None)
+        finally:
+            del settings.SKIPJACK_BATCH_CUTOFF
+
+
+BATCH_REPORT_RESPONSE = ('<html><!-- Begin Data -->'
+                         'TransactionDate,OrderNumber,Amount,BatchNumber,'
+                         '<br>\r\n'
+                         '%(date)s 1:02:03 PM,1,$10.00,1001,<br>\r\n'
+                         '%(date)s 1:02:04 PM,2,$20.50,1001,<br>\r\n'
+                         '%(date)s 1:02:05 PM,2,($5.00),1001,<br>\r\n'
+                         '%(date)s 1:02:06 PM,3,$7.00,1002,<br>\r\n'
+                         '%(date)s 1:02:07 PM,4,$3.00,1003,<br>\r\n'
+                         '%(date)s 1:02:08 PM,5,$9.00,,<br>\r\n'
+                         '<!-- End Data --></html>')
+
+
+class ReconcileTestCase(TestCase):
+    """Batch totals are compared with the database's."""
+    def setUp(self):
+        self.old_post_chunks = transport.post_chunks
+        self.today = datetime.date.today()
+        def post(url, data, endpoint=None, merchant=None):
+            self.assertTrue('showBatchNumber=Y' in data)
+            return BATCH_REPORT_RESPONSE % {
+                        'date': self.today.strftime('%m/%d/%Y')}
+        transport.post_chunks = chunked(post)
+    
+    def tearDown(self):
+        transport.post_chunks = self.old_post_chunks
+    
+    def create(self, model, batch_number, amount):
+        return model.objects.create(transaction_id='0001', order_number='1',
+                                    amount=Decimal(amount), return_code=1,
+                                    current_status=SETTLED,
+                                    batch_number=batch_number)
+    
+    def test_reconcile(self):
+        """Only the batches that don't match are reported."""
+        self.create(Transaction, '1001', '10.00')
+        self.create(ArchivedTransaction, '1001', '20.50')
+        self.create(Transaction, '1002', '8.00')
+        self.create(Transaction, '1004', '1.00')
+        self.create(Transaction, '', '9.00')
+        self.assertEqual(reconcile(self.today, self.today), [
+            ('1002', (1, 700), (1, 800)),
+            ('1003', (1, 300), None),
+            ('1004', None, (1, 100))])
+        output = StringIO()
+        call_command('reconcile_skipjack_batches',
+                     start=self.today.strftime('%Y-%m-%d'), stdout=output)
+        self.assertEqual(output.getvalue(),
+                         'Batch 1002: Skipjack 1 for 7.00, database 1 for '
+                         '8.00.\n'
+                         'Batch 1003: Skipjack 1 for 3.00, database '
+                         'missing.\n'
+                         'Batch 1004: Skipjack missing, database 1 for '
+                         '1.00.\n')
+    
+    def test_status(self):
+        """The batch number is kept as the status is synced."""
+        old_post = transport.post
+        transport.post = FakeSkipjack({'0001': '30'})
+        try:
+            payment = self.create(Transaction, '', '10.00')
+            payment.update_status()
+        finally:
+            transport.post = old_post
+        self.assertEqual(Transaction.objects.get().batch_number, '1042')
+    
+    def test_credited_status(self):
+        """A credit later in the order's history doesn't move the sale."""
+        def post(url, data, endpoint=None, merchant=None):
+            return ('"000111222333","2","","","","","","",""\r\n'
+                    '"000111222333","10.00","30","Message","1",'
+                    '"10/19/11 13:02:03","0001","123456","1042"\r\n'
+                    '"000111222333","-10.00","40","Message","1",'
+                    '"10/20/11 13:02:03","0002","123456","1050"')
+        old_post = transport.post
+        transport.post = post
+        try:
+            payment = self.create(Transaction, '', '10.00')
+            Transaction.objects.filter(pk=payment.pk).update(
+                            auth_code='123456', auth_response_code='123456')
+            Transaction.objects.get(pk=payment.pk).update_status()
+        finally:
+            transport.post = old_post
+        self.assertEqual(Transaction.objects.get().batch_number, '1042')
+
+
+class CreditCardTestCase(unittest.TestCase):
+    """Test credit card number validation."""
+    def test_verify(self):
+        """Numbers are typed, or given the reason they're invalid."""
+        numbers = ['4012 8888 8888 1881', '5105-1051-0510-5100',
+                   u'378282246310005', '4111111111111112', '1234567812345670',
+                   'abc', None, '6011000000000004', '36000000000008']
+        self.assertEqual(list(verify_credit_cards(numbers)), [
+            (None, TEST_NUMBER), (None, TEST_NUMBER), (None, TEST_NUMBER),
+            (None, FAILED_MOD10), (None, UNKNOWN_TYPE), (None, NOT_A_NUMBER),
+            (None, NOT_A_NUMBER), ('Discover', None), ('Dinersclub', None)])
+        self.assertEqual([card for card, reason in verify_credit_cards(
+                            numbers, allow_test=True)],
+                         ['Visa', 'Mastercard', 'Amex', None, None, None,
+                          None, 'Discover', 'Dinersclub'])
+        self.assertEqual([verify_credit_card(number, allow_test=True)
+                          for number in numbers],
+                         [card for card, reason in verify_credit_cards(
+                            numbers, allow_test=True)])
+    
+    def test_iin_ranges(self):
+        """Types come from the narrowest IIN range, for valid lengths."""
+        self.assertEqual([card_type(number) for number in (
+                            '2221000000000009', '3530111333300000',
+                            '6200000000000005', '6221260000000000',
+                            '6759649826438453', '4222222222222',
+                            '42222222222222', '9999999999999995')],
+                         ['Mastercard', 'JCB', 'UnionPay', 'Discover',
+                          'Maestro', 'Visa', None, None])
+        table = IINTable([('1', '1', 'One', frozenset([4])),
+                          ('12', '13', 'Twelve', frozenset([4])),
+                          ('14', '14', 'One', frozenset([4]))])
+        self.assertEqual(len(table), 4)
+        self.assertEqual([table.lookup(number) for number in
+                          ('1000', '1299', '1300', '1400', '1999', '2000')],
+                         ['One', 'Twelve', 'Twelve', 'One', 'One', None])
+    
+    def test_load(self):
+        """The ranges can be read from another file."""
+        path = tempfile.mktemp()
+        data = open(path, 'wb')
+        data.write('# Test ranges\n9,9,Nines,16\n')
+        data.close()
+        try:
+            load_iin_table(path)
+            self.assertEqual(card_type('9999999999999999'), 'Nines')
+            self.assertEqual(card_type('4111111111111111'), None)
+        finally:
+            os.remove(path)
+            load_iin_table()
+        self.assertEqual(card_type('4111111111111111'), 'Visa')
@@ -0,0 +1,325 @@
+"""
+HTTP transport used by the helpers to talk to Skipjack.
+
+Keeps a pool of keep-alive connections per host (and merchant account,
+see skipjack.merchants), so that concurrent and repeated requests don't each
+pay for a new TCP connection and TLS handshake the way urllib2.urlopen does.
+
+Responses may be gzip or deflate compressed, and are decompressed as they
+are read. Requests and responses can be recorded for replaying offline, see
+skipjack.recording, and connections can be opened ahead of the first
+request, see skipjack.prewarm.
+
+Optional settings:
+    SKIPJACK_POOL_SIZE - idle connections kept per host (default 10), or
+        the merchant account's POOL_SIZE.
+    SKIPJACK_TIMEOUT - socket timeout in seconds (default None, no timeout).
+    SKIPJACK_RECORD_FILE - see skipjack.recording.
+
+"""
+import errno
+import httplib
+import select
+import socket
+import threading
+import time
+import urllib2
+import urlparse
+import zlib
+
+from django.conf import settings
+
+from skipjack import ratelimit
+from skipjack.merchants import get_merchant
+
+
+DEFAULT_POOL_SIZE = 10
+
+# Bytes read from the socket at a time by post_chunks().
+CHUNK_SIZE = 64 * 1024
+
+HEADERS = {'Content-Type': 'application/x-www-form-urlencoded',
+           'Connection': 'keep-alive',
+           'Accept-Encoding': 'gzip, deflate'}
+
+# Errors that mean a reused connection was closed by the other end while it
+# sat idle.
+STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+# Endpoints whose requests can safely be sent twice. The others (authorize,
+# change_status, close_batch) charge, refund or settle, so are never resent
+# once Skipjack may have received them.
+IDEMPOTENT_ENDPOINTS = ('status', 'report')
+
+
+class ConnectionPool(object):
+    """A thread safe pool of keep-alive connections to one host."""
+    def __init__(self, scheme, host, maxsize=DEFAULT_POOL_SIZE, timeout=None):
+        self.scheme = scheme
+        self.host = host
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # (connection, time it was last used) tuples, most recent last.
+        self.idle = []
+
+    def new_connection(self):
+        """Returns a new (unconnected) connection to the host."""
+        if self.scheme == 'https':
+            connection_class = httplib.HTTPSConnection
+        else:
+            connection_class = httplib.HTTPConnection
+        return connection_class(self.host, timeout=self.timeout)
+
+    def get(self):
+        """
+        Returns a tuple of (connection, reused), preferring the most recently
+        used idle connection.
+
+        """
+        self.lock.acquire()
+        try:
+            if self.idle:
+                return self.idle.pop()[0], True
+        finally:
+            self.lock.release()
+        return self.new_connection(), False
+
+    def put(self, connection):
+        """Returns a connection to the pool, closing it if the pool is full."""
+        self.lock.acquire()
+        try:
+            if len(self.idle) < self.maxsize:
+                self.idle.append((connection, time.time()))
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def clear(self):
+        """Closes all idle connections."""
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.lock.release()
+        for connection, since in idle:
+            connection.close()
+
+    def warm(self, count):
+        """
+        Opens new connections until `count` (at most maxsize) are idle,
+        returning the number opened. Connection errors are raised.
+
+        """
+        self.lock.acquire()
+        try:
+            needed = min(count, self.maxsize) - len(self.idle)
+        finally:
+            self.lock.release()
+        for i in xrange(needed):
+            connection = self.new_connection()
+            connection.connect()
+            self.put(connection)
+        return max(0, needed)
+
+    def expire(self, max_idle):
+        """
+        Closes the connections that have been idle for more than `max_idle`
+        seconds, before the other end can time them out, returning the
+        number closed.
+
+        """
+        cutoff = time.time() - max_idle
+        self.lock.acquire()
+        try:
+            expired = [connection for connection, since in self.idle
+                       if since < cutoff]
+            self.idle = [(connection, since) for connection, since in self.idle
+                         if since >= cutoff]
+        finally:
+            self.lock.release()
+        for connection in expired:
+            connection.close()
+        return len(expired)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(scheme, host, merchant=None):
+    """
+    Returns the shared ConnectionPool for the given scheme and host, and
+    merchant account.
+
+    """
+    key = (scheme, host, merchant or '')
+    pool = _pools.get(key)
+    if pool is None:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(
+                    scheme, host,
+                    maxsize=get_merchant(merchant).get('POOL_SIZE',
+                                                       DEFAULT_POOL_SIZE),
+                    timeout=getattr(settings, 'SKIPJACK_TIMEOUT', None))
+                _pools[key] = pool
+        finally:
+            _pools_lock.release()
+    return pool
+
+
+def is_stale(error):
+    """True if the error means an idle keep-alive connection went away."""
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and error.errno in STALE_ERRNOS
+
+
+def is_dropped(connection):
+    """
+    True if an idle connection has been closed by the other end: its socket
+    is readable (at end of file) while no response is expected.
+
+    """
+    if connection.sock is None:
+        return False
+    try:
+        return bool(select.select([connection.sock], [], [], 0)[0])
+    except (select.error, socket.error, ValueError):
+        return True
+
+
+class Decoder(object):
+    """
+    Decompresses a response body a chunk at a time, according to its
+    Content-Encoding.
+
+    """
+    def __init__(self, encoding):
+        self.encoding = (encoding or 'identity').strip().lower()
+        if self.encoding in ('gzip', 'x-gzip'):
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.decompressor = None
+        self.started = False
+
+    def decompress(self, chunk):
+        if self.decompressor is None:
+            return chunk
+        if self.encoding == 'deflate' and not self.started:
+            self.started = True
+            try:
+                return self.decompressor.decompress(chunk)
+            except zlib.error:
+                # Some servers send raw deflate data, without the zlib
+                # header the specification calls for.
+                self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self.decompressor.decompress(chunk)
+
+    def flush(self):
+        if self.decompressor is None:
+            return ''
+        return self.decompressor.flush()
+
+
+def post(url, data, endpoint=None, merchant=None):
+    """
+    POSTs the urlencoded data to the url and returns the response body.
+
+    endpoint names the Skipjack endpoint (e.g. 'authorize') for the purposes
+    of rate limiting, see skipjack.ratelimit, and merchant the merchant
+    account the request is for, whose connections and rate limits are used.
+
+    Raises urllib2.HTTPError for non 200 responses, the same as the
+    urllib2.urlopen calls this replaces.
+
+    Pooled connections the other end has closed while idle are discarded
+    before the request is sent. A request that couldn't be sent because a
+    pooled connection had gone is sent again on a new connection. One that
+    was sent but got no response is only sent again for the
+    IDEMPOTENT_ENDPOINTS, as Skipjack may have processed it.
+
+    """
+    return ''.join(post_chunks(url, data, endpoint, merchant))
+
+
+def post_chunks(url, data, endpoint=None, merchant=None):
+    """
+    As post(), but yields the (decompressed) response body a chunk at a
+    time as it's received, so that large responses can be processed without
+    holding the whole body in memory.
+
+    The connection is only returned to the pool if the body is read to the
+    end.
+
+    """
+    from skipjack.recording import get_recorder
+    recorder = get_recorder()
+    chunks = _post_chunks(url, data, endpoint, merchant)
+    if recorder is None:
+        return chunks
+    return recorder.record(url, data, endpoint, merchant, chunks)
+
+
+def _post_chunks(url, data, endpoint=None, merchant=None):
+    """The generator behind post_chunks()."""
+    if endpoint:
+        ratelimit.acquire(endpoint, merchant)
+    scheme, host, path, query, _ = urlparse.urlsplit(url)
+    if query:
+        path = '%s?%s' % (path, query)
+    pool = get_pool(scheme, host, merchant)
+    connection, reused = pool.get()
+    while reused and is_dropped(connection):
+        connection.close()
+        connection, reused = pool.get()
+    finished = False
+    try:
+        try:
+            connection.request('POST', path, data, HEADERS)
+        except (httplib.HTTPException, socket.error), e:
+            # Not sent, so safe to send again whatever the endpoint.
+            connection.close()
+            if not (reused and is_stale(e)):
+                raise
+            connection = pool.new_connection()
+            connection.request('POST', path, data, HEADERS)
+            reused = False
+        try:
+            response = connection.getresponse()
+        except (httplib.HTTPException, socket.error), e:
+            connection.close()
+            if not (reused and is_stale(e) and
+                    endpoint in IDEMPOTENT_ENDPOINTS):
+                raise
+            connection = pool.new_connection()
+            connection.request('POST', path, data, HEADERS)
+            response = connection.getresponse()
+        if response.status != 200:
+            response.read()
+            finished = True
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        decoder = Decoder(response.getheader('content-encoding'))
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            chunk = decoder.decompress(chunk)
+            if chunk:
+                yield chunk
+        chunk = decoder.flush()
+        finished = True
+        if chunk:
+            yield chunk
+    finally:
+        if finished and not response.will_close:
+            pool.put(connection)
+        else:
+            connection.close()
@@ -4,47 +4,94 @@ Utility methods to aid usage of Skipjack.
 Included utility functions:
     create_transaction(data)
 
+    create_transactions(data_iterable, workers=None, batch_size=100)
+
     get_transaction_status(order_number, transaction_id=None)
 
     change_transaction_status(transaction_id, desired_status, amount=None)
 
+Each also takes a merchant argument, the name of the merchant account (see
+skipjack.merchants) to make the requests for, the default account if not
+given.
+
 """
 import datetime
 from decimal import Decimal
+import sys
+import threading
 
 from django.conf import settings
+from django.db import transaction
 
+from skipjack import reportcache
+from skipjack.merchants import get_merchant
 from skipjack.helpers import PaymentHelper, StatusHelper, ChangeStatusHelper, \
                              CloseBatchHelper, StatusHistoryHelper, \
                              ReportHelper
-from skipjack.models import Transaction, Status, StatusChange, \
+from skipjack.models import Transaction, BulkTransactionError, \
                             CLOSE_BATCH_STATUS_CHOICES, \
-                            SETTLED, CREDITED, SPLIT_SETTLED
-from skipjack.signals import payment_was_successful, payment_was_flagged
+                            SETTLED, CREDITED, SPLIT_SETTLED, \
+                            dispatch_payment_signals
+from skipjack.parsers import ReportColumns, parse_report_data
+from skipjack.workers import imap_unordered
+
+
+# The default merchant account's request fields.
+DEFAULT_LIST = get_merchant().default_list
 
+SZ_DEFAULT_LIST = get_merchant().sz_default_list
 
-DEFAULT_LIST = [
-    ('SerialNumber', settings.SKIPJACK_SERIAL_NUMBER),
-    ('DeveloperSerialNumber', settings.SKIPJACK_DEVELOPER_SERIAL_NUMBER)
-]
+REPORT_DEFAULT_LIST = get_merchant().report_default_list
 
-SZ_DEFAULT_LIST = [
-    ('szSerialNumber', settings.SKIPJACK_SERIAL_NUMBER),
-    ('szDeveloperSerialNumber', settings.SKIPJACK_DEVELOPER_SERIAL_NUMBER)
-]
+DEFAULT_BATCH_SIZE = 100
 
-REPORT_DEFAULT_LIST = [
-    ('sSerialNumber_Merchant', settings.SKIPJACK_SERIAL_NUMBER),
-    ('sSerialNumber_Login', settings.SKIPJACK_LOGIN_SERIAL_NUMBER),
-    ('sUsername', settings.SKIPJACK_LOGIN_USERNAME),
-    ('sPassword', settings.SKIPJACK_LOGIN_PASSWORD),
-]
 
-def create_transaction(data):
+class SingleFlight(object):
     """
-    Creates a Transaction in the database based on the returned data from
-    Skipjack to an authorize request.
-    Sends signals payment_was_successful or payment_was_flagged.
+    Concurrent calls made through do() with the same key share a single
+    in-flight call, and its result (or exception).
+    
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+    
+    def do(self, key, func, *args, **kwargs):
+        self.lock.acquire()
+        try:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event()}
+        finally:
+            self.lock.release()
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                error = call['error']
+                raise error[0], error[1], error[2]
+            return call['result']
+        try:
+            try:
+                call['result'] = func(*args, **kwargs)
+            except:
+                call['error'] = sys.exc_info()
+                raise
+        finally:
+            self.lock.acquire()
+            try:
+                del self.calls[key]
+            finally:
+                self.lock.release()
+            call['done'].set()
+        return call['result']
+
+_in_flight = SingleFlight()
+
+
+def _authorize(data, merchant=None):
+    """
+    Sends an authorize request and returns the Skipjack response dict.
     
     Data must be coerced to a list so we can ensure the Skipjack serial
     numbers go first, and in the correct order ('SerialNumber' followed by
@@ -55,18 +102,122 @@ def create_transaction(data):
         data = data.items()
     elif type(data) is tuple:
         data = list(data)
-    helper = PaymentHelper(defaults=DEFAULT_LIST)
+    helper = PaymentHelper(defaults=get_merchant(merchant).default_list,
+                           merchant=merchant)
     response_dict = helper.get_response(data)
     response_dict['is_live'] = not settings.SKIPJACK_DEBUG
-    response = Transaction.objects.create_from_dict(response_dict)
-    if response.is_approved:
-        payment_was_successful.send(sender=response)
-    else:
-        payment_was_flagged.send(sender=response)
-    return response
+    response_dict['merchant'] = merchant or ''
+    return response_dict
+
+
+def create_transaction(data, merchant=None):
+    """
+    Creates a Transaction in the database based on the returned data from
+    Skipjack to an authorize request.
+    
+    Signals payment_was_successful or payment_was_flagged are sent (once)
+    when the Transaction is saved, see models.send_payment_signals.
+    
+    """
+    return Transaction.objects.create_from_dict(_authorize(data, merchant))
+
+
+def _create_batch(response_dicts):
+    """
+    Bulk insert Transactions, then send their payment signals.
+    
+    Every response is a charge at Skipjack, so if the bulk insert fails they
+    are inserted one at a time (sending their signals as they're saved)
+    rather than all being lost. BulkTransactionError lists the responses
+    that still couldn't be stored.
+    
+    Each insert is made in a savepoint, rolled back if it fails, so that
+    under transaction management a failed insert doesn't abort the database
+    transaction (as it does on PostgreSQL) for the inserts after it.
+    
+    """
+    sid = transaction.savepoint()
+    try:
+        payments = Transaction.objects.bulk_create_from_dict(response_dicts)
+        transaction.savepoint_commit(sid)
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        payments = []
+        failures = []
+        for response_dict in response_dicts:
+            sid = transaction.savepoint()
+            try:
+                payments.append(
+                        Transaction.objects.create_from_dict(response_dict))
+                transaction.savepoint_commit(sid)
+            except Exception:
+                failures.append((response_dict, sys.exc_info()))
+                transaction.savepoint_rollback(sid)
+        if failures:
+            raise BulkTransactionError(failures)
+        return payments
+    for payment in payments:
+        dispatch_payment_signals(payment)
+    return payments
+
+
+def create_transactions(data_iterable, workers=None,
+                        batch_size=DEFAULT_BATCH_SIZE, merchant=None):
+    """
+    Bulk version of create_transaction() for many authorizations.
+    
+    Submits the authorize requests in data_iterable over a pool of `workers`
+    concurrent requests (default settings.SKIPJACK_WORKERS, or 4) and yields
+    each Transaction as it's created. Transactions are inserted batch_size at
+    a time, and the payment signals are sent once per Transaction after its
+    batch has been committed.
+    
+    A failed request doesn't stop the others; BulkTransactionError is raised
+    once everything else is done, listing the data that failed.
+    
+    If the generator is closed early (or the caller raises while consuming
+    it), no further requests are started, but every authorization already
+    made, including those still in flight, is stored before it returns.
+    
+    """
+    failures = []
+    pending = []
+    stopped = []
+    def authorize(data):
+        return _authorize(data, merchant)
+    def requests():
+        for data in data_iterable:
+            if stopped:
+                return
+            yield data
+    results = imap_unordered(authorize, requests(), workers)
+    try:
+        for data, response_dict, error in results:
+            if error:
+                failures.append((data, error))
+                continue
+            pending.append(response_dict)
+            if len(pending) >= batch_size:
+                batch, pending = pending, []
+                for payment in _create_batch(batch):
+                    yield payment
+        batch, pending = pending, []
+        for payment in _create_batch(batch):
+            yield payment
+    finally:
+        # Store the authorizations not yet inserted, without yielding them:
+        # the customers have been charged.
+        stopped.append(True)
+        for data, response_dict, error in results:
+            if not error:
+                pending.append(response_dict)
+        if pending:
+            _create_batch(pending)
+    if failures:
+        raise BulkTransactionError(failures)
 
 
-def get_transaction_status(order_number, transaction_id=None):
+def get_transaction_status(order_number, transaction_id=None, merchant=None):
     """
     Returns a textual description of either the latest transaction associated
     with the request, or the status of the specified transaction_id.
@@ -80,37 +231,47 @@ def get_transaction_status(order_number, transaction_id=None):
     Naturally, the SerialNumber and DeveloperSerialNumber fields are prefixed
     with 'sz' making them totally inconsistent with the authorize request above.
     
+    Skipjack returns the order's whole history either way, so concurrent
+    requests for the same order (including from get_order_transaction_history)
+    share a single request to Skipjack.
+    
     """
-    helper = StatusHelper(defaults=SZ_DEFAULT_LIST)
-    response_dict = helper.get_response(order_number,
-                                        transaction_id=transaction_id)
-    response = Status(**response_dict)
-    return response
+    return StatusHelper.select(_order_history(order_number, merchant),
+                               transaction_id)
+
 
+def _order_history(order_number, merchant=None):
+    """The order's history, from a request shared with concurrent callers."""
+    helper = StatusHistoryHelper(
+                            defaults=get_merchant(merchant).sz_default_list,
+                            merchant=merchant)
+    return _in_flight.do(('status', merchant or '', order_number),
+                         helper.get_response, order_number)
 
-def get_order_transaction_history(order_number):
+
+def get_order_transaction_history(order_number, merchant=None):
     """
     Returns a list of Status objects representing the transaction history
     of the given order.
     
+    Concurrent requests for the same order share a single request to
+    Skipjack.
+    
     """
-    helper = StatusHistoryHelper(defaults=SZ_DEFAULT_LIST)
-    response_list = helper.get_response(order_number)
-    history = []
-    for response_dict in response_list:
-        history.append(Status(**response_dict))
-    return history
+    return list(_order_history(order_number, merchant))
 
 
 def change_transaction_status(transaction_id, desired_status, amount=None,
-                              force_settlement=True):
+                              force_settlement=True, merchant=None):
     """
     Changes a specified transaction to the desired status if Skipjack can.
     
     Returns a textual description of the response from Skipjack.
     
     """
-    helper = ChangeStatusHelper(defaults=SZ_DEFAULT_LIST)
+    helper = ChangeStatusHelper(
+                            defaults=get_merchant(merchant).sz_default_list,
+                            merchant=merchant)
     data = [('szTransactionId', transaction_id),
             ('szDesiredStatus', desired_status)]
     if amount:
@@ -120,25 +281,24 @@ def change_transaction_status(transaction_id, desired_status, amount=None,
             data.append(('szForceSettlement', '1'))
         else:
             data.append(('szForceSettlement', '0'))
-    response_dict = helper.get_response(data)
-    response = StatusChange(**response_dict)
-    return response
+    return helper.get_response(data)
 
 
-def close_current_batch():
+def close_current_batch(merchant=None):
     """
     Close the current (open) batch.
     
     Returns a textual description of the response from Skipjack.
     
     """
-    helper = CloseBatchHelper(defaults=SZ_DEFAULT_LIST)
+    helper = CloseBatchHelper(defaults=get_merchant(merchant).sz_default_list,
+                              merchant=merchant)
     response_dict = helper.get_response()
     response = dict(CLOSE_BATCH_STATUS_CHOICES)[response_dict['status']]
     return response
 
 
-def amount_paid(order_number):
+def amount_paid(order_number, merchant=None):
     """
     Iterates through the status history for the given order and calculates
     the amount paid by adding the amounts for Settled, Credited, or
@@ -146,36 +306,14 @@ def amount_paid(order_number):
     
     """    
     amount = Decimal('0.00')
-    for trans in get_order_transaction_history(order_number):
+    for trans in get_order_transaction_history(order_number, merchant):
         if trans.current_status in (SETTLED, CREDITED, SPLIT_SETTLED):
             amount += trans.amount
     return amount
 
 
-def transaction_reports(start_date=None, end_date=None,
-                        extra_fields=None, **kwargs):
-    """
-    Using the Customized Report API we can get transaction data for use
-    in adding transactions into your system, and checking their status
-    with one call. Defaults to showing transactions from the current day.
-    
-    extra_fields should be a list of extra fields to show, such as:
-        ('CardType', 'PurchaseOrderNumber', 'CustomerName', 'CustomerEmail')
-        
-        By default we return the transaction date, status, id, order number,
-        approval code, amount, and original amount.
-    
-    kwargs offers complete override (or addition) of any desired fields
-    according to the Skipjack Reporting API for Customized Reports.
-    
-    See the Skipjack Reporting API Integration Guide for further detail.
-    
-    """
-    helper = ReportHelper(defaults=REPORT_DEFAULT_LIST)
-    if not start_date:
-        start_date = datetime.date.today()
-    if not end_date:
-        end_date = datetime.date.today()
+def _report_request(start_date, end_date, extra_fields, kwargs):
+    """The Customized Report API request data for the given dates."""
     data = [
         ('sRecsPerPage', 1000),
         ('sPosted', 1),
@@ -211,7 +349,124 @@ def transaction_reports(start_date=None, end_date=None,
     if kwargs:
         for field, val in kwargs.items():
             data.append((field, val))
-    response = helper.get_response(data)
-    return response
+    return data
 
-    
\ No newline at end of file
+
+def report_windows(start_date, end_date, days=1):
+    """
+    Splits start_date..end_date (inclusive) into consecutive windows of
+    `days` days, returning a list of (start, end) date tuples in order.
+    
+    """
+    windows = []
+    step = datetime.timedelta(days=days)
+    one_day = datetime.timedelta(days=1)
+    while start_date <= end_date:
+        windows.append((start_date, min(start_date + step - one_day,
+                                        end_date)))
+        start_date += step
+    return windows
+
+
+def _split_final_days(windows):
+    """
+    Splits the days of the windows whose reports are final into windows of
+    their own, so that they can be cached a day at a time.
+    
+    """
+    split = []
+    one_day = datetime.timedelta(days=1)
+    for start_date, end_date in windows:
+        while start_date <= end_date and reportcache.is_final(start_date):
+            split.append((start_date, start_date))
+            start_date += one_day
+        if start_date <= end_date:
+            split.append((start_date, end_date))
+    return split
+
+
+def transaction_reports(start_date=None, end_date=None,
+                        extra_fields=None, split_days=None, workers=None,
+                        columnar=False, merchant=None, **kwargs):
+    """
+    Using the Customized Report API we can get transaction data for use
+    in adding transactions into your system, and checking their status
+    with one call. Defaults to showing transactions from the current day.
+    
+    extra_fields should be a list of extra fields to show, such as:
+        ('CardType', 'PurchaseOrderNumber', 'CustomerName', 'CustomerEmail')
+        
+        By default we return the transaction date, status, id, order number,
+        approval code, amount, and original amount.
+    
+    Skipjack returns the report a page (sRecsPerPage rows, 1000 unless
+    overridden) at a time, so pages are requested until one comes back short.
+    
+    split_days splits a long date range into windows of that many days
+    (e.g. 1 for a request per day), which are fetched `workers` at a time
+    (default settings.SKIPJACK_WORKERS, or 4) and merged back in transaction
+    date order. A long range then takes about as long as its slowest window
+    rather than one huge request.
+    
+    With settings.SKIPJACK_REPORT_CACHE_DIR set, the reports for past days
+    are cached there a day at a time, and only the days not yet cached (and
+    those that may still change) are requested from Skipjack.
+    
+    columnar returns a skipjack.parsers.ReportColumns, holding the report
+    by column as arrays of integer cents, timestamps and status codes, in
+    place of the list of dicts. It takes much less memory for large reports
+    and can be summed, grouped and filtered without converting each value
+    (or with NumPy, through its to_numpy() method).
+    
+    merchant names the merchant account to report on, the default account
+    if not given.
+    
+    kwargs offers complete override (or addition) of any desired fields
+    according to the Skipjack Reporting API for Customized Reports.
+    
+    See the Skipjack Reporting API Integration Guide for further detail.
+    
+    """
+    defaults = get_merchant(merchant).report_default_list
+    helper = ReportHelper(defaults=defaults, merchant=merchant)
+    if not start_date:
+        start_date = datetime.date.today()
+    if not end_date:
+        end_date = datetime.date.today()
+    caching = bool(reportcache.cache_dir())
+    if not (split_days or caching):
+        return helper.get_response(_report_request(start_date, end_date,
+                                                   extra_fields, kwargs),
+                                   columnar)
+    windows = report_windows(start_date, end_date, split_days or
+                             (end_date - start_date).days + 1)
+    if caching:
+        windows = _split_final_days(windows)
+        serial_number = dict(defaults)['sSerialNumber_Merchant']
+    def fetch(window):
+        request = _report_request(window[0], window[1], extra_fields, kwargs)
+        if not (caching and window[0] == window[1] and
+                reportcache.is_final(window[0])):
+            return helper.get_response(request, columnar)
+        path = reportcache.cache_path(serial_number, window[0],
+                                      extra_fields, kwargs)
+        rows = reportcache.read(path, columnar)
+        if rows is None:
+            data = helper.get_all_data(request)
+            reportcache.write(path, data)
+            rows = parse_report_data(data, columnar)
+        return rows
+    pages = {}
+    for window, rows, error in imap_unordered(fetch, windows, workers):
+        if error:
+            raise error[0], error[1], error[2]
+        pages[window] = rows
+    # The windows don't overlap, and each is ordered by dtTransactionDate,
+    # so concatenating them in order merges them.
+    if columnar:
+        response = ReportColumns()
+    else:
+        response = []
+    for window in windows:
+        response.extend(pages[window])
+    return response
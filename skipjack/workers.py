@@ -0,0 +1,278 @@
+"""
+Small thread pools for running Skipjack work concurrently, or in the
+background.
+
+The requests spend nearly all their time waiting on the network, so threads
+are sufficient, and the standard library of the Python versions we support
+has no concurrent.futures.
+
+Optional settings:
+    SKIPJACK_WORKERS - default number of concurrent requests (default 4).
+    SKIPJACK_BACKGROUND_WORKERS - threads running deferred work (default 2).
+
+"""
+import atexit
+import logging
+import Queue
+import sys
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+
+DEFAULT_WORKERS = 4
+DEFAULT_BACKGROUND_WORKERS = 2
+
+logger = logging.getLogger('skipjack')
+
+_STOP = object()
+
+
+def default_workers():
+    """The configured number of concurrent requests."""
+    return getattr(settings, 'SKIPJACK_WORKERS', DEFAULT_WORKERS)
+
+
+def imap_unordered(func, iterable, workers=None):
+    """
+    Calls func for each item of iterable on up to `workers` threads, yielding
+    (item, result, error) tuples as each call completes.
+
+    error is None on success, otherwise the sys.exc_info() of the exception
+    func raised (and result is None). One failure doesn't stop the rest.
+    func runs on the worker threads, so it should only talk to Skipjack and
+    leave the database to the caller, which gets each item back in its own
+    thread.
+
+    The iterable is consumed in the calling thread, and no more than twice
+    `workers` items are taken from it ahead of the results being consumed,
+    so arbitrarily long iterables run in bounded memory.
+
+    """
+    workers = workers or default_workers()
+    tasks = Queue.Queue()
+    results = Queue.Queue()
+    stopped = threading.Event()
+
+    def work():
+        while True:
+            item = tasks.get()
+            if item is _STOP:
+                return
+            if stopped.isSet():
+                continue
+            try:
+                results.put((item, func(item), None))
+            except Exception:
+                results.put((item, None, sys.exc_info()))
+
+    threads = []
+    for i in range(workers):
+        thread = threading.Thread(target=work, name='skipjack-worker-%d' % i)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+
+    items = iter(iterable)
+    limit = workers * 2
+    in_flight = 0
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and in_flight < limit:
+                try:
+                    item = items.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                tasks.put(item)
+                in_flight += 1
+            if not in_flight:
+                break
+            yield results.get()
+            in_flight -= 1
+    finally:
+        # Anything not yet started is skipped if we're stopped early.
+        stopped.set()
+        for thread in threads:
+            tasks.put(_STOP)
+        if not in_flight:
+            for thread in threads:
+                thread.join()
+
+
+class Executor(object):
+    """
+    Runs submitted calls on a pool of background threads, started on first
+    use. Exceptions are logged, not raised.
+    
+    Each call's database connections are closed once it's done, as a thread
+    otherwise keeps its own connection open for as long as it lives.
+    
+    """
+    def __init__(self, workers, name='skipjack-background'):
+        self.workers = workers
+        self.name = name
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work, name='%s-%d' % (
+                                                self.name, len(self.threads)))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) to run in the background."""
+        if len(self.threads) < self.workers:
+            self.start()
+        self.tasks.put((func, args, kwargs))
+
+    def work(self):
+        while True:
+            func, args, kwargs = self.tasks.get()
+            try:
+                try:
+                    func(*args, **kwargs)
+                except Exception:
+                    logger.exception('Background call to %r failed', func)
+            finally:
+                for connection in connections.all():
+                    connection.close()
+                self.tasks.task_done()
+
+    def join(self):
+        """Block until everything submitted so far has run."""
+        self.tasks.join()
+
+
+_background = None
+_background_lock = threading.Lock()
+
+
+def background():
+    """Returns the shared background Executor."""
+    global _background
+    if _background is None:
+        _background_lock.acquire()
+        try:
+            if _background is None:
+                _background = Executor(getattr(settings,
+                                               'SKIPJACK_BACKGROUND_WORKERS',
+                                               DEFAULT_BACKGROUND_WORKERS))
+                # Don't lose queued work when the process exits normally.
+                atexit.register(_background.join)
+        finally:
+            _background_lock.release()
+    return _background
+
+
+_deferred = threading.local()
+
+
+def defer(func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) on the background Executor once the current
+    transaction on the default database has committed, see defer_using().
+    
+    """
+    defer_using(DEFAULT_DB_ALIAS, func, *args, **kwargs)
+
+
+def defer_using(using, func, *args, **kwargs):
+    """
+    Run func(*args, **kwargs) on the background Executor once the current
+    transaction on the `using` database has committed.
+    
+    Uses transaction.on_commit where Django provides it. Otherwise, when
+    not under transaction management the data has already been committed,
+    so it's submitted straight away. When under transaction management
+    (TransactionMiddleware, commit_on_success, commit_manually) it's held
+    until the connection commits, and discarded if it rolls back instead.
+    Anything still held when the request finishes was never committed, and
+    is discarded too.
+    
+    """
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(lambda: background().submit(func, *args, **kwargs),
+                  using=using)
+    elif transaction.is_managed(using=using):
+        hook_connection(using)
+        if not hasattr(_deferred, 'calls'):
+            _deferred.calls = {}
+        _deferred.calls.setdefault(using, []).append((func, args, kwargs))
+    else:
+        background().submit(func, *args, **kwargs)
+
+
+def hook_connection(using):
+    """
+    Has the connection for `using` run this thread's deferred calls when it
+    commits, and discard them when it rolls back. (Connections are thread
+    local, so this only hooks this thread's.)
+    
+    """
+    connection = connections[using]
+    if getattr(connection, '_skipjack_hooked', False):
+        return
+    commit, rollback = connection.commit, connection.rollback
+    def hooked_commit():
+        commit()
+        flush_deferred(using=using)
+    def hooked_rollback():
+        rollback()
+        discard_deferred(using=using)
+    connection.commit = hooked_commit
+    connection.rollback = hooked_rollback
+    connection._skipjack_hooked = True
+
+
+def flush_deferred(using=None):
+    """
+    Submit the calls this thread deferred until the `using` database (all
+    of them by default) committed. Called when the connection commits.
+    
+    """
+    calls = getattr(_deferred, 'calls', None)
+    if not calls:
+        return
+    if using is None:
+        flushed = [call for alias in calls for call in calls[alias]]
+        calls.clear()
+    else:
+        flushed = calls.pop(using, [])
+    executor = background()
+    for func, args, kwargs in flushed:
+        executor.submit(func, *args, **kwargs)
+
+
+def discard_deferred(using=None, **extra):
+    """
+    Drop the calls this thread deferred until the `using` database (all of
+    them by default) committed, as it rolled back instead.
+    
+    """
+    calls = getattr(_deferred, 'calls', None)
+    if not calls:
+        return
+    if using is None:
+        discarded = sum(len(alias_calls) for alias_calls in calls.values())
+        calls.clear()
+    else:
+        discarded = len(calls.pop(using, []))
+    if discarded:
+        logger.info('Discarded %d deferred calls that were never committed',
+                    discarded)
+# By the end of the request TransactionMiddleware has committed or rolled
+# back, so anything left was never committed.
+request_finished.connect(discard_deferred)